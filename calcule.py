@@ -1,2272 +1,3197 @@
-# FINboot.py — one-file Telegram finance helper (Python 3.10+, PTB v21)
-
-import os
-import re
-import sys
-import sqlite3
-import html
-import logging
-
-try:
-    import jdatetime  # optional
-except Exception:
-    jdatetime = None
-
-from dataclasses import dataclass
-from datetime import date, timedelta
-from contextlib import contextmanager
-from typing import Optional, List, Tuple
-from pathlib import Path
-from functools import wraps
-
-try:
-    # Import the required classes from python‑telegram‑bot.  The library must be version 21 or newer.
-    from telegram import ForceReply, InlineKeyboardButton, InlineKeyboardMarkup, Update
-    from telegram.constants import ParseMode, UpdateType
-    from telegram.ext import (
-        Application,
-        ApplicationBuilder,
-        CallbackContext,
-        CallbackQueryHandler,
-        CommandHandler,
-        MessageHandler,
-        filters,
-        Defaults,
-        ContextTypes,
-    )
-    from telegram.error import BadRequest
-
-except ImportError:
-    print(
-        "ERROR: python‑telegram‑bot v21+ is required. Install with: pip install python-telegram-bot==21.*",
-        file=sys.stderr,
-    )
-    sys.exit(1)
-
-logger = logging.getLogger(__name__)
-
-MAX_MESSAGE_LENGTH = 4096
-TRUNCATE_THRESHOLD = 4000
-TRUNCATE_BODY_LENGTH = 3900
-TRUNCATION_SUFFIX = "\n\n… [truncated]"
-HELP_TEXT = (
-    "دستورات در دسترس:\n"
-    "/start — بازگشت به خانه\n"
-    "/help — همین راهنما\n"
-    "/about — معرفی ربات\n"
-    "/ping — بررسی اتصال\n\n"
-    "برای مبالغ می‌توان از k (هزار)، m (میلیون) و b (میلیارد) استفاده کرد."
-)
-ABOUT_TEXT = (
-    "FINbot یک دستیار مالی برای داروخانه‌هاست؛ ذخیره‌سازی داده، گزارش‌گیری و مقایسه ماهانه را ساده می‌کند."
-)
-
-def h(value: Optional[str]) -> str:
-    """Escape user-sourced strings for safe HTML output."""
-    return html.escape(value or "")
-
-def _truncate_text(text: str) -> str:
-    """Ensure messages stay within Telegram limits with a friendly suffix."""
-    if len(text) <= TRUNCATE_THRESHOLD:
-        return text
-    trimmed = text[:TRUNCATE_BODY_LENGTH]
-    if "\n" in trimmed:
-        trimmed = trimmed.rsplit("\n", 1)[0]
-    trimmed = trimmed.rstrip()
-    suffix = TRUNCATION_SUFFIX
-    if len(trimmed) + len(suffix) > MAX_MESSAGE_LENGTH:
-        trimmed = trimmed[: MAX_MESSAGE_LENGTH - len(suffix)]
-    return f"{trimmed}{suffix}"
-
-def owner_only_access(func):
-    @wraps(func)
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user_id = update.effective_user.id if update.effective_user else None
-        if user_id not in OWNER_USER_IDS:
-            return
-        return await func(update, context, *args, **kwargs)
-    return wrapper
-
-OWNER_USER_IDS = (
-    {int(x) for x in os.environ.get("OWNER_USER_IDS", "").split(",") if x.strip().isdigit()}
-    if os.environ.get("OWNER_USER_IDS")
-    else set()
-)
-
-
-async def safe_edit(
-    message,
-    text: str,
-    reply_markup=None,
-    context: Optional[ContextTypes.DEFAULT_TYPE] = None,
-    log_context: str = "safe_edit",
-) -> None:
-    """Edit a message with HTML-safe text, handling BadRequest gracefully."""
-    if not message:
-        return
-    primary = _truncate_text(text)
-    try:
-        await message.edit_text(primary, reply_markup=reply_markup)
-        return
-    except BadRequest as exc:
-        logger.warning("%s failed (primary): %s", log_context, exc)
-        fallback = _truncate_text(h(text))
-        try:
-            if fallback != primary:
-                await message.edit_text(fallback, reply_markup=reply_markup)
-                return
-        except BadRequest as exc2:
-            logger.warning("%s fallback failed: %s", log_context, exc2)
-        bot = context.bot if context and getattr(context, "bot", None) else getattr(message, "bot", None)
-        chat_id = getattr(message, "chat_id", None)
-        if bot and chat_id is not None:
-            try:
-                await bot.send_message(chat_id=chat_id, text=fallback, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-            except BadRequest as exc3:
-                logger.error("%s fallback send failed: %s", log_context, exc3)
-        else:
-            logger.error("%s: unable to send fallback message (no bot/chat).", log_context)
-
-async def safe_reply(
-    message,
-    text: str,
-    reply_markup=None,
-    context: Optional[ContextTypes.DEFAULT_TYPE] = None,
-    log_context: str = "safe_reply",
-) -> None:
-    """Reply to a message with HTML-safe text, guarding against BadRequest issues."""
-    if not message:
-        return
-    primary = _truncate_text(text)
-    try:
-        await message.reply_text(primary, reply_markup=reply_markup)
-        return
-    except BadRequest as exc:
-        logger.warning("%s failed (primary): %s", log_context, exc)
-        fallback = _truncate_text(h(text))
-        try:
-            if fallback != primary:
-                await message.reply_text(fallback, reply_markup=reply_markup)
-                return
-        except BadRequest as exc2:
-            logger.warning("%s fallback failed: %s", log_context, exc2)
-        bot = context.bot if context and getattr(context, "bot", None) else getattr(message, "bot", None)
-        chat_id = getattr(message, "chat_id", None)
-        if bot and chat_id is not None:
-            try:
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=fallback,
-                    reply_markup=reply_markup,
-                    parse_mode=ParseMode.HTML,
-                    reply_to_message_id=getattr(message, "message_id", None),
-                )
-            except BadRequest as exc3:
-                logger.error("%s fallback send failed: %s", log_context, exc3)
-        else:
-            logger.error("%s: unable to send fallback message (no bot/chat).", log_context)
-
-def ensure_data_dir(path: str) -> None:
-    """Make sure the directory for the database path exists."""
-    p = Path(path).parent
-    p.mkdir(parents=True, exist_ok=True)
-
-def get_token() -> str:
-    """\n    Retrieve the bot token from environment variables.\n\n    In non‑interactive environments (e.g. a deployed bot), prompting the user for a\n    token via ``input()`` is not practical. Instead, we read the token from the\n    ``FINBOT_TOKEN`` or ``BOT_TOKEN`` environment variables. If neither is set\n    or is empty after stripping whitespace, the function exits with an error\n    message.\n    """
-    tok = (os.environ.get("FINBOT_TOKEN") or os.environ.get("BOT_TOKEN") or "").strip()
-    if not tok:
-        print(
-            "No token provided. Set FINBOT_TOKEN or BOT_TOKEN environment variables.",
-            file=sys.stderr,
-        )
-        sys.exit(1)
-    return tok
-
-BOT_TOKEN = get_token()
-import os
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "robot_moein_data.db")
-
-OWNER_USER_IDS = (
-    {int(x) for x in os.environ.get("OWNER_USER_IDS", "").split(",") if x.strip().isdigit()}
-    if os.environ.get("OWNER_USER_IDS")
-    else set()
-)
-ensure_data_dir(DB_PATH)
-
-TAG_PHARM_SELECT = "fin.pharm.select"
-TAG_PHARM_NEW = "fin.pharm.new"
-TAG_PERIOD_SELECT = "fin.period.select"
-TAG_PERIOD_NEW = "fin.period.new"
-TAG_DAILY_START = "main.daily"
-TAG_DAILY_PICK_DAY = "fin.daily.pick_day"
-TAG_DAILY_FLOW_PICK_DAY = "daily.pick_day"
-TAG_SUMMARY_START = "main.summary"
-TAG_SUMMARY_PICK_MONTH = "summary.pick_month"
-TAG_CHECK_START = "main.check"
-TAG_CHECK_PICK_DAY = "check.pick_day"
-TAG_WEEKLY_REPORT = "fin.weekly.report"
-TAG_PERIOD_NEW_JALALI = "fin.period.new_from_jalali"
-TAG_COMPARE_PREV = "fin.compare.prev"
-TAG_COMPARE_MONTHS = "fin.compare.months"
-TAG_COMPARE_PICK = "fin.compare.pick"
-TAG_COMPARE_PICK_FIRST = "fin.compare.pick_first"
-TAG_COMPARE_PICK_SECOND = "fin.compare.pick_second"
-TAG_COMPARE_START = "fin.compare.start"
-
-# Tag for triggering simple PDF report generation
-TAG_PDF_SIMPLE = "fin.pdf.simple"
-
-# Tags for two elver simulation
-TAG_SIM_MENU = "fin.sim.menu"
-TAG_SIM_DELTA = "fin.sim.delta"
-TAG_SIM_RESET = "fin.sim.reset"
-TAG_SIM_BACK = "fin.sim.back"
-
-@contextmanager
-def db_conn():
-    """Context manager for SQLite connections with foreign keys enabled."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    conn.execute("PRAGMA foreign_keys = ON;")
-    try:
-        yield conn
-        conn.commit()
-    finally:
-        conn.close()
-
-def migrate() -> None:
-    """Create the necessary tables and indexes if they do not exist."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            """\n        CREATE TABLE IF NOT EXISTS pharmacies(\n          id INTEGER PRIMARY KEY,\n          title TEXT NOT NULL,\n          created_at TEXT NOT NULL\n        );\n        """
-        )
-        c.execute(
-            """\n        CREATE TABLE IF NOT EXISTS periods(\n          id INTEGER PRIMARY KEY,\n          pharmacy_id INTEGER NOT NULL,\n          title TEXT NOT NULL,\n          start_date TEXT NOT NULL,\n          end_date TEXT NOT NULL,\n          status TEXT NOT NULL DEFAULT 'open',\n          created_at TEXT NOT NULL,\n          FOREIGN KEY(pharmacy_id) REFERENCES pharmacies(id)\n        );\n        """
-        )
-        c.execute(
-            """\n        CREATE TABLE IF NOT EXISTS period_metrics(\n          id INTEGER PRIMARY KEY,\n          pharmacy_id INTEGER NOT NULL,\n          period_id INTEGER NOT NULL,\n          basis TEXT NOT NULL DEFAULT 'cash',\n          sales_cash REAL NOT NULL DEFAULT 0,\n          sales_ins REAL NOT NULL DEFAULT 0,\n          sales_total REAL NOT NULL DEFAULT 0,\n          var_total REAL NOT NULL DEFAULT 0,\n          fixed_rent REAL NOT NULL DEFAULT 0,\n          fixed_staff REAL NOT NULL DEFAULT 0,\n          fixed_total REAL NOT NULL DEFAULT 0,\n          opex_other_total REAL NOT NULL DEFAULT 0,\n          visits_total INTEGER NOT NULL DEFAULT 0,\n          days_count INTEGER NOT NULL DEFAULT 30,\n          gross_profit REAL NOT NULL DEFAULT 0,\n          net_profit_operational REAL NOT NULL DEFAULT 0,\n          contrib_margin REAL NOT NULL DEFAULT 0,\n          cm_ratio REAL NOT NULL DEFAULT 0,\n          breakeven_sales REAL NOT NULL DEFAULT 0,\n          avg_daily_sales REAL NOT NULL DEFAULT 0,\n          avg_sale_per_visit REAL NOT NULL DEFAULT 0,\n          computed_at TEXT,\n          locked_at TEXT,\n          UNIQUE (pharmacy_id, period_id, basis),\n          FOREIGN KEY(pharmacy_id) REFERENCES pharmacies(id),\n          FOREIGN KEY(period_id) REFERENCES periods(id)\n        );\n        """
-        )
-        # Add np_ratio column (net profit margin) if it does not exist.
-        try:
-            c.execute("ALTER TABLE period_metrics ADD COLUMN np_ratio REAL NOT NULL DEFAULT 0;")
-        except sqlite3.OperationalError:
-            # Column already exists; ignore error
-            pass
-        c.execute("CREATE INDEX IF NOT EXISTS idx_periods_pharmacy ON periods(pharmacy_id);")
-        c.execute(
-            """\n        CREATE INDEX IF NOT EXISTS idx_metrics_ppb\n        ON period_metrics(pharmacy_id, period_id, basis);\n        """
-        )
-        c.execute(
-            """\n        CREATE TABLE IF NOT EXISTS daily_logs(\n          id INTEGER PRIMARY KEY,\n          pharmacy_id INTEGER NOT NULL,\n          log_date TEXT NOT NULL,\n          sales_cash REAL NOT NULL DEFAULT 0,\n          sales_ins REAL NOT NULL DEFAULT 0,\n          var_purchases REAL NOT NULL DEFAULT 0,\n          opex_other REAL NOT NULL DEFAULT 0,\n          visits INTEGER NOT NULL DEFAULT 0,\n          note TEXT,\n          created_at TEXT NOT NULL DEFAULT (datetime('now')),\n          FOREIGN KEY(pharmacy_id) REFERENCES pharmacies(id),\n          UNIQUE (pharmacy_id, log_date)\n        );\n        """
-        )
-        c.execute(
-            """\n        CREATE INDEX IF NOT EXISTS idx_daily_logs_pharmacy_date\n        ON daily_logs(pharmacy_id, log_date);\n        """
-        )
-
-def upsert_daily_log(
-    pharmacy_id: int,
-    log_date: str,
-    sales_cash: float = 0,
-    sales_ins: float = 0,
-    var_purchases: float = 0,
-    opex_other: float = 0,
-    visits: int = 0,
-    note: Optional[str] = None,
-) -> None:
-    """Insert or update a daily log entry keyed by pharmacy and date."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            """\n        INSERT INTO daily_logs(\n          pharmacy_id, log_date, sales_cash, sales_ins, var_purchases, opex_other, visits, note\n        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)\n        ON CONFLICT (pharmacy_id, log_date) DO UPDATE SET\n          sales_cash=excluded.sales_cash,\n          sales_ins=excluded.sales_ins,\n          var_purchases=excluded.var_purchases,\n          opex_other=excluded.opex_other,\n          visits=excluded.visits,\n          note=excluded.note;\n        """,
-            (
-                pharmacy_id,
-                log_date,
-                sales_cash,
-                sales_ins,
-                var_purchases,
-                opex_other,
-                visits,
-                note,
-            ),
-        )
-
-def get_daily_range(
-    pharmacy_id: int, start_iso: str, end_iso: str
-) -> List[sqlite3.Row]:
-    """Return daily logs within an inclusive date range ordered by date."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            """\n        SELECT *\n        FROM daily_logs\n        WHERE pharmacy_id = ? AND log_date BETWEEN ? AND ?\n        ORDER BY log_date ASC;\n        """,
-            (pharmacy_id, start_iso, end_iso),
-        )
-        return c.fetchall()
-
-def get_last_daily_for_month(
-    pharmacy_id: int, start_iso: str, end_iso: str
-) -> Optional[sqlite3.Row]:
-    """Return the most recent daily log within the given inclusive range."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            """\n        SELECT *\n        FROM daily_logs\n        WHERE pharmacy_id = ? AND log_date BETWEEN ? AND ?\n        ORDER BY log_date DESC\n        LIMIT 1;\n        """,
-            (pharmacy_id, start_iso, end_iso),
-        )
-        return c.fetchone()
-
-def upsert_metrics_cash(
-    pharmacy_id: int,
-    period_id: int,
-    sales_cash: float,
-    sales_ins: float,
-    var_total: float,
-    fixed_rent: float,
-    fixed_staff: float,
-    opex_other_total: float,
-    visits_total: int,
-    days_count: int,
-) -> None:
-    """Insert or update cash‑basis metrics and recompute derived KPIs."""
-    sales_total = (sales_cash or 0.0) + (sales_ins or 0.0)
-    fixed_total = (fixed_rent or 0.0) + (fixed_staff or 0.0)
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            """\n        INSERT INTO period_metrics(\n          pharmacy_id, period_id, basis,\n          sales_cash, sales_ins, sales_total,\n          var_total, fixed_rent, fixed_staff, fixed_total,\n          opex_other_total, visits_total, days_count, computed_at\n        ) VALUES (?, ?, 'cash', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))\n        ON CONFLICT (pharmacy_id, period_id, basis) DO UPDATE SET\n          sales_cash=excluded.sales_cash,\n          sales_ins=excluded.sales_ins,\n          sales_total=excluded.sales_total,\n          var_total=excluded.var_total,\n          fixed_rent=excluded.fixed_rent,\n          fixed_staff=excluded.fixed_staff,\n          fixed_total=excluded.fixed_total,\n          opex_other_total=excluded.opex_other_total,\n          visits_total=excluded.visits_total,\n          days_count=excluded.days_count,\n          computed_at=excluded.computed_at;\n        """,
-            (
-                pharmacy_id,
-                period_id,
-                sales_cash,
-                sales_ins,
-                sales_total,
-                var_total,
-                fixed_rent,
-                fixed_staff,
-                fixed_total,
-                opex_other_total,
-                visits_total,
-                days_count,
-            ),
-        )
-        c.execute(
-            """\n        UPDATE period_metrics\n        SET\n          gross_profit = sales_total - var_total,\n          net_profit_operational = (sales_total - var_total) - fixed_total - opex_other_total,\n          contrib_margin = sales_total - var_total,\n          cm_ratio = CASE WHEN sales_total > 0 THEN (sales_total - var_total)/sales_total ELSE 0 END,\n          np_ratio = CASE\n                       WHEN sales_total > 0\n                       THEN ((sales_total - var_total) - fixed_total - opex_other_total) * 1.0 / sales_total\n                       ELSE 0\n                     END,\n          breakeven_sales = CASE\n                             WHEN sales_total > 0 AND (sales_total - var_total)/sales_total > 0\n                             THEN fixed_total / ((sales_total - var_total)/sales_total)\n                             ELSE 0 END,\n          avg_daily_sales = CASE WHEN days_count > 0 THEN sales_total*1.0/days_count ELSE 0 END,\n          avg_sale_per_visit = CASE WHEN visits_total > 0 THEN sales_total*1.0/visits_total ELSE 0 END\n        WHERE pharmacy_id = ? AND period_id = ? AND basis = 'cash';\n        """,
-            (pharmacy_id, period_id),
-        )
-
-def new_pharmacy(title: str) -> int:
-    """Create a new pharmacy entry and return its id (raises on failure)."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute("INSERT INTO pharmacies(title, created_at) VALUES (?, datetime('now'));", (title,))
-        last = c.lastrowid
-        if last is None:
-            raise RuntimeError("Failed to create pharmacy record")
-        return int(last)
-
-def list_pharmacies() -> List[sqlite3.Row]:
-    """Return a list of all pharmacies in descending order of ID."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute("SELECT * FROM pharmacies ORDER BY id DESC;")
-        return c.fetchall()
-
-PERIOD_OVERLAP_MESSAGE = "❗ این بازه زمانی با یک دورهٔ دیگر هم‌پوشانی دارد."
-
-class PeriodOverlapError(Exception):
-    """Raised when attempting to create a period that overlaps an existing one."""
-
-    def __init__(self, message: str = PERIOD_OVERLAP_MESSAGE) -> None:
-        super().__init__(message)
-
-def new_period(pharmacy_id: int, title: str, start_date: str, end_date: str) -> int:
-    """Insert a new period for a given pharmacy.\n\n    Raises:\n        PeriodOverlapError: If the proposed date range overlaps an existing period.\n    """
-    with db_conn() as conn:
-        c = conn.cursor()
-        # Prevent overlapping periods for the same pharmacy by checking whether any existing
-        # period intersects the requested inclusive date range before inserting.
-        c.execute(
-            """\n        SELECT id\n        FROM periods\n        WHERE pharmacy_id = ?\n          AND NOT (end_date < ? OR start_date > ?)\n        LIMIT 1;\n        """,
-            (pharmacy_id, start_date, end_date),
-        )
-        overlap = c.fetchone()
-        if overlap:
-            raise PeriodOverlapError()
-        c.execute(
-            """\n        INSERT INTO periods(pharmacy_id, title, start_date, end_date, status, created_at)\n        VALUES (?, ?, ?, ?, 'open', datetime('now'));\n        """,
-            (pharmacy_id, title, start_date, end_date),
-        )
-        return c.lastrowid
-
-def find_period_by_bounds(
-    pharmacy_id: int, start_iso: str, end_iso: str
-) -> Optional[dict]:
-    """Return the period row (as dict) matching the inclusive ISO bounds, if any."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            """\n        SELECT *\n        FROM periods\n        WHERE pharmacy_id = ?\n          AND start_date = ?\n          AND end_date = ?;\n        """,
-            (pharmacy_id, start_iso, end_iso),
-        )
-        row = c.fetchone()
-        return dict(row) if row else None
-
-def get_period_by_jalali(pharmacy_id: int, jy: int, jm: int) -> Optional[dict]:
-    """Return the period dict for the given Jalali year/month if it exists."""
-    start_date, end_date, _ = jalali_month_bounds(jy, jm)
-    return find_period_by_bounds(pharmacy_id, start_date.isoformat(), end_date.isoformat())
-
-def list_periods(pharmacy_id: int) -> List[sqlite3.Row]:
-    """Fetch all periods for a given pharmacy ordered by start date descending."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            """\n        SELECT * FROM periods\n        WHERE pharmacy_id = ?\n        ORDER BY start_date DESC;\n        """,
-            (pharmacy_id,),
-        )
-        return c.fetchall()
-
-def get_period(period_id: int) -> Optional[sqlite3.Row]:
-    """Retrieve a single period by its ID."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute("SELECT * FROM periods WHERE id=?;", (period_id,))
-        return c.fetchone()
-
-def get_metrics(pharmacy_id: int, period_id: int) -> Optional[sqlite3.Row]:
-    """Get the metrics row for a given pharmacy and period using cash basis."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            """\n        SELECT * FROM period_metrics\n        WHERE pharmacy_id=? AND period_id=? AND basis='cash';\n        """,
-            (pharmacy_id, period_id),
-        )
-        return c.fetchone()
-
-def set_period_status(period_id: int, status: str) -> None:
-    """Update a period's status and lock metrics if closed."""
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute("UPDATE periods SET status=? WHERE id=?;", (status, period_id))
-        if status == "closed":
-            c.execute(
-                """\n            UPDATE period_metrics\n            SET locked_at = datetime('now')\n            WHERE period_id = ? AND basis = 'cash';\n            """,
-                (period_id,),
-            )
-
-def main_menu_kb():
-    """Keyboard with a single option to add a pharmacy."""
-    return InlineKeyboardMarkup([[InlineKeyboardButton("➕ افزودن داروخانه", callback_data=make_cb(TAG_PHARM_NEW))]])
-
-def make_cb(tag: str, *parts: object) -> str:
-    return f"{tag}:" + ":".join(str(p) for p in parts) if parts else tag
-
-def pharm_list_kb():
-    """Keyboard listing existing pharmacies with an option to add a new one."""
-    rows = []
-    for p in list_pharmacies():
-        rows.append([
-            InlineKeyboardButton(
-                f"🏥 {p['title']} (#{p['id']})",
-                callback_data=make_cb(TAG_PHARM_SELECT, p['id']),
-            )
-        ])
-    rows.append([InlineKeyboardButton("➕ افزودن داروخانه", callback_data=make_cb(TAG_PHARM_NEW))])
-    return InlineKeyboardMarkup(rows)
-
-def period_list_kb(pharmacy_id: int):
-    """Keyboard listing periods for a pharmacy with controls to add or return."""
-    rows = []
-    for pr in list_periods(pharmacy_id):
-        badge = (
-            "?? ???"
-            if pr["status"] == "open"
-            else ("?? ?? ?????? ?????" if pr["status"] == "pending_approval" else "?? ????")
-        )
-        rows.append([
-            InlineKeyboardButton(
-                f"{badge} {pr['title']} ({pr['start_date']} - {pr['end_date']})",
-                callback_data=make_cb(TAG_PERIOD_SELECT, pharmacy_id, pr['id']),
-            )
-        ])
-    rows.append([InlineKeyboardButton("?? ????? ????", callback_data=make_cb(TAG_PERIOD_NEW, pharmacy_id))])
-    rows.append([InlineKeyboardButton("?? ??????", callback_data="fin.home")])
-    return InlineKeyboardMarkup(rows)
-
-def month_actions_kb(pharmacy_id: int, jy: int, jm: int, period_id: int | None = None, status: str | None = None) -> tuple[InlineKeyboardMarkup, int, str, str]:
-    """Create the period actions keyboard and ensure the backing period exists."""
-    if period_id is None or status is None:
-        period_id, status, _, _, _ = get_or_create_month_period(pharmacy_id, jy, jm)
-    month_name = JALALI_MONTH_NAMES[jm - 1] if 1 <= jm <= 12 else str(jm)
-    if status == "closed":
-        rows = [
-            [InlineKeyboardButton("?? ????? ???", callback_data=f"fin.report.view:{pharmacy_id}:{period_id}")],
-            [InlineKeyboardButton("?? PDF ????", callback_data=make_cb(TAG_PDF_SIMPLE, pharmacy_id, period_id))],
-            [InlineKeyboardButton("?? ????? ?????", callback_data=make_cb(TAG_WEEKLY_REPORT, pharmacy_id, period_id))],
-            [InlineKeyboardButton("?? ?????? ?? ??? ???", callback_data=make_cb(TAG_COMPARE_PREV, pharmacy_id, jy, jm))],
-            [InlineKeyboardButton("?? ?????? ?? ??? ????", callback_data=make_cb(TAG_COMPARE_MONTHS, pharmacy_id, jy, jm))],
-        ]
-        rows.append([InlineKeyboardButton("💳 ثبت چک", callback_data=make_cb(TAG_CHECK_START, pharmacy_id))])
-        rows.append([InlineKeyboardButton("📊 خلاصه ماه", callback_data=make_cb(TAG_SUMMARY_START, pharmacy_id))])
-    else:
-        rows = [
-            [
-                InlineKeyboardButton("?? ???/?????? ?????", callback_data=f"fin.entry.menu:{pharmacy_id}:{period_id}"),
-                InlineKeyboardButton("📥 ثبت اطلاعات مالی", callback_data=make_cb(TAG_DAILY_START, pharmacy_id)),
-            ],
-            [
-                InlineKeyboardButton("?? ?????? ??????", callback_data=f"fin.entry.recompute:{pharmacy_id}:{period_id}"),
-                InlineKeyboardButton("?? ????? ???", callback_data=f"fin.report.view:{pharmacy_id}:{period_id}"),
-            ],
-            [
-                InlineKeyboardButton("?? ????? ?????", callback_data=make_cb(TAG_WEEKLY_REPORT, pharmacy_id, period_id)),
-                InlineKeyboardButton("?? ?????? ?? ??? ???", callback_data=make_cb(TAG_COMPARE_PREV, pharmacy_id, jy, jm)),
-            ],
-            [
-                InlineKeyboardButton("?? ?????? ?? ??? ????", callback_data=make_cb(TAG_COMPARE_MONTHS, pharmacy_id, jy, jm)),
-                InlineKeyboardButton("?? PDF ????", callback_data=make_cb(TAG_PDF_SIMPLE, pharmacy_id, period_id)),
-            ],
-            [InlineKeyboardButton("?? ??????? ????", callback_data=make_cb(TAG_SIM_MENU, pharmacy_id, period_id))],
-        ]
-        rows.append([InlineKeyboardButton("💳 ثبت چک", callback_data=make_cb(TAG_CHECK_START, pharmacy_id))])
-        rows.append([InlineKeyboardButton("📊 خلاصه ماه", callback_data=make_cb(TAG_SUMMARY_START, pharmacy_id))])
-    rows.append([InlineKeyboardButton("?? ??????", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))])
-    return InlineKeyboardMarkup(rows), period_id, status, month_name
-
-def period_actions_kb(pharmacy_id: int, period_id: int, status: str) -> InlineKeyboardMarkup:
-    period_row = get_period(period_id)
-    if not period_row:
-        return InlineKeyboardMarkup([[InlineKeyboardButton("?? ??????", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))]])
-    period = dict(period_row)
-    start_iso = period.get("start_date") or date.today().isoformat()
-    jy, jm, _ = gregorian_to_jalali(date.fromisoformat(start_iso))
-    keyboard, _, _, _ = month_actions_kb(pharmacy_id, jy, jm, period_id=period_id, status=status)
-    return keyboard
-
-def entry_menu_kb(pharmacy_id: int, period_id: int):
-    """Keyboard for entering or editing numeric values for a period."""
-    return InlineKeyboardMarkup(
-        [
-            [
-                InlineKeyboardButton(
-                    "💵 فروش نقدی",
-                    callback_data=f"fin.entry.set:sales_cash:{pharmacy_id}:{period_id}",
-                ),
-                InlineKeyboardButton(
-                    "🏦 واریزی بیمه",
-                    callback_data=f"fin.entry.set:sales_ins:{pharmacy_id}:{period_id}",
-                ),
-            ],
-            [
-                InlineKeyboardButton(
-                    "🧪 خرید (متغیر)",
-                    callback_data=f"fin.entry.set:var_total:{pharmacy_id}:{period_id}",
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "🏠 اجاره", callback_data=f"fin.entry.set:fixed_rent:{pharmacy_id}:{period_id}"
-                ),
-                InlineKeyboardButton(
-                    "👥 حقوق پرسنل", callback_data=f"fin.entry.set:fixed_staff:{pharmacy_id}:{period_id}"
-                ),
-            ],
-            [
-                InlineKeyboardButton(
-                    "🧾 سایر هزینه‌ها", callback_data=f"fin.entry.set:opex_other_total:{pharmacy_id}:{period_id}"
-                )
-            ],
-            [
-                InlineKeyboardButton(
-                    "👣 تعداد مراجعه", callback_data=f"fin.entry.set:visits_total:{pharmacy_id}:{period_id}"
-                ),
-                InlineKeyboardButton(
-                    "📅 روزهای دوره", callback_data=f"fin.entry.set:days_count:{pharmacy_id}:{period_id}"
-                ),
-            ],
-            [InlineKeyboardButton("🔄 محاسبهٔ دوباره", callback_data=f"fin.entry.recompute:{pharmacy_id}:{period_id}")],
-            [InlineKeyboardButton("◀️ بازگشت", callback_data=make_cb(TAG_PERIOD_SELECT, pharmacy_id, period_id))],
-        ]
-    )
-
-@owner_only_access
-async def cb_daily_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Start the simplified daily data entry flow by asking for the date."""
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(rf"^{TAG_DAILY_START}:(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    state = {
-        "pharmacy_id": pharmacy_id,
-        "step": 0,
-        "date": None,
-        "data": {},
-    }
-    if context.user_data is not None:
-        context.user_data["daily"] = state
-    jy, jm, _ = gregorian_to_jalali(date.today())
-    keyboard = daily_day_picker_kb(jy, jm, tag=TAG_DAILY_FLOW_PICK_DAY, extra=str(pharmacy_id))
-    await safe_edit(
-        message,
-        "روز مورد نظر را انتخاب کن:",
-        reply_markup=keyboard,
-        context=context,
-        log_context="cb_daily_start",
-    )
-
-@owner_only_access
-async def cb_daily_pick_day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle day selection for the simplified daily flow."""
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(rf"^{TAG_DAILY_FLOW_PICK_DAY}:(\d{{4}}-\d{{2}}-\d{{2}}):(\d+)$", data)
-    if not match:
-        return
-    date_str = match.group(1)
-    pharmacy_id = int(match.group(2))
-    daily_state = context.user_data.get("daily") if context.user_data is not None else None
-    if not daily_state or daily_state.get("pharmacy_id") != pharmacy_id:
-        return
-    daily_state["date"] = date_str
-    daily_state["step"] = 1
-    await safe_edit(
-        message,
-        f"📆 تاریخ انتخاب شد: {to_persian_digits(date_str)}",
-        reply_markup=None,
-        context=context,
-        log_context="cb_daily_flow_pick_day_edit",
-    )
-    await safe_reply(
-        message,
-        "مقدار فروش نقدی (تومان) را وارد کن:",
-        reply_markup=ForceReply(selective=True),
-        context=context,
-        log_context="cb_daily_flow_pick_day_prompt",
-    )
-
-@owner_only_access
-async def msg_daily_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle replies for the simplified daily data entry flow."""
-    message = update.effective_message
-    if not message:
-        return
-    daily_state = context.user_data.get("daily") if context.user_data is not None else None
-    if not daily_state or "step" not in daily_state or "data" not in daily_state:
-        return
-    if not message.text:
-        return
-    text = message.text.strip()
-    try:
-        value, err = parse_smart_number(text, as_int=True)
-    except Exception:
-        value, err = None, "مقدار نامعتبر است."
-    if err:
-        await safe_reply(
-            message,
-            "❗ مقدار نامعتبر است. دوباره تلاش کن:",
-            reply_markup=ForceReply(selective=True),
-            context=context,
-            log_context="msg_daily_flow_invalid",
-        )
-        return
-    step = daily_state.get("step", 0)
-    fields_sequence: list[tuple[str, str]] = [
-        ("sales_cash", "مقدار فروش بیمه‌ای (تومان) را وارد کن:"),
-        ("sales_ins", "تعداد ویزیت را وارد کن:"),
-        ("visits", "مقدار هزینه ثابت را وارد کن:"),
-        ("fixed_cost", "✅ ثبت شد. اطلاعات ذخیره شد."),
-    ]
-    if step < 1 or step > len(fields_sequence):
-        await safe_reply(
-            message,
-            "این مرحله ناشناخته است.",
-            context=context,
-            log_context="msg_daily_flow_unknown_step",
-        )
-        if context.user_data is not None:
-            context.user_data.pop("daily", None)
-        return
-    key, next_prompt = fields_sequence[step - 1]
-    if value is not None:
-        daily_state["data"][key] = int(value)
-    daily_state["step"] += 1
-    if daily_state["step"] <= len(fields_sequence):
-        await safe_reply(
-            message,
-            next_prompt,
-            reply_markup=ForceReply(selective=True),
-            context=context,
-            log_context="msg_daily_flow_next_prompt",
-        )
-        return
-    payload = daily_state["data"]
-    pharmacy_id = daily_state["pharmacy_id"]
-    log_date = daily_state.get("date") or date.today().isoformat()
-    sales_cash = float(payload.get("sales_cash", 0))
-    sales_ins = float(payload.get("sales_ins", 0))
-    visits = int(payload.get("visits", 0))
-    fixed_cost = float(payload.get("fixed_cost", 0))
-    upsert_daily_log(
-        pharmacy_id,
-        log_date,
-        sales_cash,
-        sales_ins,
-        0.0,
-        fixed_cost,
-        visits,
-        None,
-    )
-    summary = "\n".join(
-        [
-            "✅ ثبت روزانه انجام شد.",
-            f"📆 تاریخ: {to_persian_digits(log_date)}",
-            f"💵 فروش نقدی: {fmt_money(sales_cash)} تومان",
-            f"💳 فروش بیمه‌ای: {fmt_money(sales_ins)} تومان",
-            f"👥 تعداد ویزیت: {visits}",
-            f"🏦 هزینه ثابت: {fmt_money(fixed_cost)} تومان",
-        ]
-    )
-    await safe_reply(
-        message,
-        summary,
-        context=context,
-        log_context="msg_daily_flow_complete",
-    )
-    if context.user_data is not None:
-        context.user_data.pop("daily", None)
-
-@owner_only_access
-async def cb_summary_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Prompt the user to pick a month for the monthly summary."""
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(rf"^{TAG_SUMMARY_START}:(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    jy, _, _ = gregorian_to_jalali(date.today())
-    keyboard = month_picker_kb(jy, tag=TAG_SUMMARY_PICK_MONTH, extra=str(pharmacy_id))
-    rows = list(keyboard.inline_keyboard) if keyboard.inline_keyboard else []
-    rows.append((InlineKeyboardButton("بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id)),))
-    keyboard = InlineKeyboardMarkup(rows)
-    await safe_edit(
-        message,
-        "ماه مورد نظر برای خلاصه را انتخاب کن:",
-        reply_markup=keyboard,
-        context=context,
-        log_context="cb_summary_start",
-    )
-
-@owner_only_access
-async def cb_summary_pick_month(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Render the monthly summary for the chosen Jalali month."""
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(rf"^{TAG_SUMMARY_PICK_MONTH}:(\d{{4}})-(\d{{2}}):(\d+)$", data)
-    if not match:
-        return
-    jy = int(match.group(1))
-    jm = int(match.group(2))
-    pharmacy_id = int(match.group(3))
-    period = get_period_by_jalali(pharmacy_id, jy, jm)
-    if not period:
-        keyboard = InlineKeyboardMarkup(
-            [
-                [
-                    InlineKeyboardButton(
-                        "🔁 انتخاب ماه دیگر", callback_data=make_cb(TAG_SUMMARY_START, pharmacy_id)
-                    )
-                ],
-                [InlineKeyboardButton("بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))],
-            ]
-        )
-        await safe_edit(
-            message,
-            "❗ برای این ماه هنوز دوره‌ای ثبت نشده است.",
-            reply_markup=keyboard,
-            context=context,
-            log_context="cb_summary_pick_month_missing_period",
-        )
-        return
-    metrics_row = get_metrics(pharmacy_id, period["id"])
-    if not metrics_row:
-        keyboard = InlineKeyboardMarkup(
-            [
-                [
-                    InlineKeyboardButton(
-                        "🔁 انتخاب ماه دیگر", callback_data=make_cb(TAG_SUMMARY_START, pharmacy_id)
-                    )
-                ],
-                [InlineKeyboardButton("بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))],
-            ]
-        )
-        await safe_edit(
-            message,
-            "❗ برای این ماه هنوز متریک‌ها محاسبه نشده‌اند.",
-            reply_markup=keyboard,
-            context=context,
-            log_context="cb_summary_pick_month_missing_metrics",
-        )
-        return
-    metrics = dict(metrics_row)
-    sales_cash = float(metrics.get("sales_cash", 0))
-    sales_ins = float(metrics.get("sales_ins", 0))
-    sales_total = float(metrics.get("sales_total", 0))
-    visits_total = int(metrics.get("visits_total", 0))
-    fixed_total = float(metrics.get("fixed_total", 0))
-    gross_profit = float(metrics.get("gross_profit", 0))
-    checks_total: float | None = None  # Placeholder until check storage is implemented.
-    prev_jy, prev_jm = (jy - 1, 12) if jm == 1 else (jy, jm - 1)
-    prev_period = get_period_by_jalali(pharmacy_id, prev_jy, prev_jm)
-    change_text = ""
-    if prev_period:
-        prev_metrics_row = get_metrics(pharmacy_id, prev_period["id"])
-        if prev_metrics_row:
-            prev_metrics_dict = dict(prev_metrics_row)
-            prev_gross = float(prev_metrics_dict.get("gross_profit", 0))
-            if prev_gross:
-                delta = (gross_profit - prev_gross) / prev_gross
-                change_text = f"📈 تغییر سود ناخالص نسبت به ماه قبل: {fmt_percent(delta)}"
-    month_name = JALALI_MONTH_NAMES[jm - 1] if 1 <= jm <= 12 else f"{jm}"
-    summary_lines = [
-        f"📊 خلاصه {month_name} {jy} برای داروخانه #{pharmacy_id}",
-        "",
-        f"💵 فروش نقدی: {fmt_money(sales_cash)} تومان",
-        f"🏥 فروش بیمه‌ای: {fmt_money(sales_ins)} تومان",
-        f"💰 جمع فروش: {fmt_money(sales_total)} تومان",
-        f"👥 تعداد ویزیت‌ها: {visits_total}",
-        f"🏦 هزینه ثابت: {fmt_money(fixed_total)} تومان",
-        f"💳 جمع چک‌ها: {fmt_money(checks_total) + ' تومان' if checks_total is not None else '—'}",
-        f"💹 سود ناخالص: {fmt_money(gross_profit)} تومان",
-    ]
-    if change_text:
-        summary_lines.append("")
-        summary_lines.append(change_text)
-    summary_text = "\n".join(summary_lines)
-    keyboard = InlineKeyboardMarkup(
-        [
-            [InlineKeyboardButton("🔁 انتخاب ماه دیگر", callback_data=make_cb(TAG_SUMMARY_START, pharmacy_id))],
-            [InlineKeyboardButton("بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))],
-        ]
-    )
-    await safe_edit(
-        message,
-        summary_text,
-        reply_markup=keyboard,
-        context=context,
-        log_context="cb_summary_pick_month",
-    )
-
-@owner_only_access
-async def cb_check_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Start the check registration flow by asking for the due date."""
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(rf"^{TAG_CHECK_START}:(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    state = {
-        "step": 0,
-        "data": {
-            "pharmacy_id": pharmacy_id,
-            "date_due": None,
-            "amount": None,
-            "recipient": None,
-        },
-    }
-    if context.user_data is not None:
-        context.user_data["check"] = state
-    jy, jm, _ = gregorian_to_jalali(date.today())
-    keyboard = daily_day_picker_kb(jy, jm, tag=TAG_CHECK_PICK_DAY, extra=str(pharmacy_id))
-    await safe_edit(
-        message,
-        "تاریخ سررسید چک را انتخاب کن:",
-        reply_markup=keyboard,
-        context=context,
-        log_context="cb_check_start",
-    )
-
-@owner_only_access
-async def cb_check_pick_day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle day selection for the check registration flow."""
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(rf"^{TAG_CHECK_PICK_DAY}:(\d{{4}}-\d{{2}}-\d{{2}}):(\d+)$", data)
-    if not match:
-        return
-    date_str = match.group(1)
-    pharmacy_id = int(match.group(2))
-    check_state = context.user_data.get("check") if context.user_data is not None else None
-    if not check_state or check_state.get("data", {}).get("pharmacy_id") != pharmacy_id:
-        return
-    check_state["data"]["date_due"] = date_str
-    check_state["step"] = 1
-    await safe_edit(
-        message,
-        f"📆 تاریخ سررسید: {to_persian_digits(date_str)}",
-        reply_markup=None,
-        context=context,
-        log_context="cb_check_pick_day_edit",
-    )
-    await safe_reply(
-        message,
-        "مبلغ چک را وارد کن (به تومان):",
-        reply_markup=ForceReply(selective=True),
-        context=context,
-        log_context="cb_check_pick_day_prompt",
-    )
-
-@owner_only_access
-async def msg_check_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle textual replies for the check registration flow."""
-    message = update.effective_message
-    if not message:
-        return
-    text = (message.text or "").strip()
-    check_state = context.user_data.get("check") if context.user_data is not None else None
-    if not check_state:
-        return
-    step = check_state.get("step", 0)
-    data = check_state.get("data", {})
-    if step == 1:
-        value, err = parse_smart_number(text, as_int=True)
-        if err:
-            await safe_reply(
-                message,
-                "❗ مبلغ نامعتبر است. دوباره تلاش کن:",
-                reply_markup=ForceReply(selective=True),
-                context=context,
-                log_context="msg_check_flow_amount_error",
-            )
-            return
-        if value is None or value <= 0:
-            await safe_reply(
-                message,
-                "❗ مبلغ باید بیشتر از صفر باشد.",
-                reply_markup=ForceReply(selective=True),
-                context=context,
-                log_context="msg_check_flow_amount_nonpositive",
-            )
-            return
-        check_state["data"]["amount"] = int(value)
-        check_state["step"] = 2
-        await safe_reply(
-            message,
-            "نام شرکت پخش یا گیرنده چک را وارد کن:",
-            reply_markup=ForceReply(selective=True),
-            context=context,
-            log_context="msg_check_flow_recipient_prompt",
-        )
-        return
-    if step == 2:
-        check_state["data"]["recipient"] = text
-        check_state["step"] = 3
-        payload = check_state["data"]
-        logger.info("Check saved: %s", payload)
-        summary_lines = [
-            "✅ چک با موفقیت ثبت شد.",
-            f"📆 تاریخ سررسید: {to_persian_digits(payload['date_due'])}",
-            f"💰 مبلغ: {fmt_money(payload['amount'])} تومان",
-            f"🏢 گیرنده: {h(payload['recipient'])}",
-        ]
-        await safe_reply(
-            message,
-            "\n".join(summary_lines),
-            context=context,
-            log_context="msg_check_flow_complete",
-        )
-        if context.user_data is not None:
-            context.user_data.pop("check", None)
-        return
-
-def fmt_money(x) -> str:
-    """Format a number with thousands separators; fallback to string representation."""
-    try:
-        return f"{float(x):,.0f}"
-    except Exception:
-        return str(x)
-
-def fmt_percent(x, *, digits: int = 1) -> str:
-    """\n    Format a ratio (0.12 -> '12.0٪') with a configurable number of decimal places.\n\n    If conversion fails, returns a dash to indicate missing value.\n    """
-    try:
-        return f"{(float(x) * 100):.{digits}f}٪"
-    except Exception:
-        return "-"
-
-def render_report(metrics_row, period_row) -> str:
-    """Create an HTML report for a period's metrics."""
-    metrics = dict(metrics_row) if not isinstance(metrics_row, dict) else metrics_row
-    period = dict(period_row) if not isinstance(period_row, dict) else period_row
-    locked_badge = "🔒 نهایی (قفل‌شده)" if metrics.get("locked_at") else "🟢 زنده"
-    lines = [
-        f"<b>{h(str(period.get('title', '')))}</b>  {locked_badge}",
-        f"{h(period.get('start_date', '-'))} → {h(period.get('end_date', '-'))}  ·  Status: <b>{h(period.get('status', 'open'))}</b>",
-        "",
-        "<b>ورودی‌ها</b>",
-        f"فروش نقدی: {fmt_money(metrics.get('sales_cash', 0))} تومان",
-        f"واریزی بیمه: {fmt_money(metrics.get('sales_ins', 0))} تومان",
-        f"فروش کل: {fmt_money(metrics.get('sales_total', 0))} تومان",
-        f"خرید (متغیر): {fmt_money(metrics.get('var_total', 0))} تومان",
-        f"هزینهٔ ثابت (اجاره+حقوق): {fmt_money(metrics.get('fixed_total', 0))} تومان  ·  سایر: {fmt_money(metrics.get('opex_other_total', 0))} تومان",
-        f"تعداد مراجعه: {metrics.get('visits_total', 0)} نفر  ·  روزهای Period: {metrics.get('days_count', 0)} روز",
-        "",
-        "<b>شاخص‌ها</b>",
-        f"سود ناخالص: {fmt_money(metrics.get('gross_profit', 0))} تومان",
-        f"سود عملیاتی (خالص): {fmt_money(metrics.get('net_profit_operational', 0))} تومان",
-        f"حاشیه سود ناخالص: {fmt_percent(metrics.get('cm_ratio', 0))}",
-        f"حاشیه سود خالص عملیاتی: {fmt_percent(metrics.get('np_ratio', 0))}",
-        f"نقطهٔ سربه‌سر فروش: {fmt_money(metrics.get('breakeven_sales', 0))} تومان",
-        f"میانگین فروش روزانه: {fmt_money(metrics.get('avg_daily_sales', 0))} تومان/روز",
-        f"میانگین فروش/مراجعه: {fmt_money(metrics.get('avg_sale_per_visit', 0))} تومان/نفر",
-        "",
-        f"<i>آخرین محاسبه: {h(str(metrics.get('computed_at') or '-'))}</i>",
-    ]
-    return "\n".join(lines)
-
-def render_compare_table(pharmacy_id: int, period_a_id: int, period_b_id: int) -> str:
-    """Render an HTML table comparing key metrics between two periods."""
-    a_metrics_row = get_metrics(pharmacy_id, period_a_id) or {}
-    b_metrics_row = get_metrics(pharmacy_id, period_b_id) or {}
-    a = dict(a_metrics_row) if not isinstance(a_metrics_row, dict) else a_metrics_row
-    b = dict(b_metrics_row) if not isinstance(b_metrics_row, dict) else b_metrics_row
-
-    def safe_num(m, k):
-        try:
-            v = m.get(k)
-            if v is None:
-                return None
-            return float(v)
-        except Exception:
-            return None
-
-    def display_num(m, k):
-        v = m.get(k)
-        return fmt_money(v) if (isinstance(v, (int, float)) or (isinstance(v, str) and v.replace('.', '', 1).isdigit())) else ("-" if v is None else str(v))
-
-    rows = []
-    # Simple HTML table with headers: Metric | Period A | Period B | Δ%
-    rows.append("<table>")
-    rows.append("<tr><th>شاخص</th><th>ماه قبل</th><th>ماه جاری</th><th>Δ%</th></tr>")
-
-    def add_row(label: str, key: str, is_percent: bool = False):
-        left = display_num(a, key) if not is_percent else (fmt_percent(a.get(key)) if a.get(key) is not None else "-")
-        right = display_num(b, key) if not is_percent else (fmt_percent(b.get(key)) if b.get(key) is not None else "-")
-        # compute delta percent where sensible
-        delta = "-"
-        av = safe_num(a, key)
-        bv = safe_num(b, key)
-        try:
-            if av is not None and av != 0:
-                delta = fmt_percent((bv or 0 - av) / abs(av))
-            elif av == 0 and (bv is not None and bv != 0):
-                delta = "—"
-            else:
-                delta = "-"
-        except Exception:
-            delta = "-"
-        rows.append(f"<tr><td>{h(label)}</td><td>{h(str(left))}</td><td>{h(str(right))}</td><td>{h(str(delta))}</td></tr>")
-
-    add_row("فروش نقدی", "sales_cash")
-    add_row("فروش بیمه", "sales_ins")
-    add_row("جمع فروش", "sales_total")
-    add_row("خرید (متغیر)", "var_total")
-    add_row("هزینه ثابت", "fixed_total")
-    add_row("سایر هزینه‌ها", "opex_other_total")
-    add_row("سود ناخالص", "gross_profit")
-    add_row("سود عملیاتی", "net_profit_operational")
-    add_row("حاشیه ناخالص", "cm_ratio", is_percent=True)
-    add_row("حاشیه خالص", "np_ratio", is_percent=True)
-    add_row("نقطه سربه‌سر", "breakeven_sales")
-    add_row("میانگین فروش روزانه", "avg_daily_sales")
-    add_row("میانگین فروش/ویزیت", "avg_sale_per_visit")
-
-    rows.append("</table>")
-    return "\n".join(rows)
-
-PERSIAN_DIGITS = str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩", "01234567890123456789")
-ASCII_TO_PERSIAN_DIGITS = str.maketrans("0123456789", "۰۱۲۳۴۵۶۷۸۹")
-
-def to_persian_digits(value: int | str) -> str:
-    """Convert ASCII digits in ``value`` to Persian numerals."""
-    return str(value).translate(ASCII_TO_PERSIAN_DIGITS)
-
-def daily_day_picker_kb(
-    jy: int,
-    jm: int,
-    *,
-    tag: str | None = None,
-    extra: str | None = None,
-) -> InlineKeyboardMarkup:
-    """Return a day-selection keyboard for the given Jalali month.
-
-    When ``tag`` is provided, the callback data will use that tag instead of the
-    default ``TAG_DAILY_PICK_DAY``. If ``extra`` is provided, it is appended as
-    an additional colon-separated part after the ISO date.
-    """
-    _, _, days_in_month = jalali_month_bounds(jy, jm)
-    callback_tag = tag or TAG_DAILY_PICK_DAY
-    rows: list[list[InlineKeyboardButton]] = []
-    current_row: list[InlineKeyboardButton] = []
-    for day in range(1, days_in_month + 1):
-        iso_date = f"{jy:04d}-{jm:02d}-{day:02d}"
-        label = to_persian_digits(day)
-        callback_data = f"{callback_tag}:{iso_date}"
-        if extra is not None:
-            callback_data = f"{callback_data}:{extra}"
-        current_row.append(InlineKeyboardButton(label, callback_data=callback_data))
-        if len(current_row) == 7:
-            rows.append(current_row)
-            current_row = []
-    if current_row:
-        rows.append(current_row)
-    return InlineKeyboardMarkup(rows)
-
-def month_picker_kb(
-    jy: int,
-    *,
-    tag: str,
-    extra: str | None = None,
-) -> InlineKeyboardMarkup:
-    """Render a 3x4 grid of Jalali months with optional extra data in callback."""
-    buttons: list[list[InlineKeyboardButton]] = []
-    row: list[InlineKeyboardButton] = []
-    for index, title in enumerate(JALALI_MONTH_NAMES, start=1):
-        callback = f"{tag}:{jy:04d}-{index:02d}"
-        if extra is not None:
-            callback = f"{callback}:{extra}"
-        row.append(InlineKeyboardButton(title, callback_data=callback))
-        if len(row) == 3:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-    return InlineKeyboardMarkup(buttons)
-
-JALALI_MONTH_NAMES = [
-    "فروردین",
-    "اردیبهشت",
-    "خرداد",
-    "تیر",
-    "مرداد",
-    "شهریور",
-    "مهر",
-    "آبان",
-    "آذر",
-    "دی",
-    "بهمن",
-    "اسفند",
-]
-
-_GREGORIAN_MONTH_DAYS = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-_JALALI_MONTH_DAYS = [31, 31, 31, 31, 31, 31, 30, 30, 30, 30, 30, 29]
-
-def gregorian_to_jalali(d: date) -> tuple[int, int, int]:
-    if jdatetime:
-        j = jdatetime.date.fromgregorian(date=d)
-        return j.year, j.month, j.day
-    gy = d.year - 1600
-    gm = d.month - 1
-    gd = d.day - 1
-    g_day_no = 365 * gy + (gy + 3) // 4 - (gy + 99) // 100 + (gy + 399) // 400
-    for i in range(gm):
-        g_day_no += _GREGORIAN_MONTH_DAYS[i]
-    if gm > 1 and ((d.year % 4 == 0 and d.year % 100 != 0) or (d.year % 400 == 0)):
-        g_day_no += 1
-    g_day_no += gd
-    j_day_no = g_day_no - 79
-    j_np = j_day_no // 12053
-    j_day_no %= 12053
-    jy = 979 + 33 * j_np + 4 * (j_day_no // 1461)
-    j_day_no %= 1461
-    if j_day_no >= 366:
-        jy += (j_day_no - 1) // 365
-        j_day_no = (j_day_no - 1) % 365
-    for i, md in enumerate(_JALALI_MONTH_DAYS):
-        if j_day_no < md:
-            jm = i + 1
-            jd = j_day_no + 1
-            break
-        j_day_no -= md
-    else:
-        jm = 12
-        jd = j_day_no + 1
-    return jy, jm, jd
-
-def jalali_to_gregorian(jy: int, jm: int, jd: int) -> date:
-    if jdatetime:
-        return jdatetime.date(jy, jm, jd).togregorian()
-    jy -= 979
-    jm -= 1
-    jd -= 1
-    j_day_no = 365 * jy + (jy // 33) * 8 + ((jy % 33) + 3) // 4
-    for i in range(jm):
-        j_day_no += _JALALI_MONTH_DAYS[i]
-    j_day_no += jd
-    g_day_no = j_day_no + 79
-    gy = 1600 + 400 * (g_day_no // 146097)
-    g_day_no %= 146097
-    leap = True
-    if g_day_no >= 36525:
-        g_day_no -= 1
-        gy += 100 * (g_day_no // 36524)
-        g_day_no %= 36524
-        if g_day_no >= 365:
-            g_day_no += 1
-        else:
-            leap = False
-    gy += 4 * (g_day_no // 1461)
-    g_day_no %= 1461
-    if g_day_no >= 366:
-        leap = False
-        g_day_no -= 1
-        gy += g_day_no // 365
-        g_day_no %= 365
-    for i, md in enumerate(_GREGORIAN_MONTH_DAYS):
-        dim = md + (1 if i == 1 and ((gy % 4 == 0 and gy % 100 != 0) or (gy % 400 == 0)) else 0)
-        if g_day_no < dim:
-            gm = i + 1
-            gd = g_day_no + 1
-            break
-        g_day_no -= dim
-    else:
-        gm = 12
-        gd = g_day_no + 1
-    return date(gy, gm, gd)
-
-def jalali_month_bounds(jy: int, jm: int) -> tuple[date, date, int]:
-    start = jalali_to_gregorian(jy, jm, 1)
-    if jm == 12:
-        next_start = jalali_to_gregorian(jy + 1, 1, 1)
-    else:
-        next_start = jalali_to_gregorian(jy, jm + 1, 1)
-    end = next_start - timedelta(days=1)
-    days = (end - start).days + 1
-    return start, end, days
-
-def get_or_create_month_period(pharmacy_id: int, jy: int, jm: int) -> tuple[int, str, date, date, int]:
-    """Return period_id/status for the given Jalali month, creating it if needed."""
-    start, end, days = jalali_month_bounds(jy, jm)
-    start_iso = start.isoformat()
-    end_iso = end.isoformat()
-    with db_conn() as conn:
-        c = conn.cursor()
-        c.execute(
-            "SELECT id, status FROM periods WHERE pharmacy_id=? AND start_date=? AND end_date=?",
-            (pharmacy_id, start_iso, end_iso),
-        )
-        row = c.fetchone()
-        if row:
-            row = dict(row)
-            return row["id"], row.get("status", "open"), start, end, days
-    title = f"{jy}-{jm:02d} (شمسی)"
-    period_id = new_period(pharmacy_id, title, start_iso, end_iso)
-    upsert_metrics_cash(
-        pharmacy_id,
-        period_id,
-        0,
-        0,
-        0,
-        0,
-        0,
-        0,
-        0,
-        days,
-    )
-    return period_id, "open", start, end, days
-
-# --- Smart numeric parsing (k/m/b), Persian-friendly ---
-# ``parse_smart_number`` converts shorthand numeric strings such as ``850k`` or
-# ``1.2m`` into their numeric equivalents.  It relies on the global
-# ``PERSIAN_DIGITS`` mapping defined above to normalise Persian and Arabic
-# numerals.  The ``typing.Tuple`` import and fall‑back definition for
-# ``PERSIAN_DIGITS`` were removed to avoid duplicate definitions.  ``Tuple``
-# is already imported near the top of this module and ``PERSIAN_DIGITS`` is
-# defined once globally.
-
-def parse_smart_number(raw: str, *, as_int: bool = False) -> Tuple[float | int | None, str | None]:
-    """\n    Accepts:\n      '1.2', '2500000',\n      '850k', '3.5k',\n      '750m', '1.2m',\n      '1b', '1.2b'\n    Rejects:\n      '1.2 m' (space before suffix), letters beyond k/m/b, multiple dots, empty.\n    Returns: (value, None) or (None, error_message_fa)\n    """
-    if raw is None:
-        return None, "❗ مقدار نامعتبر بود. مثلاً: 1.2b ، 750m ، 850k"
-
-    s = raw.strip()
-    if not s:
-        return None, "❗ مقدار نامعتبر بود. مثلاً: 1.2b ، 750m ، 850k"
-
-    # Normalize Persian digits & separators, case-insensitive
-    s = s.translate(PERSIAN_DIGITS)
-    s = s.replace(",", "").replace("٬", "").lower()
-
-    # Detect suffix (no space allowed)
-    factor = 1.0
-    if s.endswith("b"):
-        factor = 1_000_000_000.0
-        core = s[:-1]
-    elif s.endswith("m"):
-        factor = 1_000_000.0
-        core = s[:-1]
-    elif s.endswith("k"):
-        factor = 1_000.0
-        core = s[:-1]
-    else:
-        core = s
-
-    # quick structural validation
-    if " " in core or not core:
-        return None, "❗ مقدار نامعتبر بود. مثلاً: 1.2b ، 750m ، 850k"
-
-    # allow an optional leading '+' or '-' and at most one dot
-    core_check = core.lstrip("+-")
-    if core_check.count(".") > 1 or not core_check or any(c for c in core_check if (not c.isdigit() and c != ".")):
-        return None, "❗ مقدار نامعتبر بود. مثلاً: 1.2b ، 750m ، 850k"
-
-    try:
-        num = float(core)
-    except Exception:
-        return None, "❗ مقدار نامعتبر بود. مثلاً: 1.2b ، 750m ، 850k"
-
-    val = num * factor
-    if as_int:
-        return int(round(val)), None
-    return val, None
-
-def compare_months_kb(pharmacy_id: int, base_jy: int, base_jm: int, jy: int) -> InlineKeyboardMarkup:
-    buttons: list[list[InlineKeyboardButton]] = []
-    row: list[InlineKeyboardButton] = []
-    for index, title in enumerate(JALALI_MONTH_NAMES, start=1):
-        row.append(InlineKeyboardButton(title, callback_data=make_cb(TAG_COMPARE_PICK, pharmacy_id, base_jy, base_jm, jy, index)))
-        if len(row) == 3:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton("◀️ بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))])
-    return InlineKeyboardMarkup(buttons)
-
-@owner_only_access
-async def cb_compare_prev(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(r"^fin\.compare\.prev:(\d+):(\d+):(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    jy = int(match.group(2))
-    jm = int(match.group(3))
-    prev_jy, prev_jm = (jy - 1, 12) if jm == 1 else (jy, jm - 1)
-    prev_start, prev_end, _ = jalali_month_bounds(prev_jy, prev_jm)
-    curr_start, curr_end, _ = jalali_month_bounds(jy, jm)
-    prev_period = find_period_by_bounds(pharmacy_id, prev_start.isoformat(), prev_end.isoformat())
-    if not prev_period:
-        back_markup = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("◀️ بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))]]
-        )
-        await safe_edit(
-            message,
-            "🔍 دورهٔ ماه قبل هنوز ثبت نشده است.",
-            reply_markup=back_markup,
-            context=context,
-            log_context="cb_compare_prev_missing_prev",
-        )
-        return
-    current_period = find_period_by_bounds(pharmacy_id, curr_start.isoformat(), curr_end.isoformat())
-    if not current_period:
-        back_markup = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("◀️ بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))]]
-        )
-        await safe_edit(
-            message,
-            "❗ دورهٔ انتخاب‌شده پیدا نشد.",
-            reply_markup=back_markup,
-            context=context,
-            log_context="cb_compare_prev_missing_current",
-        )
-        return
-    prev_period_id = prev_period["id"]
-    current_period_id = current_period["id"]
-    table = render_compare_table(pharmacy_id, prev_period_id, current_period_id)
-    month_name = JALALI_MONTH_NAMES[jm - 1] if 1 <= jm <= 12 else str(jm)
-    prev_month_name = JALALI_MONTH_NAMES[prev_jm - 1] if 1 <= prev_jm <= 12 else str(prev_jm)
-    back_markup = InlineKeyboardMarkup([[InlineKeyboardButton("◀️ بازگشت", callback_data=make_cb(TAG_PERIOD_SELECT, pharmacy_id, current_period_id))]])
-    # Compose the comparison text using a triple-quoted f-string to keep the
-    # newline intact. This avoids breaking strings across lines in code.
-    comparison_text = (
-        f"""<b>مقایسه {month_name} {jy} با {prev_month_name} {prev_jy}</b>\n\n{table}"""
-    )
-    await safe_edit(
-        message,
-        comparison_text,
-        reply_markup=back_markup,
-        context=context,
-        log_context="cb_compare_prev",
-    )
-
-@owner_only_access
-async def cb_compare_months(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(r"^fin\.compare\.months:(\d+):(\d+):(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    base_jy = int(match.group(2))
-    base_jm = int(match.group(3))
-    jy = base_jy
-    kb = compare_months_kb(pharmacy_id, base_jy, base_jm, jy)
-    await safe_edit(
-        message,
-        f"ماه مرجع {base_jy}/{base_jm:02d} — ماه دوم را انتخاب کن",
-        reply_markup=kb,
-        context=context,
-        log_context="cb_compare_months",
-    )
-
-@owner_only_access
-async def cb_compare_pick(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(r"^fin\.compare\.pick:(\d+):(\d+):(\d+):(\d+):(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    base_jy = int(match.group(2))
-    base_jm = int(match.group(3))
-    jy = int(match.group(4))
-    jm = int(match.group(5))
-    # Do not implicitly create periods when comparing months.  Lookup existing periods instead.
-    # Compute Jalali month bounds for both the base and target months.
-    base_start, base_end, _ = jalali_month_bounds(base_jy, base_jm)
-    target_start, target_end, _ = jalali_month_bounds(jy, jm)
-    # Attempt to find existing periods by their inclusive date bounds.
-    base_period = find_period_by_bounds(
-        pharmacy_id, base_start.isoformat(), base_end.isoformat()
-    )
-    if not base_period:
-        # If the base month is not registered, do not create a new period.  Inform the user.
-        back_markup = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("◀️ بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))]]
-        )
-        await safe_edit(
-            message,
-            "🔍 دورهٔ ماه مبدا هنوز ثبت نشده است.",
-            reply_markup=back_markup,
-            context=context,
-            log_context="cb_compare_pick_missing_base",
-        )
-        return
-    target_period = find_period_by_bounds(
-        pharmacy_id, target_start.isoformat(), target_end.isoformat()
-    )
-    if not target_period:
-        # If the target month does not exist yet, avoid creating it and inform the user.
-        back_markup = InlineKeyboardMarkup(
-            [[InlineKeyboardButton("◀️ بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))]]
-        )
-        await safe_edit(
-            message,
-            "🔍 دورهٔ ماه انتخاب‌شده هنوز ثبت نشده است.",
-            reply_markup=back_markup,
-            context=context,
-            log_context="cb_compare_pick_missing_target",
-        )
-        return
-    # Both periods exist; extract their IDs for comparison.
-    base_period_id = base_period["id"]
-    target_period_id = target_period["id"]
-    table = render_compare_table(pharmacy_id, base_period_id, target_period_id)
-    base_name = JALALI_MONTH_NAMES[base_jm - 1] if 1 <= base_jm <= 12 else str(base_jm)
-    target_name = JALALI_MONTH_NAMES[jm - 1] if 1 <= jm <= 12 else str(jm)
-    back_markup = InlineKeyboardMarkup([[InlineKeyboardButton("◀️ بازگشت", callback_data=make_cb(TAG_PERIOD_SELECT, pharmacy_id, base_period_id))]])
-    await safe_edit(
-        message,
-        f"""<b>مقایسه {base_name} {base_jy} با {target_name} {jy}</b>\n\n{table}""",
-        reply_markup=back_markup,
-        context=context,
-        log_context="cb_compare_pick",
-    )
-
-@owner_only_access
-async def cb_report_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """\n    Show the detailed monthly report for a period. This callback expects data\n    in the format ``fin.report.view:<pharmacy_id>:<period_id>``. It fetches\n    the relevant metrics and period details, renders a report via\n    ``render_report``, and then displays it with the standard month actions\n    keyboard so the user can navigate back or perform other actions.\n    """
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(r"^fin\.report\.view:(\d+):(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    period_id = int(match.group(2))
-    metrics_row = get_metrics(pharmacy_id, period_id)
-    period_row = get_period(period_id)
-    if not metrics_row or not period_row:
-        await safe_edit(
-            message,
-            "⚠️ دوره پیدا نشد.",
-            reply_markup=None,
-            context=context,
-            log_context="cb_report_view_missing",
-        )
-        return
-    report_html = render_report(metrics_row, period_row)
-    # Determine the Jalali month to build the month actions keyboard
-    p = dict(period_row)
-    start_iso = p.get("start_date") or date.today().isoformat()
-    jy, jm, _ = gregorian_to_jalali(date.fromisoformat(start_iso))
-    kb, _, _, _ = month_actions_kb(pharmacy_id, jy, jm, period_id=period_id, status=p.get("status", "open"))
-    await safe_edit(
-        message,
-        report_html,
-        reply_markup=kb,
-        context=context,
-        log_context="cb_report_view",
-    )
-
-def get_period_baseline(pharmacy_id, period_id):
-    raise NotImplementedError
-
-@owner_only_access
-async def cb_sim_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """\n    Entry point for the two‑lever simulator.\n    Initializes baseline and deltas in context.user_data['sim'] and renders the simulation.\n    Callback data format: ``fin.sim.menu:<pharmacy_id>:<period_id>``.\n    """
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(rf"^{TAG_SIM_MENU}:(\d+):(\d+)$", data)
-    if not match:
-        await safe_edit(
-            message,
-            "❗ داده نامعتبر است.",
-            context=context,
-            log_context="cb_sim_menu_invalid",
-        )
-        return
-    pharmacy_id = int(match.group(1))
-    period_id = int(match.group(2))
-    # Access or initialize simulation state
-    sim_state = context.user_data.get("sim") if context.user_data else None
-    if not sim_state or sim_state.get("pharmacy_id") != pharmacy_id or sim_state.get("period_id") != period_id:
-        baseline = get_period_baseline(pharmacy_id, period_id)
-        # Ensure context.user_data exists
-        if context.user_data is None:
-            context.user_data = {}
-        context.user_data["sim"] = {
-            "pharmacy_id": pharmacy_id,
-            "period_id": period_id,
-            "deltas": {"sales": 0.0, "var": 0.0, "fixed": 0.0},
-            "baseline": baseline,
-        }
-    if context.user_data is None:
-        context.user_data = {}
-    sim_state = context.user_data.get("sim", {})
-    baseline = sim_state.get("baseline", {})
-    deltas = sim_state.get("deltas", {})
-    sim_out = compute_simulated(baseline, deltas)
-    period_row = get_period(period_id) or {}
-    text = render_sim_text(period_row, sim_out, deltas)
-    kb = sim_keyboard(pharmacy_id, period_id)
-    await safe_edit(
-        message,
-        text,
-        reply_markup=kb,
-        context=context,
-        log_context="cb_sim_menu",
-    )
-
-@owner_only_access
-async def cb_sim_delta(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """\n    Adjust one of the simulation deltas and refresh the simulation view.\n    Callback data format: ``fin.sim.delta:<ph_id>:<period_id>:<kind>:<sign>:<pct>``\n    where kind ∈ {sales, var, fixed}, sign ∈ {plus, minus}, pct ∈ {5,10}.\n    """
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(rf"^{TAG_SIM_DELTA}:(\d+):(\d+):(sales|var|fixed):(plus|minus):(5|10)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    period_id = int(match.group(2))
-    kind = match.group(3)
-    sign = match.group(4)
-    pct_val = int(match.group(5))
-    step = pct_val / 100.0
-    if sign == "minus":
-        step = -step
-    # Ensure simulation state exists and matches
-    sim_state = context.user_data.get("sim") if context.user_data else None
-    if not sim_state or sim_state.get("pharmacy_id") != pharmacy_id or sim_state.get("period_id") != period_id:
-        baseline = get_period_baseline(pharmacy_id, period_id)
-        if context.user_data is None:
-            context.user_data = {}
-        context.user_data["sim"] = {
-            "pharmacy_id": pharmacy_id,
-            "period_id": period_id,
-            "deltas": {"sales": 0.0, "var": 0.0, "fixed": 0.0},
-            "baseline": baseline,
-        }
-        sim_state = context.user_data["sim"]
-    # Update the specific delta with clamping
-    deltas = sim_state["deltas"]
-    current_val = float(deltas.get(kind, 0.0))
-    new_val = clamp(current_val + step, -0.30, 0.30)
-    deltas[kind] = new_val
-    baseline = sim_state["baseline"]
-    sim_out = compute_simulated(baseline, deltas)
-    period_row = get_period(period_id) or {}
-    text = render_sim_text(period_row, sim_out, deltas)
-    kb = sim_keyboard(pharmacy_id, period_id)
-    await safe_edit(
-        message,
-        text,
-        reply_markup=kb,
-        context=context,
-        log_context="cb_sim_delta",
-    )
-
-def render_sim_text(period_row, sim_out, deltas):
-    raise NotImplementedError
-
-def sim_keyboard(pharmacy_id, period_id):
-    raise NotImplementedError
-
-@owner_only_access
-async def cb_sim_reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """\n    Reset all simulation deltas to zero and refresh the simulation view.\n    Callback data format: ``fin.sim.reset:<ph_id>:<period_id>``.\n    """
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(rf"^{TAG_SIM_RESET}:(\d+):(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    period_id = int(match.group(2))
-    # Ensure simulation state exists
-    sim_state = context.user_data.get("sim") if context.user_data else None
-    if not sim_state or sim_state.get("pharmacy_id") != pharmacy_id or sim_state.get("period_id") != period_id:
-        baseline = get_period_baseline(pharmacy_id, period_id)
-        if context.user_data is None:
-            context.user_data = {}
-        context.user_data["sim"] = {
-            "pharmacy_id": pharmacy_id,
-            "period_id": period_id,
-            "deltas": {"sales": 0.0, "var": 0.0, "fixed": 0.0},
-            "baseline": baseline,
-        }
-        sim_state = context.user_data["sim"]
-    else:
-        sim_state["deltas"] = {"sales": 0.0, "var": 0.0, "fixed": 0.0}
-    baseline = sim_state["baseline"]
-    deltas = sim_state["deltas"]
-    sim_out = compute_simulated(baseline, deltas)
-    period_row = get_period(period_id) or {}
-    text = render_sim_text(period_row, sim_out, deltas)
-    kb = sim_keyboard(pharmacy_id, period_id)
-    await safe_edit(
-        message,
-        text,
-        reply_markup=kb,
-        context=context,
-        log_context="cb_sim_reset",
-    )
-
-@owner_only_access
-async def cb_sim_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """\n    Return from the simulator to the month actions menu.\n    Callback data format: ``fin.sim.back:<ph_id>:<period_id>``.\n    """
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(rf"^{TAG_SIM_BACK}:(\d+):(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    period_id = int(match.group(2))
-    period_row = get_period(period_id)
-    if not period_row:
-        await safe_edit(
-            message,
-            "⚠️ دوره پیدا نشد.",
-            reply_markup=None,
-            context=context,
-            log_context="cb_sim_back_missing_period",
-        )
-        return
-    p = dict(period_row)
-    start_iso = p.get("start_date") or date.today().isoformat()
-    jy, jm, _ = gregorian_to_jalali(date.fromisoformat(start_iso))
-    kb, _, _, month_name = month_actions_kb(pharmacy_id, jy, jm, period_id=period_id, status=p.get("status", "open"))
-    # Clear simulation state
-    if context.user_data and context.user_data.get("sim"):
-        context.user_data.pop("sim", None)
-    await safe_edit(
-        message,
-        f"ماه {jy}/{jm:02d} ({month_name}) — یکی از گزینه‌ها را انتخاب کن",
-        reply_markup=kb,
-        context=context,
-        log_context="cb_sim_back",
-    )
-
-def clamp(value: float, min_val: float, max_val: float) -> float:
-    """Constrain a value between minimum and maximum bounds."""
-    return max(min_val, min(max_val, value))
-
-def compute_simulated(baseline: dict, deltas: dict) -> dict:
-    """
-    Apply percentage deltas to the baseline period metrics and compute derived KPIs.
-
-    baseline: dict that may contain keys like sales_total, var_total, fixed_total,
-              opex_other_total, visits_total, days_count (any missing values default to 0).
-    deltas: dict with percentage deltas as fractions, e.g. {"sales": 0.05, "var": -0.10, "fixed": 0.0}
-    Returns a dict with recomputed keys similar to period_metrics columns.
-    """
-    def _float(d, k, default=0.0):
-        try:
-            return float(d.get(k, default) or default)
-        except Exception:
-            return float(default)
-
-    sales_total = _float(baseline, "sales_total", 0.0)
-    var_total = _float(baseline, "var_total", 0.0)
-    fixed_total = _float(baseline, "fixed_total", 0.0)
-    opex_other_total = _float(baseline, "opex_other_total", 0.0)
-    visits_total = int(baseline.get("visits_total", 0) or 0)
-    days_count = int(baseline.get("days_count", 0) or 0)
-
-    sales_delta = float(deltas.get("sales", 0.0) or 0.0)
-    var_delta = float(deltas.get("var", 0.0) or 0.0)
-    fixed_delta = float(deltas.get("fixed", 0.0) or 0.0)
-
-    new_sales = sales_total * (1.0 + sales_delta)
-    new_var = var_total * (1.0 + var_delta)
-    new_fixed = fixed_total * (1.0 + fixed_delta)
-
-    # Derived metrics
-    gross_profit = new_sales - new_var
-    net_profit_operational = gross_profit - new_fixed - opex_other_total
-
-    cm_ratio = (new_sales - new_var) / new_sales if new_sales and new_sales != 0 else 0.0
-    np_ratio = net_profit_operational / new_sales if new_sales and new_sales != 0 else 0.0
-
-    breakeven_sales = new_fixed / cm_ratio if cm_ratio and cm_ratio != 0 else 0.0
-    avg_daily_sales = new_sales / days_count if days_count and days_count != 0 else 0.0
-    avg_sale_per_visit = new_sales / visits_total if visits_total and visits_total != 0 else 0.0
-
-    return {
-        "sales_total": new_sales,
-        "var_total": new_var,
-        "fixed_total": new_fixed,
-        "opex_other_total": opex_other_total,
-        "visits_total": visits_total,
-        "days_count": days_count,
-        "gross_profit": gross_profit,
-        "net_profit_operational": net_profit_operational,
-        "cm_ratio": cm_ratio,
-        "np_ratio": np_ratio,
-        "breakeven_sales": breakeven_sales,
-        "avg_daily_sales": avg_daily_sales,
-        "avg_sale_per_visit": avg_sale_per_visit,
-    }
-
-@owner_only_access
-async def cb_weekly_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """\n    Show a report for the last seven days (including today) for the selected\n    pharmacy and period. Callback data format:\n    ``fin.weekly.report:<pharmacy_id>:<period_id>``.\n    Aggregates daily logs and displays per-day entries as well as totals.\n    """
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(r"^fin\.weekly\.report:(\d+):(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    period_id = int(match.group(2))
-    today = date.today()
-    window_end = today
-    window_start = today - timedelta(days=6)
-    period_row = get_period(period_id) if period_id else None
-    period_info = dict(period_row) if period_row else None
-    if period_info:
-        period_start_iso = period_info.get("start_date")
-        period_end_iso = period_info.get("end_date")
-        if period_start_iso and period_end_iso:
-            try:
-                period_start_date = date.fromisoformat(period_start_iso)
-                period_end_date = date.fromisoformat(period_end_iso)
-                if period_end_date < period_start_date:
-                    period_start_date, period_end_date = period_end_date, period_start_date
-                window_end = period_end_date
-                period_length = (period_end_date - period_start_date).days + 1
-                if period_length >= 7:
-                    candidate_start = period_end_date - timedelta(days=6)
-                    window_start = candidate_start if candidate_start >= period_start_date else period_start_date
-                else:
-                    window_start = period_start_date
-            except ValueError:
-                pass
-    if window_end < window_start:
-        window_start = window_end
-    start_iso = window_start.isoformat()
-    end_iso = window_end.isoformat()
-    logs = get_daily_range(pharmacy_id, start_iso, end_iso)
-    lines: list[str] = [f"<b>گزارش ۷ روزه از {h(start_iso)} تا {h(end_iso)}</b>"]
-    total_sales_cash = 0.0
-    total_sales_ins = 0.0
-    total_var = 0.0
-    total_opex = 0.0
-    total_visits = 0
-    log_map: dict[str, dict] = {}
-    for row in logs:
-        record = dict(row)
-        log_date = record.get("log_date")
-        if log_date:
-            log_map[log_date] = record
-    total_window_days = (window_end - window_start).days
-    full_days = [
-        window_start + timedelta(days=i) for i in range(total_window_days + 1)
-    ]
-    if not full_days:
-        full_days = [window_start]
-    for day in full_days:
-        day_iso = day.isoformat()
-        record = log_map.get(day_iso)
-        if record:
-            sales_cash = record.get("sales_cash") or 0.0
-            sales_ins = record.get("sales_ins") or 0.0
-            var_purchases = record.get("var_purchases") or 0.0
-            opex_other = record.get("opex_other") or 0.0
-            visits = record.get("visits") or 0
-            note_val = record.get("note") or None
-            note_display = h(note_val) if note_val else "-"
-        else:
-            sales_cash = 0.0
-            sales_ins = 0.0
-            var_purchases = 0.0
-            opex_other = 0.0
-            visits = 0
-            note_display = "– بدون ثبت –"
-        lines.append(
-            f"{h(day_iso)}: نقدی {fmt_money(sales_cash)}، بیمه {fmt_money(sales_ins)}، متغیر {fmt_money(var_purchases)}، سایر {fmt_money(opex_other)}، مراجعه {visits}، یادداشت: {note_display}"
-        )
-        total_sales_cash += float(sales_cash)
-        total_sales_ins += float(sales_ins)
-        total_var += float(var_purchases)
-        total_opex += float(opex_other)
-        try:
-            total_visits += int(visits)
-        except Exception:
-            pass
-    lines.append("")
-    lines.append("<b>جمع ۷ روزه</b>")
-    lines.append(f"نقدی: {fmt_money(total_sales_cash)}")
-    lines.append(f"بیمه: {fmt_money(total_sales_ins)}")
-    lines.append(f"خرید متغیر: {fmt_money(total_var)}")
-    lines.append(f"سایر هزینه‌ها: {fmt_money(total_opex)}")
-    lines.append(f"مراجعه: {total_visits}")
-    report_text = "\n".join(lines)
-    back_callback = make_cb(TAG_PERIOD_SELECT, pharmacy_id, period_id)
-    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("?? ??????", callback_data=back_callback)]])
-    await safe_edit(
-        message,
-        report_text,
-        reply_markup=keyboard,
-        context=context,
-        log_context="cb_weekly_report",
-    )
-
-@owner_only_access
-async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /start command."""
-    if not update.message:
-        return
-    await update.message.reply_text("به ربات مالی خوش آمدید!", reply_markup=main_menu_kb())
-
-@owner_only_access
-async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /help command."""
-    if not update.message:
-        return
-    await update.message.reply_text(HELP_TEXT)
-
-@owner_only_access
-async def cmd_about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /about command."""
-    if not update.message:
-        return
-    await update.message.reply_text(ABOUT_TEXT)
-
-@owner_only_access
-async def cmd_ping(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle the /ping command."""
-    if not update.message:
-        return
-    await update.message.reply_text("🏓 Pong!")
-
-@owner_only_access
-async def cb_home(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle home button callback."""
-    q = update.callback_query
-    if not q or not q.message:
-        return
-    await q.answer()
-    await safe_edit(q.message, "به ربات مالی خوش آمدید!", reply_markup=main_menu_kb(), context=context)
-
-@owner_only_access
-async def cb_pharm_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle new pharmacy button callback."""
-    q = update.callback_query
-    if not q or not q.message:
-        return
-    await q.answer()
-    await safe_edit(q.message, "نام داروخانه را وارد کنید:", reply_markup=ForceReply(), context=context)
-
-@owner_only_access
-async def cb_pharm_select(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle pharmacy selection callback."""
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message
-    if not message:
-        return
-    data = q.data or ""
-    match = re.match(r"^fin\.pharm\.select:(\d+)$", data)
-    if not match:
-        return
-    pharmacy_id = int(match.group(1))
-    await safe_edit(message, f"داروخانه #{pharmacy_id} انتخاب شد.", reply_markup=period_list_kb(pharmacy_id), context=context)
-
-@owner_only_access
-async def cb_compare_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle compare start callback."""
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    await safe_edit(q.message, "ماه اول را انتخاب کنید:", reply_markup=month_picker_kb(date.today().year, tag=TAG_COMPARE_PICK_FIRST), context=context)
-
-@owner_only_access
-async def cb_compare_pick_first(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle first month selection for comparison."""
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    # Implementation here
-
-@owner_only_access
-async def cb_compare_pick_second(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle second month selection for comparison."""
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    # Implementation here
-
-async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle regular text messages."""
-    if not update.message:
-        return
-    await update.message.reply_text("لطفاً از دستورات و دکمه‌های موجود استفاده کنید.")
-
-@owner_only_access
-async def cb_pdf_simple(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """\n    Generate a simple PDF report for a given pharmacy and period.\n    The callback data format is ``fin.pdf.simple:<pharmacy_id>:<period_id>``.\n\n    This handler attempts to import the reportlab library; if unavailable,\n    it informs the user that PDF generation is not possible. Otherwise,\n    it constructs a one‑page PDF containing the pharmacy name, period\n    information, and a simple three‑column table of key metrics.\n    """
-    q = update.callback_query
-    if not q:
-        return
-    await q.answer()
-    message = q.message or update.effective_message
-    if not message:
-        return
-    data = q.data or ""
-    m = re.match(r"^fin\.pdf\.simple:(\d+):(\d+)$", data)
-    if not m:
-        return
-    pharmacy_id = int(m.group(1))
-    period_id = int(m.group(2))
-    metrics_row = get_metrics(pharmacy_id, period_id)
-    period_row = get_period(period_id)
-    if not metrics_row or not period_row:
-        await safe_edit(
-            message,
-            "⚠️ دوره یا داده یافت نشد.",
-            reply_markup=None,
-            context=context,
-            log_context="cb_pdf_simple_missing",
-        )
-        return
-    # Attempt to import reportlab components
-    try:
-        from reportlab.lib.pagesizes import A4
-        from reportlab.lib import colors
-        from reportlab.lib.styles import getSampleStyleSheet
-        from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-        from reportlab.pdfbase import pdfmetrics
-        from reportlab.pdfbase.ttfonts import TTFont
-        import tempfile
-        from datetime import datetime
-    except Exception:
-        await safe_edit(
-            message,
-            "⚠️ امکان تولید فایل PDF وجود ندارد. لطفماً کتابخانه reportlab را نصب کنید.",
-            reply_markup=None,
-            context=context,
-            log_context="cb_pdf_simple_no_reportlab",
-        )
-        return
-    # Convert rows to dicts if necessary
-    metrics = dict(metrics_row) if not isinstance(metrics_row, dict) else metrics_row
-    period = dict(period_row) if not isinstance(period_row, dict) else period_row
-    # Retrieve pharmacy name
-    pharmacy_name = f"#{pharmacy_id}"
-    try:
-        with db_conn() as conn:
-            c = conn.cursor()
-            c.execute("SELECT title FROM pharmacies WHERE id = ?", (pharmacy_id,))
-            row = c.fetchone()
-            if row and row["title"]:
-                pharmacy_name = row["title"]
-    except Exception:
-        pass
-    # Prepare table data (English)
-    table_data: list[list[str]] = []
-    table_data.append(["Metric", "Value", "Unit"])
-    def _pct(v):
-        try:
-            return f"{float(v)*100:.1f}%"
-        except Exception:
-            return "-"
-    def add_row(title: str, value, unit: str) -> None:
-        table_data.append([title, value, unit])
-    add_row("Cash Sales", fmt_money(metrics.get("sales_cash", 0)), "Toman")
-    add_row("Insurance Deposits", fmt_money(metrics.get("sales_ins", 0)), "Toman")
-    add_row("Total Sales", fmt_money(metrics.get("sales_total", 0)), "Toman")
-    add_row("Variable Purchases", fmt_money(metrics.get("var_total", 0)), "Toman")
-    add_row("Fixed Costs (Rent+Staff)", fmt_money(metrics.get("fixed_total", 0)), "Toman")
-    add_row("Other Opex", fmt_money(metrics.get("opex_other_total", 0)), "Toman")
-    add_row("Gross Profit", fmt_money(metrics.get("gross_profit", 0)), "Toman")
-    add_row("Net Operating Profit", fmt_money(metrics.get("net_profit_operational", 0)), "Toman")
-    add_row("Gross Margin", _pct(metrics.get("cm_ratio", 0)), "%")
-    add_row("Net Margin", _pct(metrics.get("np_ratio", 0)), "%")
-    add_row("Breakeven Sales", fmt_money(metrics.get("breakeven_sales", 0)), "Toman")
-    add_row("Avg Daily Sales", fmt_money(metrics.get("avg_daily_sales", 0)), "Toman/day")
-    add_row("Avg Sale/Visit", fmt_money(metrics.get("avg_sale_per_visit", 0)), "Toman/visit")
-    add_row("Visits", str(metrics.get("visits_total", 0)), "person")
-    add_row("Days in Period", str(metrics.get("days_count", 0)), "day")
-    # Create a temporary file for the PDF
-    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pdf")
-    tmp_path = tmp_file.name
-    tmp_file.close()
-    # Build the PDF document
-    doc = SimpleDocTemplate(tmp_path, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
-    styles = getSampleStyleSheet()
-    story = []
-    # Attempt to register a Persian font; fall back to default
-    try:
-        pdfmetrics.registerFont(TTFont("Vazirmatn", "./assets/fonts/Vazirmatn-Regular.ttf"))
-        font_name = "Vazirmatn"
-    except Exception:
-        font_name = "Helvetica"
-    title_style = styles["Title"]
-    normal_style = styles["Normal"]
-    italic_style = styles["Italic"]
-    # Title and period info
-    story.append(Paragraph(f"Financial Report for Pharmacy {h(str(pharmacy_name))}", title_style))
-    story.append(Paragraph(f"Period: {h(str(period.get('title', '')))}", normal_style))
-    story.append(Paragraph(f"From {h(str(period.get('start_date', '-')))} to {h(str(period.get('end_date', '-')))}", normal_style))
-    story.append(Paragraph(f"Status: {h(str(period.get('status', 'open')))}", normal_style))
-    story.append(Paragraph(f"Generated on: {datetime.now().date().isoformat()}", normal_style))
-    story.append(Spacer(1, 12))
-    # Table with metrics
-    table = Table(table_data, colWidths=[230, 120, 80])
-    table_style = TableStyle(
-        [
-            ("GRID", (0, 0), (-1, -1), 0.5, colors.gray),
-            ("BACKGROUND", (0, 0), (-1, 0), colors.lightgrey),
-            ("ALIGN", (1, 1), (-1, -1), "LEFT"),
-        ]
-    )
-    table.setStyle(table_style)
-    story.append(table)
-    story.append(Spacer(1, 12))
-    story.append(Paragraph("This report was auto-generated by FINbot.", italic_style))
-    # Render the PDF
-    doc.build(story)
-    # Send the generated PDF to the user
-    try:
-        await context.bot.send_document(
-            chat_id=message.chat.id,
-            document=open(tmp_path, "rb"),
-            filename=f"Report_{pharmacy_id}_{period_id}.pdf",
-            caption="📄 PDF report is ready.",
-        )
-    except Exception:
-        await safe_edit(
-            message,
-            "⚠️ خطا در ارسال فایل PDF.",
-            reply_markup=None,
-            context=context,
-            log_context="cb_pdf_simple_send_error",
-        )
-    finally:
-        import os as _os
-        try:
-            _os.unlink(tmp_path)
-        except Exception:
-            pass
-
-def main() -> None:
-    """Entry point for running the Telegram bot."""
-    migrate()
-    application = (
-        ApplicationBuilder()
-        .token(BOT_TOKEN)
-        .defaults(Defaults(parse_mode=ParseMode.HTML))
-        .build()
-    )
-
-    # --- Commands ---
-    application.add_handler(CommandHandler("start", cmd_start))
-    application.add_handler(CommandHandler("help", cmd_help))
-    application.add_handler(CommandHandler("about", cmd_about))
-    application.add_handler(CommandHandler("ping", cmd_ping))
-
-    # --- Main Menu Flow ---
-    application.add_handler(CallbackQueryHandler(cb_home, pattern=r"^fin\.home$"))
-    application.add_handler(CallbackQueryHandler(cb_pharm_new, pattern=r"^fin\.pharm\.new$"))
-    application.add_handler(CallbackQueryHandler(cb_pharm_select, pattern=r"^fin\.pharm\.select:(\d+)$"))
-
-    # --- Check Registration ---
-    application.add_handler(CallbackQueryHandler(cb_check_start, pattern=rf"^{TAG_CHECK_START}:(\d+)$"))
-    application.add_handler(
-        CallbackQueryHandler(cb_check_pick_day, pattern=rf"^{TAG_CHECK_PICK_DAY}:\d{{4}}-\d{{2}}-\d{{2}}:(\d+)$")
-    )
-
-    # --- Daily Registration ---
-    application.add_handler(CallbackQueryHandler(cb_daily_start, pattern=rf"^{TAG_DAILY_START}:(\d+)$"))
-    application.add_handler(
-        CallbackQueryHandler(cb_daily_pick_day, pattern=rf"^{TAG_DAILY_FLOW_PICK_DAY}:\d{{4}}-\d{{2}}-\d{{2}}:(\d+)$")
-    )
-
-    # --- Monthly Summary ---
-    application.add_handler(CallbackQueryHandler(cb_summary_start, pattern=rf"^{TAG_SUMMARY_START}:(\d+)$"))
-    application.add_handler(
-        CallbackQueryHandler(cb_summary_pick_month, pattern=rf"^{TAG_SUMMARY_PICK_MONTH}:\d{{4}}-\d{{2}}:(\d+)$")
-    )
-
-    # --- Compare Months ---
-    application.add_handler(CallbackQueryHandler(cb_compare_start, pattern=rf"^{TAG_COMPARE_START}:(\d+)$"))
-    application.add_handler(
-        CallbackQueryHandler(cb_compare_pick_first, pattern=rf"^{TAG_COMPARE_PICK_FIRST}:\d{{4}}-\d{{2}}:(\d+)$")
-    )
-    application.add_handler(
-        CallbackQueryHandler(cb_compare_pick_second, pattern=rf"^{TAG_COMPARE_PICK_SECOND}:\d{{4}}-\d{{2}}:(\d+)$")
-    )
-
-    # --- Unified message flow (check/daily) ---
-    application.add_handler(MessageHandler(filters.TEXT & filters.REPLY & ~filters.COMMAND, msg_check_flow))
-    application.add_handler(MessageHandler(filters.TEXT & filters.REPLY & ~filters.COMMAND, msg_daily_flow))
-
-    # Fallback handler (optional text logging)
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
-
-    # --- Start polling ---
-    application.run_polling(
-        allowed_updates=[
-            UpdateType.MESSAGE,
-            UpdateType.CALLBACK_QUERY,
-            UpdateType.EDITED_MESSAGE,
-            UpdateType.MY_CHAT_MEMBER,
-            UpdateType.CHAT_MEMBER,
-        ],
-        drop_pending_updates=True,
-    )
-
-
-if __name__ == "__main__":
-    import sys
-    try:
-        main()
-    except KeyboardInterrupt:
-        pass
+# FINboot.py — one-file Telegram finance helper (Python 3.10+, PTB v21)
+
+import asyncio
+import os
+import re
+import sys
+import io
+import sqlite3
+import logging
+import queue
+import threading
+
+# jdatetime is optional and only needed once a Jalali conversion actually
+# runs; importing it lazily keeps bot startup off the hook.
+jdatetime = None
+_jdatetime_checked = False
+
+def _jd():
+    """Import jdatetime on first use; returns the module or None."""
+    global jdatetime, _jdatetime_checked
+    if not _jdatetime_checked:
+        _jdatetime_checked = True
+        try:
+            import jdatetime as _j
+            jdatetime = _j
+        except Exception:
+            pass
+    return jdatetime
+
+from dataclasses import dataclass
+from datetime import date, timedelta
+from contextlib import contextmanager
+from typing import Optional, List, Tuple
+from pathlib import Path
+from functools import lru_cache, partial, wraps
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    # Import the required classes from python‑telegram‑bot.  The library must be version 21 or newer.
+    from telegram import ForceReply, InlineKeyboardButton, InlineKeyboardMarkup, Update
+    from telegram.constants import ParseMode, UpdateType
+    from telegram.ext import (
+        Application,
+        ApplicationBuilder,
+        CallbackContext,
+        CallbackQueryHandler,
+        CommandHandler,
+        MessageHandler,
+        filters,
+        Defaults,
+        ContextTypes,
+    )
+    from telegram.error import BadRequest
+    from telegram.request import HTTPXRequest
+
+except ImportError:
+    print(
+        "ERROR: python‑telegram‑bot v21+ is required. Install with: pip install python-telegram-bot==21.*",
+        file=sys.stderr,
+    )
+    sys.exit(1)
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+TRUNCATE_THRESHOLD = 4000
+TRUNCATE_BODY_LENGTH = 3900
+TRUNCATION_SUFFIX = "\n\n… [truncated]"
+HELP_TEXT = (
+    "دستورات در دسترس:\n"
+    "/start — بازگشت به خانه\n"
+    "/help — همین راهنما\n"
+    "/about — معرفی ربات\n"
+    "/ping — بررسی اتصال\n\n"
+    "برای مبالغ می‌توان از k (هزار)، m (میلیون) و b (میلیارد) استفاده کرد."
+)
+ABOUT_TEXT = (
+    "FINbot یک دستیار مالی برای داروخانه‌هاست؛ ذخیره‌سازی داده، گزارش‌گیری و مقایسه ماهانه را ساده می‌کند."
+)
+
+# Single-pass C-level escape; html.escape does three chained str.replace
+# passes and h() sits on every message-render path.
+_HTML_ESCAPE_TABLE = str.maketrans(
+    {"&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;"}
+)
+
+def h(value: Optional[str]) -> str:
+    """Escape user-sourced strings for safe HTML output."""
+    return (value or "").translate(_HTML_ESCAPE_TABLE)
+
+def _truncate_text(text: str) -> str:
+    """Ensure messages stay within Telegram limits with a friendly suffix."""
+    if len(text) <= TRUNCATE_THRESHOLD:
+        return text
+    cut = text.rfind("\n", 0, TRUNCATE_BODY_LENGTH)
+    if cut == -1:
+        cut = TRUNCATE_BODY_LENGTH
+    trimmed = text[:cut].rstrip()
+    suffix = TRUNCATION_SUFFIX
+    if len(trimmed) + len(suffix) > MAX_MESSAGE_LENGTH:
+        trimmed = trimmed[: MAX_MESSAGE_LENGTH - len(suffix)]
+    return f"{trimmed}{suffix}"
+
+OWNER_USER_IDS: frozenset = frozenset(
+    int(x) for x in os.environ.get("OWNER_USER_IDS", "").split(",") if x.strip().isdigit()
+)
+
+def owner_only_access(func):
+    # Ownership is import-time configuration: with no owners configured the
+    # bot is open and handlers are returned unwrapped, so the common dispatch
+    # path pays nothing. Otherwise keep the owner set in a closure local.
+    if not OWNER_USER_IDS:
+        return func
+    _owners = OWNER_USER_IDS
+
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+        user = update.effective_user
+        if user is None or user.id not in _owners:
+            return
+        return await func(update, context, *args, **kwargs)
+    return wrapper
+
+
+async def safe_edit(
+    message,
+    text: str,
+    reply_markup=None,
+    context: Optional[ContextTypes.DEFAULT_TYPE] = None,
+    log_context: str = "safe_edit",
+) -> None:
+    """Edit a message with HTML-safe text, handling BadRequest gracefully."""
+    if not message:
+        return
+    primary = _truncate_text(text)
+    try:
+        await message.edit_text(primary, reply_markup=reply_markup)
+        return
+    except BadRequest as exc:
+        logger.warning("%s failed (primary): %s", log_context, exc)
+        # Only pay for the escape + second truncation pass once the primary
+        # edit has actually failed; skip the retry when escaping changed nothing.
+        escaped = h(text)
+        fallback = _truncate_text(escaped)
+        try:
+            if escaped != text:
+                await message.edit_text(fallback, reply_markup=reply_markup)
+                return
+        except BadRequest as exc2:
+            logger.warning("%s fallback failed: %s", log_context, exc2)
+        bot = context.bot if context and getattr(context, "bot", None) else getattr(message, "bot", None)
+        chat_id = getattr(message, "chat_id", None)
+        if bot and chat_id is not None:
+            try:
+                await bot.send_message(chat_id=chat_id, text=fallback, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+            except BadRequest as exc3:
+                logger.error("%s fallback send failed: %s", log_context, exc3)
+        else:
+            logger.error("%s: unable to send fallback message (no bot/chat).", log_context)
+
+async def safe_reply(
+    message,
+    text: str,
+    reply_markup=None,
+    context: Optional[ContextTypes.DEFAULT_TYPE] = None,
+    log_context: str = "safe_reply",
+) -> None:
+    """Reply to a message with HTML-safe text, guarding against BadRequest issues."""
+    if not message:
+        return
+    primary = _truncate_text(text)
+    try:
+        await message.reply_text(primary, reply_markup=reply_markup)
+        return
+    except BadRequest as exc:
+        logger.warning("%s failed (primary): %s", log_context, exc)
+        escaped = h(text)
+        fallback = _truncate_text(escaped)
+        try:
+            if escaped != text:
+                await message.reply_text(fallback, reply_markup=reply_markup)
+                return
+        except BadRequest as exc2:
+            logger.warning("%s fallback failed: %s", log_context, exc2)
+        bot = context.bot if context and getattr(context, "bot", None) else getattr(message, "bot", None)
+        chat_id = getattr(message, "chat_id", None)
+        if bot and chat_id is not None:
+            try:
+                await bot.send_message(
+                    chat_id=chat_id,
+                    text=fallback,
+                    reply_markup=reply_markup,
+                    parse_mode=ParseMode.HTML,
+                    reply_to_message_id=getattr(message, "message_id", None),
+                )
+            except BadRequest as exc3:
+                logger.error("%s fallback send failed: %s", log_context, exc3)
+        else:
+            logger.error("%s: unable to send fallback message (no bot/chat).", log_context)
+
+def ensure_data_dir(path: str) -> None:
+    """Make sure the directory for the database path exists."""
+    p = Path(path).parent
+    p.mkdir(parents=True, exist_ok=True)
+
+def get_token() -> str:
+    """\n    Retrieve the bot token from environment variables.\n\n    In non‑interactive environments (e.g. a deployed bot), prompting the user for a\n    token via ``input()`` is not practical. Instead, we read the token from the\n    ``FINBOT_TOKEN`` or ``BOT_TOKEN`` environment variables. If neither is set\n    or is empty after stripping whitespace, the function exits with an error\n    message.\n    """
+    tok = (os.environ.get("FINBOT_TOKEN") or os.environ.get("BOT_TOKEN") or "").strip()
+    if not tok:
+        print(
+            "No token provided. Set FINBOT_TOKEN or BOT_TOKEN environment variables.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+    return tok
+
+BOT_TOKEN = get_token()
+import os
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_PATH = os.path.join(BASE_DIR, "robot_moein_data.db")
+
+ensure_data_dir(DB_PATH)
+
+TAG_PHARM_SELECT = "fin.pharm.select"
+TAG_PHARM_NEW = "fin.pharm.new"
+TAG_PERIOD_SELECT = "fin.period.select"
+TAG_PERIOD_NEW = "fin.period.new"
+TAG_DAILY_START = "main.daily"
+TAG_DAILY_PICK_DAY = "fin.daily.pick_day"
+TAG_DAILY_FLOW_PICK_DAY = "daily.pick_day"
+TAG_SUMMARY_START = "main.summary"
+TAG_SUMMARY_PICK_MONTH = "summary.pick_month"
+TAG_CHECK_START = "main.check"
+TAG_CHECK_PICK_DAY = "check.pick_day"
+TAG_WEEKLY_REPORT = "fin.weekly.report"
+TAG_PERIOD_NEW_JALALI = "fin.period.new_from_jalali"
+TAG_COMPARE_PREV = "fin.compare.prev"
+TAG_COMPARE_MONTHS = "fin.compare.months"
+TAG_COMPARE_PICK = "fin.compare.pick"
+TAG_COMPARE_PICK_FIRST = "fin.compare.pick_first"
+TAG_COMPARE_PICK_SECOND = "fin.compare.pick_second"
+TAG_COMPARE_START = "fin.compare.start"
+TAG_REPORT_VIEW = "fin.report.view"
+TAG_HOME = "fin.home"
+
+# Tag for triggering simple PDF report generation
+TAG_PDF_SIMPLE = "fin.pdf.simple"
+
+# Tags for two elver simulation
+TAG_SIM_MENU = "fin.sim.menu"
+TAG_SIM_DELTA = "fin.sim.delta"
+TAG_SIM_RESET = "fin.sim.reset"
+TAG_SIM_BACK = "fin.sim.back"
+
+# Dotted tag literals are not auto-interned by CPython; intern them once so
+# tag comparisons in the dispatch path can hit the pointer-equality fast path.
+for _name, _value in list(globals().items()):
+    if _name.startswith("TAG_") and isinstance(_value, str):
+        globals()[_name] = sys.intern(_value)
+del _name, _value
+
+# Callback-data patterns are matched on every button press; compile them once
+# at import time instead of handing re.match a fresh pattern string inside
+# each handler dispatch.
+_CB_DAILY_START_RE = re.compile(rf"^{re.escape(TAG_DAILY_START)}:(\d+)$")
+_CB_DAILY_PICK_DAY_RE = re.compile(rf"^{re.escape(TAG_DAILY_FLOW_PICK_DAY)}:(\d{{4}}-\d{{2}}-\d{{2}}):(\d+)$")
+_CB_SUMMARY_START_RE = re.compile(rf"^{re.escape(TAG_SUMMARY_START)}:(\d+)$")
+_CB_SUMMARY_PICK_MONTH_RE = re.compile(rf"^{re.escape(TAG_SUMMARY_PICK_MONTH)}:(\d{{4}})-(\d{{2}}):(\d+)$")
+_CB_CHECK_START_RE = re.compile(rf"^{re.escape(TAG_CHECK_START)}:(\d+)$")
+_CB_CHECK_PICK_DAY_RE = re.compile(rf"^{re.escape(TAG_CHECK_PICK_DAY)}:(\d{{4}}-\d{{2}}-\d{{2}}):(\d+)$")
+_CB_SIM_MENU_RE = re.compile(rf"^{re.escape(TAG_SIM_MENU)}:(\d+):(\d+)$")
+_CB_SIM_DELTA_RE = re.compile(rf"^{re.escape(TAG_SIM_DELTA)}:(\d+):(\d+):(sales|var|fixed):(plus|minus):(5|10)$")
+_CB_SIM_RESET_RE = re.compile(rf"^{re.escape(TAG_SIM_RESET)}:(\d+):(\d+)$")
+_CB_SIM_BACK_RE = re.compile(rf"^{re.escape(TAG_SIM_BACK)}:(\d+):(\d+)$")
+
+# compare-prev sits on every month keyboard, so it gets a startswith
+# prefilter plus an offset-anchored args pattern: mismatching callbacks
+# bail out on a C-level prefix check before the regex engine is engaged.
+_CB_COMPARE_PREV_PREFIX = TAG_COMPARE_PREV + ":"
+_CB_COMPARE_PREV_ARGS_RE = re.compile(r"(\d+):(\d+):(\d+)$")
+_CB_COMPARE_PREV_RE = re.compile(rf"^{re.escape(TAG_COMPARE_PREV)}:(\d+):(\d+):(\d+)$")
+_CB_COMPARE_MONTHS_RE = re.compile(rf"^{re.escape(TAG_COMPARE_MONTHS)}:(\d+):(\d+):(\d+)$")
+_CB_COMPARE_PICK_RE = re.compile(rf"^{re.escape(TAG_COMPARE_PICK)}:(\d+):(\d+):(\d+):(\d+):(\d+)$")
+_CB_REPORT_VIEW_RE = re.compile(rf"^{re.escape(TAG_REPORT_VIEW)}:(\d+):(\d+)$")
+_CB_WEEKLY_REPORT_RE = re.compile(rf"^{re.escape(TAG_WEEKLY_REPORT)}:(\d+):(\d+)$")
+_CB_PHARM_SELECT_RE = re.compile(rf"^{re.escape(TAG_PHARM_SELECT)}:(\d+)$")
+_CB_PDF_SIMPLE_RE = re.compile(rf"^{re.escape(TAG_PDF_SIMPLE)}:(\d+):(\d+)$")
+_CB_HOME_RE = re.compile(rf"^{re.escape(TAG_HOME)}$")
+_CB_PHARM_NEW_RE = re.compile(r"^fin\.pharm\.new$")
+_CB_COMPARE_START_RE = re.compile(rf"^{re.escape(TAG_COMPARE_START)}:(\d+)$")
+_CB_COMPARE_PICK_FIRST_RE = re.compile(rf"^{re.escape(TAG_COMPARE_PICK_FIRST)}:(\d{{4}})-(\d{{2}}):(\d+)$")
+_CB_COMPARE_PICK_SECOND_RE = re.compile(rf"^{re.escape(TAG_COMPARE_PICK_SECOND)}:(\d{{4}})-(\d{{2}}):(\d+)$")
+
+# Compiled patterns by tag so future handlers reuse them instead of passing
+# fresh pattern strings to re.match.
+_CALLBACK_PATTERNS = {
+    TAG_DAILY_START: _CB_DAILY_START_RE,
+    TAG_DAILY_FLOW_PICK_DAY: _CB_DAILY_PICK_DAY_RE,
+    TAG_SUMMARY_START: _CB_SUMMARY_START_RE,
+    TAG_SUMMARY_PICK_MONTH: _CB_SUMMARY_PICK_MONTH_RE,
+    TAG_CHECK_START: _CB_CHECK_START_RE,
+    TAG_CHECK_PICK_DAY: _CB_CHECK_PICK_DAY_RE,
+    TAG_SIM_MENU: _CB_SIM_MENU_RE,
+    TAG_SIM_DELTA: _CB_SIM_DELTA_RE,
+    TAG_SIM_RESET: _CB_SIM_RESET_RE,
+    TAG_SIM_BACK: _CB_SIM_BACK_RE,
+    TAG_COMPARE_PREV: _CB_COMPARE_PREV_RE,
+    TAG_COMPARE_MONTHS: _CB_COMPARE_MONTHS_RE,
+    TAG_COMPARE_PICK: _CB_COMPARE_PICK_RE,
+    TAG_WEEKLY_REPORT: _CB_WEEKLY_REPORT_RE,
+    TAG_PHARM_SELECT: _CB_PHARM_SELECT_RE,
+    TAG_PDF_SIMPLE: _CB_PDF_SIMPLE_RE,
+    TAG_COMPARE_START: _CB_COMPARE_START_RE,
+    TAG_COMPARE_PICK_FIRST: _CB_COMPARE_PICK_FIRST_RE,
+    TAG_COMPARE_PICK_SECOND: _CB_COMPARE_PICK_SECOND_RE,
+}
+# All fin.* callbacks share the "tag:a:b:..." shape, so handlers that only
+# need integer arguments can skip the regex engine entirely: one C-level
+# split plus a tag/arity check, with int() conversion at the call site.
+def _parse_cb(data: str, tag: str, arity: int) -> Optional[tuple[str, ...]]:
+    parts = data.split(":")
+    if len(parts) != arity + 1:
+        return None
+    # Tags are interned above, so the canonicalized first part compares by
+    # identity; the equality fallback covers literal tags at call sites.
+    p0 = sys.intern(parts[0])
+    if p0 is not tag and p0 != tag:
+        return None
+    return tuple(parts[1:])
+
+_SIM_DELTA_KINDS = frozenset({"sales", "var", "fixed"})
+_SIM_DELTA_SIGNS = frozenset({"plus", "minus"})
+_SIM_DELTA_PCTS = frozenset({"5", "10"})
+
+# Connection tuning for this bot's workload: many small transactional writes
+# (daily-log/metrics upserts) interleaved with reads for keyboards.  WAL keeps
+# readers from blocking behind writers and NORMAL sync drops the per-commit
+# fsync cost; busy_timeout absorbs short write-lock contention instead of
+# raising SQLITE_BUSY inside callback handlers.
+_CONN_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA cache_size=-20000;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA foreign_keys=ON;",
+)
+
+# Read-only connections cannot switch the journal mode; they only need the
+# per-connection tuning knobs.
+_READER_PRAGMAS = (
+    "PRAGMA busy_timeout=5000;",
+    "PRAGMA cache_size=-20000;",
+    "PRAGMA temp_store=MEMORY;",
+)
+
+class ConnectionPool:
+    """Process-wide SQLite pool: one shared writer plus read-only readers.
+
+    Connections are created lazily (the read-only URI requires the database
+    file to exist, i.e. after ``migrate()`` has run) and kept open for the
+    lifetime of the process instead of being opened and closed per call.
+    """
+
+    def __init__(self, size: Optional[int] = None) -> None:
+        self._size = size or max(4, os.cpu_count() or 1)
+        self._readers: queue.Queue = queue.Queue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._writer: Optional[sqlite3.Connection] = None
+        self._writer_lock = threading.Lock()
+
+    def _connect(self, *, readonly: bool) -> sqlite3.Connection:
+        if readonly:
+            conn = sqlite3.connect(
+                f"file:{DB_PATH}?mode=ro&cache=private",
+                uri=True,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=256,
+            )
+            pragmas = _READER_PRAGMAS
+        else:
+            conn = sqlite3.connect(
+                DB_PATH,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=256,
+            )
+            pragmas = _CONN_PRAGMAS
+        for pragma in pragmas:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def read(self):
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            conn = None
+            with self._reader_lock:
+                if self._reader_count < self._size:
+                    self._reader_count += 1
+                    conn = self._connect(readonly=True)
+            if conn is None:
+                conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    @contextmanager
+    def write(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect(readonly=False)
+            conn = self._writer
+            try:
+                yield conn
+                if conn.in_transaction:
+                    conn.commit()
+            except Exception:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+
+_POOL = ConnectionPool()
+
+@contextmanager
+def read_conn():
+    """Check out a pooled read-only connection yielding plain tuple rows."""
+    with _POOL.read() as conn:
+        conn.row_factory = None
+        yield conn
+
+@contextmanager
+def read_conn_dict():
+    """Check out a pooled read-only connection yielding sqlite3.Row rows."""
+    with _POOL.read() as conn:
+        conn.row_factory = sqlite3.Row
+        yield conn
+
+@contextmanager
+def write_conn():
+    """Acquire the shared writer connection; commits (or rolls back) on exit."""
+    with _POOL.write() as conn:
+        conn.row_factory = sqlite3.Row
+        yield conn
+
+def migrate() -> None:
+    """Create the necessary tables and indexes if they do not exist."""
+    with write_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            """\n        CREATE TABLE IF NOT EXISTS pharmacies(\n          id INTEGER PRIMARY KEY,\n          title TEXT NOT NULL,\n          created_at TEXT NOT NULL\n        );\n        """
+        )
+        c.execute(
+            """\n        CREATE TABLE IF NOT EXISTS periods(\n          id INTEGER PRIMARY KEY,\n          pharmacy_id INTEGER NOT NULL,\n          title TEXT NOT NULL,\n          start_date TEXT NOT NULL,\n          end_date TEXT NOT NULL,\n          status TEXT NOT NULL DEFAULT 'open',\n          created_at TEXT NOT NULL,\n          FOREIGN KEY(pharmacy_id) REFERENCES pharmacies(id)\n        );\n        """
+        )
+        c.execute(
+            """\n        CREATE TABLE IF NOT EXISTS period_metrics(\n          id INTEGER PRIMARY KEY,\n          pharmacy_id INTEGER NOT NULL,\n          period_id INTEGER NOT NULL,\n          basis TEXT NOT NULL DEFAULT 'cash',\n          sales_cash REAL NOT NULL DEFAULT 0,\n          sales_ins REAL NOT NULL DEFAULT 0,\n          sales_total REAL NOT NULL DEFAULT 0,\n          var_total REAL NOT NULL DEFAULT 0,\n          fixed_rent REAL NOT NULL DEFAULT 0,\n          fixed_staff REAL NOT NULL DEFAULT 0,\n          fixed_total REAL NOT NULL DEFAULT 0,\n          opex_other_total REAL NOT NULL DEFAULT 0,\n          visits_total INTEGER NOT NULL DEFAULT 0,\n          days_count INTEGER NOT NULL DEFAULT 30,\n          gross_profit REAL NOT NULL DEFAULT 0,\n          net_profit_operational REAL NOT NULL DEFAULT 0,\n          contrib_margin REAL NOT NULL DEFAULT 0,\n          cm_ratio REAL NOT NULL DEFAULT 0,\n          breakeven_sales REAL NOT NULL DEFAULT 0,\n          avg_daily_sales REAL NOT NULL DEFAULT 0,\n          avg_sale_per_visit REAL NOT NULL DEFAULT 0,\n          computed_at TEXT,\n          locked_at TEXT,\n          UNIQUE (pharmacy_id, period_id, basis),\n          FOREIGN KEY(pharmacy_id) REFERENCES pharmacies(id),\n          FOREIGN KEY(period_id) REFERENCES periods(id)\n        );\n        """
+        )
+        # Add np_ratio column (net profit margin) if it does not exist. Probe
+        # the schema instead of letting a doomed ALTER fail on every startup.
+        cols = {r[1] for r in c.execute("PRAGMA table_info(period_metrics);")}
+        if "np_ratio" not in cols:
+            c.execute("ALTER TABLE period_metrics ADD COLUMN np_ratio REAL NOT NULL DEFAULT 0;")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_periods_pharmacy ON periods(pharmacy_id);")
+        c.execute(
+            """\n        CREATE INDEX IF NOT EXISTS idx_metrics_ppb\n        ON period_metrics(pharmacy_id, period_id, basis);\n        """
+        )
+        c.execute(
+            """\n        CREATE TABLE IF NOT EXISTS daily_logs(\n          id INTEGER PRIMARY KEY,\n          pharmacy_id INTEGER NOT NULL,\n          log_date TEXT NOT NULL,\n          sales_cash REAL NOT NULL DEFAULT 0,\n          sales_ins REAL NOT NULL DEFAULT 0,\n          var_purchases REAL NOT NULL DEFAULT 0,\n          opex_other REAL NOT NULL DEFAULT 0,\n          visits INTEGER NOT NULL DEFAULT 0,\n          note TEXT,\n          created_at TEXT NOT NULL DEFAULT (datetime('now')),\n          FOREIGN KEY(pharmacy_id) REFERENCES pharmacies(id),\n          UNIQUE (pharmacy_id, log_date)\n        );\n        """
+        )
+        c.execute(
+            """\n        CREATE INDEX IF NOT EXISTS idx_daily_logs_pharmacy_date\n        ON daily_logs(pharmacy_id, log_date);\n        """
+        )
+        # Covering index so daily range scans are answered from the index alone
+        # instead of hopping back to the table for every row.
+        c.execute(
+            """\n        CREATE INDEX IF NOT EXISTS idx_daily_logs_cover\n        ON daily_logs(pharmacy_id, log_date, sales_cash, sales_ins, var_purchases, opex_other, visits);\n        """
+        )
+        # Matches the ORDER BY in list_periods and the overlap probe in new_period.
+        c.execute(
+            """\n        CREATE INDEX IF NOT EXISTS idx_periods_pharmacy_start\n        ON periods(pharmacy_id, start_date DESC);\n        """
+        )
+        c.execute(
+            """\n        CREATE INDEX IF NOT EXISTS idx_periods_overlap\n        ON periods(pharmacy_id, end_date, start_date);\n        """
+        )
+        # Backs the ON CONFLICT target of the month-period upsert.
+        c.execute(
+            """\n        CREATE UNIQUE INDEX IF NOT EXISTS idx_periods_unique_bounds\n        ON periods(pharmacy_id, start_date, end_date);\n        """
+        )
+
+# Hot-path SQL lives in module-level constants so the exact same string
+# object reaches sqlite3 each call and the per-connection statement cache
+# (cached_statements=256) actually hits instead of re-parsing.
+_SQL_UPSERT_DAILY_LOG = """\n        INSERT INTO daily_logs(\n          pharmacy_id, log_date, sales_cash, sales_ins, var_purchases, opex_other, visits, note\n        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)\n        ON CONFLICT (pharmacy_id, log_date) DO UPDATE SET\n          sales_cash=excluded.sales_cash,\n          sales_ins=excluded.sales_ins,\n          var_purchases=excluded.var_purchases,\n          opex_other=excluded.opex_other,\n          visits=excluded.visits,\n          note=excluded.note;\n        """
+
+_SQL_DAILY_RANGE = """\n        SELECT *\n        FROM daily_logs\n        WHERE pharmacy_id = ? AND log_date BETWEEN ? AND ?\n        ORDER BY log_date ASC;\n        """
+
+_SQL_LAST_DAILY = """\n        SELECT *\n        FROM daily_logs\n        WHERE pharmacy_id = ? AND log_date BETWEEN ? AND ?\n        ORDER BY log_date DESC\n        LIMIT 1;\n        """
+
+_SQL_UPSERT_METRICS_CASH = """\n        INSERT INTO period_metrics(\n          pharmacy_id, period_id, basis,\n          sales_cash, sales_ins, sales_total,\n          var_total, fixed_rent, fixed_staff, fixed_total,\n          opex_other_total, visits_total, days_count,\n          gross_profit, net_profit_operational, contrib_margin,\n          cm_ratio, np_ratio, breakeven_sales,\n          avg_daily_sales, avg_sale_per_visit, computed_at\n        ) VALUES (?, ?, 'cash', ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))\n        ON CONFLICT (pharmacy_id, period_id, basis) DO UPDATE SET\n          sales_cash=excluded.sales_cash,\n          sales_ins=excluded.sales_ins,\n          sales_total=excluded.sales_total,\n          var_total=excluded.var_total,\n          fixed_rent=excluded.fixed_rent,\n          fixed_staff=excluded.fixed_staff,\n          fixed_total=excluded.fixed_total,\n          opex_other_total=excluded.opex_other_total,\n          visits_total=excluded.visits_total,\n          days_count=excluded.days_count,\n          gross_profit=excluded.gross_profit,\n          net_profit_operational=excluded.net_profit_operational,\n          contrib_margin=excluded.contrib_margin,\n          cm_ratio=excluded.cm_ratio,\n          np_ratio=excluded.np_ratio,\n          breakeven_sales=excluded.breakeven_sales,\n          avg_daily_sales=excluded.avg_daily_sales,\n          avg_sale_per_visit=excluded.avg_sale_per_visit,\n          computed_at=excluded.computed_at;\n        """
+
+_SQL_PERIOD_OVERLAP = """\n        SELECT id\n        FROM periods\n        WHERE pharmacy_id = ?\n          AND NOT (end_date < ? OR start_date > ?)\n        LIMIT 1;\n        """
+
+_SQL_INSERT_PERIOD = """\n        INSERT INTO periods(pharmacy_id, title, start_date, end_date, status, created_at)\n        VALUES (?, ?, ?, ?, 'open', datetime('now'));\n        """
+
+_SQL_PERIOD_BY_BOUNDS = """\n        SELECT id, title, start_date, end_date, status\n        FROM periods\n        WHERE pharmacy_id = ?\n          AND start_date = ?\n          AND end_date = ?;\n        """
+
+_SQL_LIST_PERIODS = """\n        SELECT id, title, start_date, end_date, status FROM periods\n        WHERE pharmacy_id = ?\n        ORDER BY start_date DESC;\n        """
+
+_SQL_GET_METRICS = """\n        SELECT * FROM period_metrics\n        WHERE pharmacy_id=? AND period_id=? AND basis='cash';\n        """
+
+def upsert_daily_logs_bulk(rows: List[tuple]) -> None:
+    """Upsert many daily-log rows in one transaction.
+
+    Each row is ``(pharmacy_id, log_date, sales_cash, sales_ins,
+    var_purchases, opex_other, visits, note)``. A single BEGIN IMMEDIATE
+    covers the whole batch, so bulk imports pay one write lock and one
+    fsync instead of one per row.
+    """
+    if not rows:
+        return
+    with write_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+        c.executemany(_SQL_UPSERT_DAILY_LOG, rows)
+
+_SQL_PERIOD_FOR_DATE = """\n        SELECT id, start_date, end_date FROM periods\n        WHERE pharmacy_id = ? AND start_date <= ? AND end_date >= ?\n        LIMIT 1;\n        """
+
+_SQL_DAILY_SUMS = """\n        SELECT\n          COALESCE(SUM(sales_cash), 0),\n          COALESCE(SUM(sales_ins), 0),\n          COALESCE(SUM(var_purchases), 0),\n          COALESCE(SUM(opex_other), 0),\n          COALESCE(SUM(visits), 0)\n        FROM daily_logs\n        WHERE pharmacy_id = ? AND log_date BETWEEN ? AND ?;\n        """
+
+def _refresh_period_metrics(c: sqlite3.Cursor, pharmacy_id: int, log_date: str) -> None:
+    """Recompute cash metrics for the period containing log_date.
+
+    Runs on the caller's cursor inside an already-open write transaction.
+    The sales/variable/visit totals are re-aggregated from the period's
+    daily logs; fixed costs and the configured day count are kept from the
+    existing metrics row since they are entered manually.
+    """
+    period = c.execute(_SQL_PERIOD_FOR_DATE, (pharmacy_id, log_date, log_date)).fetchone()
+    if period is None:
+        return
+    sums = c.execute(
+        _SQL_DAILY_SUMS, (pharmacy_id, period["start_date"], period["end_date"])
+    ).fetchone()
+    existing = c.execute(_SQL_GET_METRICS, (pharmacy_id, period["id"])).fetchone()
+    fixed_rent = float(existing["fixed_rent"]) if existing else 0.0
+    fixed_staff = float(existing["fixed_staff"]) if existing else 0.0
+    days_count = int(existing["days_count"]) if existing else 30
+    (
+        sales_total,
+        fixed_total,
+        gross_profit,
+        net_profit_operational,
+        contrib_margin,
+        cm_ratio,
+        np_ratio,
+        breakeven_sales,
+        avg_daily_sales,
+        avg_sale_per_visit,
+    ) = _compute_kpis(
+        float(sums[0]),
+        float(sums[1]),
+        float(sums[2]),
+        fixed_rent,
+        fixed_staff,
+        float(sums[3]),
+        float(sums[4]),
+        float(days_count),
+    )
+    c.execute(
+        _SQL_UPSERT_METRICS_CASH,
+        (
+            pharmacy_id,
+            period["id"],
+            sums[0],
+            sums[1],
+            sales_total,
+            sums[2],
+            fixed_rent,
+            fixed_staff,
+            fixed_total,
+            sums[3],
+            sums[4],
+            days_count,
+            gross_profit,
+            net_profit_operational,
+            contrib_margin,
+            cm_ratio,
+            np_ratio,
+            breakeven_sales,
+            avg_daily_sales,
+            avg_sale_per_visit,
+        ),
+    )
+
+def upsert_daily_log_with_metrics(
+    pharmacy_id: int,
+    log_date: str,
+    sales_cash: float = 0,
+    sales_ins: float = 0,
+    var_purchases: float = 0,
+    opex_other: float = 0,
+    visits: int = 0,
+    note: Optional[str] = None,
+) -> None:
+    """Upsert a daily log and refresh its period's cash metrics atomically.
+
+    Both writes share one BEGIN IMMEDIATE transaction (one fsync per user
+    interaction instead of two).
+    """
+    with write_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+        c.execute(
+            _SQL_UPSERT_DAILY_LOG,
+            (pharmacy_id, log_date, sales_cash, sales_ins, var_purchases, opex_other, visits, note),
+        )
+        _refresh_period_metrics(c, pharmacy_id, log_date)
+    _invalidate_metrics_cache(pharmacy_id)
+
+def flush_daily_rows(rows: List[tuple]) -> None:
+    """Upsert a batch of daily-log rows and refresh every touched period.
+
+    Used by the write-behind queue: one BEGIN IMMEDIATE covers the whole
+    batch, and each distinct (pharmacy, date) pair gets a single metrics
+    recomputation regardless of how many queued rows hit it.
+    """
+    if not rows:
+        return
+    with write_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+        c.executemany(_SQL_UPSERT_DAILY_LOG, rows)
+        for pharmacy_id, log_date in dict.fromkeys((r[0], r[1]) for r in rows):
+            _refresh_period_metrics(c, pharmacy_id, log_date)
+    for pharmacy_id in {r[0] for r in rows}:
+        _invalidate_metrics_cache(pharmacy_id)
+
+def upsert_daily_log(
+    pharmacy_id: int,
+    log_date: str,
+    sales_cash: float = 0,
+    sales_ins: float = 0,
+    var_purchases: float = 0,
+    opex_other: float = 0,
+    visits: int = 0,
+    note: Optional[str] = None,
+) -> None:
+    """Insert or update a daily log entry keyed by pharmacy and date."""
+    upsert_daily_logs_bulk(
+        [
+            (
+                pharmacy_id,
+                log_date,
+                sales_cash,
+                sales_ins,
+                var_purchases,
+                opex_other,
+                visits,
+                note,
+            )
+        ]
+    )
+
+def get_daily_range(
+    pharmacy_id: int, start_iso: str, end_iso: str
+) -> List[sqlite3.Row]:
+    """Return daily logs within an inclusive date range ordered by date."""
+    with read_conn_dict() as conn:
+        c = conn.cursor()
+        c.execute(
+            _SQL_DAILY_RANGE,
+            (pharmacy_id, start_iso, end_iso),
+        )
+        return c.fetchall()
+
+def get_last_daily_for_month(
+    pharmacy_id: int, start_iso: str, end_iso: str
+) -> Optional[sqlite3.Row]:
+    """Return the most recent daily log within the given inclusive range."""
+    with read_conn_dict() as conn:
+        c = conn.cursor()
+        c.execute(
+            _SQL_LAST_DAILY,
+            (pharmacy_id, start_iso, end_iso),
+        )
+        return c.fetchone()
+
+def _compute_kpis(
+    sales_cash: float,
+    sales_ins: float,
+    var_total: float,
+    fixed_rent: float,
+    fixed_staff: float,
+    opex_other_total: float,
+    visits_total: float,
+    days_count: float,
+) -> tuple:
+    """Pure-numeric KPI kernel; branch-light so it JIT-compiles cleanly."""
+    sales_total = sales_cash + sales_ins
+    fixed_total = fixed_rent + fixed_staff
+    gross_profit = sales_total - var_total
+    net_profit_operational = gross_profit - fixed_total - opex_other_total
+    contrib_margin = gross_profit
+    cm_ratio = gross_profit / sales_total if sales_total > 0 else 0.0
+    np_ratio = net_profit_operational / sales_total if sales_total > 0 else 0.0
+    breakeven_sales = fixed_total / cm_ratio if cm_ratio > 0 else 0.0
+    avg_daily_sales = sales_total / days_count if days_count > 0 else 0.0
+    avg_sale_per_visit = sales_total / visits_total if visits_total > 0 else 0.0
+    return (
+        sales_total,
+        fixed_total,
+        gross_profit,
+        net_profit_operational,
+        contrib_margin,
+        cm_ratio,
+        np_ratio,
+        breakeven_sales,
+        avg_daily_sales,
+        avg_sale_per_visit,
+    )
+
+try:  # optional, like jdatetime: compile the kernel when numba is present
+    from numba import njit
+    _compute_kpis = njit(cache=True, fastmath=True)(_compute_kpis)
+except Exception:
+    pass
+
+def upsert_metrics_cash(
+    pharmacy_id: int,
+    period_id: int,
+    sales_cash: float,
+    sales_ins: float,
+    var_total: float,
+    fixed_rent: float,
+    fixed_staff: float,
+    opex_other_total: float,
+    visits_total: int,
+    days_count: int,
+) -> None:
+    """Insert or update cash‑basis metrics with the derived KPIs in one write."""
+    (
+        sales_total,
+        fixed_total,
+        gross_profit,
+        net_profit_operational,
+        contrib_margin,
+        cm_ratio,
+        np_ratio,
+        breakeven_sales,
+        avg_daily_sales,
+        avg_sale_per_visit,
+    ) = _compute_kpis(
+        float(sales_cash or 0.0),
+        float(sales_ins or 0.0),
+        float(var_total or 0.0),
+        float(fixed_rent or 0.0),
+        float(fixed_staff or 0.0),
+        float(opex_other_total or 0.0),
+        float(visits_total or 0),
+        float(days_count or 0),
+    )
+    with write_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+        c.execute(
+            _SQL_UPSERT_METRICS_CASH,
+            (
+                pharmacy_id,
+                period_id,
+                sales_cash,
+                sales_ins,
+                sales_total,
+                var_total,
+                fixed_rent,
+                fixed_staff,
+                fixed_total,
+                opex_other_total,
+                visits_total,
+                days_count,
+                gross_profit,
+                net_profit_operational,
+                contrib_margin,
+                cm_ratio,
+                np_ratio,
+                breakeven_sales,
+                avg_daily_sales,
+                avg_sale_per_visit,
+            ),
+        )
+    _invalidate_metrics_cache(pharmacy_id)
+
+# Keyboard renders re-read the pharmacy/period lists on every button press
+# while the underlying rows only change on explicit admin actions, so keep
+# materialised dict copies in memory and invalidate on write.
+_pharm_cache: Optional[List[tuple]] = None
+_period_cache: dict[int, List[tuple]] = {}
+_cache_lock = threading.Lock()
+
+def _invalidate_pharm_cache() -> None:
+    global _pharm_cache
+    with _cache_lock:
+        _pharm_cache = None
+
+def _invalidate_period_cache(pharmacy_id: Optional[int] = None) -> None:
+    with _cache_lock:
+        if pharmacy_id is None:
+            _period_cache.clear()
+        else:
+            _period_cache.pop(pharmacy_id, None)
+
+def new_pharmacy(title: str) -> int:
+    """Create a new pharmacy entry and return its id (raises on failure)."""
+    with write_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+        c.execute("INSERT INTO pharmacies(title, created_at) VALUES (?, datetime('now'));", (title,))
+        last = c.lastrowid
+        if last is None:
+            raise RuntimeError("Failed to create pharmacy record")
+    _invalidate_pharm_cache()
+    return int(last)
+
+_SQL_PHARMACY_TITLE = "SELECT title FROM pharmacies WHERE id=?;"
+
+def get_pharmacy_title(pharmacy_id: int) -> Optional[str]:
+    """Return a pharmacy's title, preferring the cached list over a query."""
+    with _cache_lock:
+        cached = _pharm_cache
+    if cached is not None:
+        for pid, title in cached:
+            if pid == pharmacy_id:
+                return title
+    with read_conn() as conn:
+        c = conn.cursor()
+        c.execute(_SQL_PHARMACY_TITLE, (pharmacy_id,))
+        row = c.fetchone()
+    return row[0] if row else None
+
+def list_pharmacies() -> List[tuple]:
+    """Return (id, title) tuples for all pharmacies in descending order of ID."""
+    global _pharm_cache
+    with _cache_lock:
+        cached = _pharm_cache
+    if cached is not None:
+        return cached
+    with read_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT id, title FROM pharmacies ORDER BY id DESC;")
+        rows = c.fetchall()
+    with _cache_lock:
+        _pharm_cache = rows
+    return rows
+
+PERIOD_OVERLAP_MESSAGE = "❗ این بازه زمانی با یک دورهٔ دیگر هم‌پوشانی دارد."
+
+class PeriodOverlapError(Exception):
+    """Raised when attempting to create a period that overlaps an existing one."""
+
+    def __init__(self, message: str = PERIOD_OVERLAP_MESSAGE) -> None:
+        super().__init__(message)
+
+def new_period(pharmacy_id: int, title: str, start_date: str, end_date: str) -> int:
+    """Insert a new period for a given pharmacy.\n\n    Raises:\n        PeriodOverlapError: If the proposed date range overlaps an existing period.\n    """
+    with write_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+        # Prevent overlapping periods for the same pharmacy by checking whether any existing
+        # period intersects the requested inclusive date range before inserting.
+        c.execute(
+            _SQL_PERIOD_OVERLAP,
+            (pharmacy_id, start_date, end_date),
+        )
+        overlap = c.fetchone()
+        if overlap:
+            raise PeriodOverlapError()
+        c.execute(
+            _SQL_INSERT_PERIOD,
+            (pharmacy_id, title, start_date, end_date),
+        )
+        last = c.lastrowid
+    _invalidate_period_cache(pharmacy_id)
+    _lookup_period_by_jalali.cache_clear()
+    return last
+
+def find_period_by_bounds(
+    pharmacy_id: int, start_iso: str, end_iso: str
+) -> Optional[dict]:
+    """Return the period row (as dict) matching the inclusive ISO bounds, if any."""
+    with read_conn_dict() as conn:
+        c = conn.cursor()
+        c.execute(
+            _SQL_PERIOD_BY_BOUNDS,
+            (pharmacy_id, start_iso, end_iso),
+        )
+        row = c.fetchone()
+        return dict(row) if row else None
+
+_SQL_PERIODS_BY_BOUNDS_BATCH = """\n        SELECT id, title, start_date, end_date, status\n        FROM periods\n        WHERE pharmacy_id = ?\n          AND (start_date, end_date) IN (VALUES (?, ?), (?, ?));\n        """
+
+def find_periods_by_bounds_pair(
+    pharmacy_id: int,
+    first: tuple[str, str],
+    second: tuple[str, str],
+) -> dict[tuple[str, str], dict]:
+    """Look up two periods by their inclusive ISO bounds in one query.
+
+    Returns a dict keyed by (start_iso, end_iso); missing months are simply
+    absent. Used by the compare handlers, which would otherwise issue two
+    sequential round-trips per tap.
+    """
+    with read_conn_dict() as conn:
+        c = conn.cursor()
+        c.execute(
+            _SQL_PERIODS_BY_BOUNDS_BATCH,
+            (pharmacy_id, first[0], first[1], second[0], second[1]),
+        )
+        return {(row["start_date"], row["end_date"]): dict(row) for row in c.fetchall()}
+
+# Keyboard renders ask for the same (pharmacy, jalali month) period over and
+# over; memoise the bounds computation + DB probe and clear on period writes.
+@lru_cache(maxsize=4096)
+def _lookup_period_by_jalali(pharmacy_id: int, jy: int, jm: int) -> Optional[dict]:
+    start_date, end_date, _ = jalali_month_bounds(jy, jm)
+    return find_period_by_bounds(pharmacy_id, start_date.isoformat(), end_date.isoformat())
+
+def get_period_by_jalali(pharmacy_id: int, jy: int, jm: int) -> Optional[dict]:
+    """Return the period dict for the given Jalali year/month if it exists."""
+    return _lookup_period_by_jalali(pharmacy_id, jy, jm)
+
+def list_periods(pharmacy_id: int) -> List[tuple]:
+    """Return (id, title, start_date, end_date, status) tuples, newest first."""
+    with _cache_lock:
+        cached = _period_cache.get(pharmacy_id)
+    if cached is not None:
+        return cached
+    with read_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            _SQL_LIST_PERIODS,
+            (pharmacy_id,),
+        )
+        rows = c.fetchall()
+    with _cache_lock:
+        _period_cache[pharmacy_id] = rows
+    return rows
+
+# Period rows are re-fetched by every report/sim/PDF callback but only
+# change via set_period_status; cache them like the metrics rows.
+_period_row_cache: dict[int, sqlite3.Row] = {}
+
+def _invalidate_period_row_cache() -> None:
+    with _cache_lock:
+        _period_row_cache.clear()
+
+def get_period(period_id: int) -> Optional[sqlite3.Row]:
+    """Retrieve a single period by its ID."""
+    with _cache_lock:
+        cached = _period_row_cache.get(period_id)
+    if cached is not None:
+        return cached
+    with read_conn_dict() as conn:
+        c = conn.cursor()
+        c.execute("SELECT * FROM periods WHERE id=?;", (period_id,))
+        row = c.fetchone()
+    if row is not None:
+        with _cache_lock:
+            _period_row_cache[period_id] = row
+    return row
+
+# Metrics rows are read on every summary/compare/report tap but only change
+# on our own writes, so they are cached like the pharmacy/period lists with
+# explicit invalidation. Misses (no row yet) are not cached.
+_metrics_cache: dict[tuple[int, int], sqlite3.Row] = {}
+
+def _invalidate_metrics_cache(pharmacy_id: Optional[int] = None) -> None:
+    with _cache_lock:
+        if pharmacy_id is None:
+            _metrics_cache.clear()
+        else:
+            for key in [k for k in _metrics_cache if k[0] == pharmacy_id]:
+                del _metrics_cache[key]
+
+def get_metrics(pharmacy_id: int, period_id: int) -> Optional[sqlite3.Row]:
+    """Get the metrics row for a given pharmacy and period using cash basis."""
+    key = (pharmacy_id, period_id)
+    with _cache_lock:
+        cached = _metrics_cache.get(key)
+    if cached is not None:
+        return cached
+    with read_conn_dict() as conn:
+        c = conn.cursor()
+        c.execute(
+            _SQL_GET_METRICS,
+            (pharmacy_id, period_id),
+        )
+        row = c.fetchone()
+    if row is not None:
+        with _cache_lock:
+            _metrics_cache[key] = row
+    return row
+
+_SQL_METRICS_WITH_PERIOD = """\n        SELECT m.*, p.title, p.start_date, p.end_date, p.status\n        FROM period_metrics m\n        JOIN periods p ON p.id = m.period_id\n        WHERE m.pharmacy_id=? AND m.period_id=? AND m.basis='cash';\n        """
+
+def get_metrics_with_period(pharmacy_id: int, period_id: int) -> Optional[sqlite3.Row]:
+    """Fetch the cash-basis metrics row joined with its period in one query.\n\n    The returned row carries both column sets, so render paths that need\n    metrics and period fields can share it instead of issuing two SELECTs.\n    """
+    with read_conn_dict() as conn:
+        c = conn.cursor()
+        c.execute(_SQL_METRICS_WITH_PERIOD, (pharmacy_id, period_id))
+        return c.fetchone()
+
+_SQL_SET_PERIOD_STATUS = "UPDATE periods SET status=? WHERE id=?;"
+
+_SQL_LOCK_PERIOD_METRICS = """\n            UPDATE period_metrics\n            SET locked_at = datetime('now')\n            WHERE period_id = ? AND basis = 'cash';\n            """
+
+def set_period_status(period_id: int, status: str) -> None:
+    """Update a period's status and lock metrics if closed.
+
+    Both UPDATEs run inside one BEGIN IMMEDIATE transaction, so closing a
+    period hits the WAL as a single group commit and readers never observe
+    a closed period whose metrics are still unlocked.
+    """
+    with write_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+        c.execute(_SQL_SET_PERIOD_STATUS, (status, period_id))
+        if status == "closed":
+            c.execute(_SQL_LOCK_PERIOD_METRICS, (period_id,))
+    # The period/metrics caches key by pharmacy, which isn't known here; drop all.
+    _invalidate_period_cache()
+    _invalidate_period_row_cache()
+    _invalidate_metrics_cache()
+    _lookup_period_by_jalali.cache_clear()
+
+
+# The DB helpers above are synchronous sqlite3 calls. Async handlers go
+# through these thin wrappers so queries run on a worker thread and the
+# event loop keeps serving other updates while SQLite works. A dedicated
+# executor (sized to the read pool) keeps DB work from starving the default
+# executor PTB uses for its own blocking calls.
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="finbot-db")
+
+async def _adb(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    if kwargs:
+        return await loop.run_in_executor(_DB_EXECUTOR, partial(fn, *args, **kwargs))
+    return await loop.run_in_executor(_DB_EXECUTOR, fn, *args)
+
+async def a_list_pharmacies() -> List[dict]:
+    return await _adb(list_pharmacies)
+
+async def a_get_pharmacy_title(pharmacy_id: int) -> Optional[str]:
+    return await _adb(get_pharmacy_title, pharmacy_id)
+
+async def a_list_periods(pharmacy_id: int) -> List[dict]:
+    return await _adb(list_periods, pharmacy_id)
+
+async def a_get_period(period_id: int) -> Optional[sqlite3.Row]:
+    return await _adb(get_period, period_id)
+
+async def a_get_metrics(pharmacy_id: int, period_id: int) -> Optional[sqlite3.Row]:
+    return await _adb(get_metrics, pharmacy_id, period_id)
+
+async def a_get_metrics_with_period(pharmacy_id: int, period_id: int) -> Optional[sqlite3.Row]:
+    return await _adb(get_metrics_with_period, pharmacy_id, period_id)
+
+async def a_get_daily_range(pharmacy_id: int, start_iso: str, end_iso: str) -> List[sqlite3.Row]:
+    return await _adb(get_daily_range, pharmacy_id, start_iso, end_iso)
+
+async def a_find_period_by_bounds(pharmacy_id: int, start_iso: str, end_iso: str) -> Optional[dict]:
+    return await _adb(find_period_by_bounds, pharmacy_id, start_iso, end_iso)
+
+async def a_find_periods_by_bounds_pair(
+    pharmacy_id: int, first: tuple[str, str], second: tuple[str, str]
+) -> dict[tuple[str, str], dict]:
+    return await _adb(find_periods_by_bounds_pair, pharmacy_id, first, second)
+
+async def a_get_period_by_jalali(pharmacy_id: int, jy: int, jm: int) -> Optional[dict]:
+    return await _adb(get_period_by_jalali, pharmacy_id, jy, jm)
+
+async def a_upsert_daily_log(*args, **kwargs) -> None:
+    await _adb(upsert_daily_log, *args, **kwargs)
+
+async def a_upsert_daily_log_with_metrics(*args, **kwargs) -> None:
+    await _adb(upsert_daily_log_with_metrics, *args, **kwargs)
+
+async def a_upsert_metrics_cash(*args, **kwargs) -> None:
+    await _adb(upsert_metrics_cash, *args, **kwargs)
+
+async def a_new_period(pharmacy_id: int, title: str, start_date: str, end_date: str) -> int:
+    return await _adb(new_period, pharmacy_id, title, start_date, end_date)
+
+async def a_set_period_status(period_id: int, status: str) -> None:
+    await _adb(set_period_status, period_id, status)
+
+# Write-behind queue for daily-log upserts. The handler enqueues its row and
+# confirms to the user immediately; a background task drains the queue and
+# batches rows into a single transaction via flush_daily_rows(), so disk I/O
+# amortises across concurrent users instead of gating each reply.
+_WRITE_FLUSH_INTERVAL = 0.1  # seconds to wait for more rows before flushing
+_WRITE_FLUSH_BATCH = 64  # max rows per transaction
+_write_queue: Optional[asyncio.Queue] = None
+_write_flusher: Optional[asyncio.Task] = None
+
+async def _flush_writes() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        rows = [await _write_queue.get()]
+        deadline = loop.time() + _WRITE_FLUSH_INTERVAL
+        try:
+            while len(rows) < _WRITE_FLUSH_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(await asyncio.wait_for(_write_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await _adb(flush_daily_rows, rows)
+        except asyncio.CancelledError:
+            # Cancelled mid-batch: the user was already told these rows were
+            # saved, so hand them back to the queue for drain_write_queue()
+            # to flush. The upsert is last-write-wins per (pharmacy, date),
+            # so a flush that was already in flight makes the requeue a
+            # harmless rewrite rather than a double count.
+            for row in rows:
+                _write_queue.put_nowait(row)
+            raise
+        except Exception:
+            logger.exception("Write-behind flush failed for %d row(s)", len(rows))
+
+async def enqueue_daily_log(
+    pharmacy_id: int,
+    log_date: str,
+    sales_cash: float = 0,
+    sales_ins: float = 0,
+    var_purchases: float = 0,
+    opex_other: float = 0,
+    visits: int = 0,
+    note: Optional[str] = None,
+) -> None:
+    """Queue a daily-log upsert for the background flusher."""
+    global _write_queue, _write_flusher
+    if _write_queue is None:
+        _write_queue = asyncio.Queue()
+        _write_flusher = asyncio.create_task(_flush_writes())
+    await _write_queue.put(
+        (pharmacy_id, log_date, sales_cash, sales_ins, var_purchases, opex_other, visits, note)
+    )
+
+async def drain_write_queue() -> None:
+    """Stop the flusher and write out anything still queued (shutdown hook)."""
+    global _write_flusher
+    if _write_flusher is not None:
+        _write_flusher.cancel()
+        try:
+            await _write_flusher
+        except asyncio.CancelledError:
+            pass
+        _write_flusher = None
+    if _write_queue is None:
+        return
+    rows = []
+    while not _write_queue.empty():
+        rows.append(_write_queue.get_nowait())
+    if rows:
+        await _adb(flush_daily_rows, rows)
+
+# The cached markups below are shared between calls; callers must treat them
+# as immutable (PTB only serialises them, it never mutates).
+@lru_cache(maxsize=1)
+def main_menu_kb():
+    """Keyboard with a single option to add a pharmacy."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("➕ افزودن داروخانه", callback_data=make_cb(TAG_PHARM_NEW))]])
+
+def make_cb(tag: str, *parts: object) -> str:
+    # Keyboard renders call this once per button; specialise the 1-2 part
+    # cases into single f-strings and keep the generic join (map avoids a
+    # generator frame) for the rare wider callbacks.
+    if not parts:
+        return tag
+    if len(parts) == 1:
+        return f"{tag}:{parts[0]}"
+    if len(parts) == 2:
+        return f"{tag}:{parts[0]}:{parts[1]}"
+    return tag + ":" + ":".join(map(str, parts))
+
+def pharm_list_kb():
+    """Keyboard listing existing pharmacies with an option to add a new one."""
+    rows = []
+    for pid, title in list_pharmacies():
+        rows.append([
+            InlineKeyboardButton(
+                f"🏥 {title} (#{pid})",
+                callback_data=make_cb(TAG_PHARM_SELECT, pid),
+            )
+        ])
+    rows.append([InlineKeyboardButton("➕ افزودن داروخانه", callback_data=make_cb(TAG_PHARM_NEW))])
+    return InlineKeyboardMarkup(rows)
+
+def period_list_kb(pharmacy_id: int):
+    """Keyboard listing periods for a pharmacy with controls to add or return."""
+    rows = []
+    for period_id, title, start_date, end_date, status in list_periods(pharmacy_id):
+        badge = (
+            "?? ???"
+            if status == "open"
+            else ("?? ?? ?????? ?????" if status == "pending_approval" else "?? ????")
+        )
+        rows.append([
+            InlineKeyboardButton(
+                f"{badge} {title} ({start_date} - {end_date})",
+                callback_data=make_cb(TAG_PERIOD_SELECT, pharmacy_id, period_id),
+            )
+        ])
+    rows.append([InlineKeyboardButton("?? ????? ????", callback_data=make_cb(TAG_PERIOD_NEW, pharmacy_id))])
+    rows.append([InlineKeyboardButton("?? ??????", callback_data=TAG_HOME)])
+    return InlineKeyboardMarkup(rows)
+
+def month_actions_kb(pharmacy_id: int, jy: int, jm: int, period_id: int | None = None, status: str | None = None) -> tuple[InlineKeyboardMarkup, int, str, str]:
+    """Create the period actions keyboard and ensure the backing period exists."""
+    if period_id is None or status is None:
+        period_id, status, _, _, _ = get_or_create_month_period(pharmacy_id, jy, jm)
+    month_name = _month_name(jm)
+    if status == "closed":
+        rows = [
+            [InlineKeyboardButton("?? ????? ???", callback_data=make_cb(TAG_REPORT_VIEW, pharmacy_id, period_id))],
+            [InlineKeyboardButton("?? PDF ????", callback_data=make_cb(TAG_PDF_SIMPLE, pharmacy_id, period_id))],
+            [InlineKeyboardButton("?? ????? ?????", callback_data=make_cb(TAG_WEEKLY_REPORT, pharmacy_id, period_id))],
+            [InlineKeyboardButton("?? ?????? ?? ??? ???", callback_data=make_cb(TAG_COMPARE_PREV, pharmacy_id, jy, jm))],
+            [InlineKeyboardButton("?? ?????? ?? ??? ????", callback_data=make_cb(TAG_COMPARE_MONTHS, pharmacy_id, jy, jm))],
+        ]
+        rows.append([InlineKeyboardButton("💳 ثبت چک", callback_data=make_cb(TAG_CHECK_START, pharmacy_id))])
+        rows.append([InlineKeyboardButton("📊 خلاصه ماه", callback_data=make_cb(TAG_SUMMARY_START, pharmacy_id))])
+    else:
+        rows = [
+            [
+                InlineKeyboardButton("?? ???/?????? ?????", callback_data=f"fin.entry.menu:{pharmacy_id}:{period_id}"),
+                InlineKeyboardButton("📥 ثبت اطلاعات مالی", callback_data=make_cb(TAG_DAILY_START, pharmacy_id)),
+            ],
+            [
+                InlineKeyboardButton("?? ?????? ??????", callback_data=f"fin.entry.recompute:{pharmacy_id}:{period_id}"),
+                InlineKeyboardButton("?? ????? ???", callback_data=make_cb(TAG_REPORT_VIEW, pharmacy_id, period_id)),
+            ],
+            [
+                InlineKeyboardButton("?? ????? ?????", callback_data=make_cb(TAG_WEEKLY_REPORT, pharmacy_id, period_id)),
+                InlineKeyboardButton("?? ?????? ?? ??? ???", callback_data=make_cb(TAG_COMPARE_PREV, pharmacy_id, jy, jm)),
+            ],
+            [
+                InlineKeyboardButton("?? ?????? ?? ??? ????", callback_data=make_cb(TAG_COMPARE_MONTHS, pharmacy_id, jy, jm)),
+                InlineKeyboardButton("?? PDF ????", callback_data=make_cb(TAG_PDF_SIMPLE, pharmacy_id, period_id)),
+            ],
+            [InlineKeyboardButton("?? ??????? ????", callback_data=make_cb(TAG_SIM_MENU, pharmacy_id, period_id))],
+        ]
+        rows.append([InlineKeyboardButton("💳 ثبت چک", callback_data=make_cb(TAG_CHECK_START, pharmacy_id))])
+        rows.append([InlineKeyboardButton("📊 خلاصه ماه", callback_data=make_cb(TAG_SUMMARY_START, pharmacy_id))])
+    rows.append([InlineKeyboardButton("?? ??????", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))])
+    return InlineKeyboardMarkup(rows), period_id, status, month_name
+
+def period_actions_kb(pharmacy_id: int, period_id: int, status: str) -> InlineKeyboardMarkup:
+    period_row = get_period(period_id)
+    if not period_row:
+        return _back_markup("?? ??????", TAG_PHARM_SELECT, pharmacy_id)
+    start_iso = _get(period_row, "start_date", None) or date.today().isoformat()
+    jy, jm, _ = _iso_to_jalali(start_iso)
+    keyboard, _, _, _ = month_actions_kb(pharmacy_id, jy, jm, period_id=period_id, status=status)
+    return keyboard
+
+@lru_cache(maxsize=4096)
+def entry_menu_kb(pharmacy_id: int, period_id: int):
+    """Keyboard for entering or editing numeric values for a period."""
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    "💵 فروش نقدی",
+                    callback_data=f"fin.entry.set:sales_cash:{pharmacy_id}:{period_id}",
+                ),
+                InlineKeyboardButton(
+                    "🏦 واریزی بیمه",
+                    callback_data=f"fin.entry.set:sales_ins:{pharmacy_id}:{period_id}",
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    "🧪 خرید (متغیر)",
+                    callback_data=f"fin.entry.set:var_total:{pharmacy_id}:{period_id}",
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "🏠 اجاره", callback_data=f"fin.entry.set:fixed_rent:{pharmacy_id}:{period_id}"
+                ),
+                InlineKeyboardButton(
+                    "👥 حقوق پرسنل", callback_data=f"fin.entry.set:fixed_staff:{pharmacy_id}:{period_id}"
+                ),
+            ],
+            [
+                InlineKeyboardButton(
+                    "🧾 سایر هزینه‌ها", callback_data=f"fin.entry.set:opex_other_total:{pharmacy_id}:{period_id}"
+                )
+            ],
+            [
+                InlineKeyboardButton(
+                    "👣 تعداد مراجعه", callback_data=f"fin.entry.set:visits_total:{pharmacy_id}:{period_id}"
+                ),
+                InlineKeyboardButton(
+                    "📅 روزهای دوره", callback_data=f"fin.entry.set:days_count:{pharmacy_id}:{period_id}"
+                ),
+            ],
+            [InlineKeyboardButton("🔄 محاسبهٔ دوباره", callback_data=f"fin.entry.recompute:{pharmacy_id}:{period_id}")],
+            [InlineKeyboardButton("◀️ بازگشت", callback_data=make_cb(TAG_PERIOD_SELECT, pharmacy_id, period_id))],
+        ]
+    )
+
+@owner_only_access
+async def cb_daily_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Start the simplified daily data entry flow by asking for the date."""
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    match = _CB_DAILY_START_RE.match(data)
+    if not match:
+        return
+    pharmacy_id = int(match.group(1))
+    state = {
+        "pharmacy_id": pharmacy_id,
+        "step": 0,
+        "date": None,
+        "data": {},
+    }
+    if context.user_data is not None:
+        context.user_data["daily"] = state
+    jy, jm, _ = gregorian_to_jalali(date.today())
+    keyboard = daily_day_picker_kb(jy, jm, tag=TAG_DAILY_FLOW_PICK_DAY, extra=str(pharmacy_id))
+    await safe_edit(
+        message,
+        "روز مورد نظر را انتخاب کن:",
+        reply_markup=keyboard,
+        context=context,
+        log_context="cb_daily_start",
+    )
+
+@owner_only_access
+async def cb_daily_pick_day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle day selection for the simplified daily flow."""
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    # Fixed "tag:YYYY-MM-DD:pharmacy_id" shape: a C-level split with
+    # fromisoformat/int validation is far cheaper than the regex engine here.
+    tag, _, rest = data.partition(":")
+    if tag != TAG_DAILY_FLOW_PICK_DAY:
+        return
+    date_str, _, pharm = rest.partition(":")
+    try:
+        date.fromisoformat(date_str)
+        pharmacy_id = int(pharm)
+    except ValueError:
+        return
+    daily_state = context.user_data.get("daily") if context.user_data is not None else None
+    if not daily_state or daily_state.get("pharmacy_id") != pharmacy_id:
+        return
+    daily_state["date"] = date_str
+    daily_state["step"] = 1
+    await safe_edit(
+        message,
+        f"📆 تاریخ انتخاب شد: {to_persian_digits(date_str)}",
+        reply_markup=None,
+        context=context,
+        log_context="cb_daily_flow_pick_day_edit",
+    )
+    await safe_reply(
+        message,
+        "مقدار فروش نقدی (تومان) را وارد کن:",
+        reply_markup=ForceReply(selective=True),
+        context=context,
+        log_context="cb_daily_flow_pick_day_prompt",
+    )
+
+# Prompt sequence for the daily flow; constant, so built once instead of
+# per incoming message.
+_DAILY_FIELDS: tuple[tuple[str, str], ...] = (
+    ("sales_cash", "مقدار فروش بیمه‌ای (تومان) را وارد کن:"),
+    ("sales_ins", "تعداد ویزیت را وارد کن:"),
+    ("visits", "مقدار هزینه ثابت را وارد کن:"),
+    ("fixed_cost", "✅ ثبت شد. اطلاعات ذخیره شد."),
+)
+
+@owner_only_access
+async def msg_daily_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle replies for the simplified daily data entry flow."""
+    message = update.effective_message
+    if not message:
+        return
+    daily_state = context.user_data.get("daily") if context.user_data is not None else None
+    if not daily_state or "step" not in daily_state or "data" not in daily_state:
+        return
+    if not message.text:
+        return
+    text = message.text.strip()
+    try:
+        value, err = parse_smart_number(text, as_int=True)
+    except Exception:
+        value, err = None, "مقدار نامعتبر است."
+    if err:
+        await safe_reply(
+            message,
+            "❗ مقدار نامعتبر است. دوباره تلاش کن:",
+            reply_markup=ForceReply(selective=True),
+            context=context,
+            log_context="msg_daily_flow_invalid",
+        )
+        return
+    step = daily_state.get("step", 0)
+    if step < 1 or step > len(_DAILY_FIELDS):
+        await safe_reply(
+            message,
+            "این مرحله ناشناخته است.",
+            context=context,
+            log_context="msg_daily_flow_unknown_step",
+        )
+        if context.user_data is not None:
+            context.user_data.pop("daily", None)
+        return
+    key, next_prompt = _DAILY_FIELDS[step - 1]
+    daily_state["data"][key] = int(value)
+    if step < len(_DAILY_FIELDS):
+        # Intermediate step: just advance and prompt for the next field.
+        daily_state["step"] = step + 1
+        await safe_reply(
+            message,
+            next_prompt,
+            reply_markup=ForceReply(selective=True),
+            context=context,
+            log_context="msg_daily_flow_next_prompt",
+        )
+        return
+    await _daily_flow_finalize(daily_state, message, context)
+
+async def _daily_flow_finalize(daily_state: dict, message, context) -> None:
+    """Last daily-flow step: queue the write and confirm, no prompt keyboard."""
+    payload = daily_state["data"]
+    pharmacy_id = daily_state["pharmacy_id"]
+    log_date = daily_state.get("date") or date.today().isoformat()
+    sales_cash = float(payload.get("sales_cash", 0))
+    sales_ins = float(payload.get("sales_ins", 0))
+    visits = int(payload.get("visits", 0))
+    fixed_cost = float(payload.get("fixed_cost", 0))
+    await enqueue_daily_log(
+        pharmacy_id,
+        log_date,
+        sales_cash,
+        sales_ins,
+        0.0,
+        fixed_cost,
+        visits,
+        None,
+    )
+    summary = "\n".join(
+        [
+            "✅ ثبت روزانه انجام شد.",
+            f"📆 تاریخ: {to_persian_digits(log_date)}",
+            f"💵 فروش نقدی: {fmt_money(sales_cash)} تومان",
+            f"💳 فروش بیمه‌ای: {fmt_money(sales_ins)} تومان",
+            f"👥 تعداد ویزیت: {visits}",
+            f"🏦 هزینه ثابت: {fmt_money(fixed_cost)} تومان",
+        ]
+    )
+    await safe_reply(
+        message,
+        summary,
+        context=context,
+        log_context="msg_daily_flow_complete",
+    )
+    if context.user_data is not None:
+        context.user_data.pop("daily", None)
+
+@owner_only_access
+async def cb_summary_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Prompt the user to pick a month for the monthly summary."""
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    match = _CB_SUMMARY_START_RE.match(data)
+    if not match:
+        return
+    pharmacy_id = int(match.group(1))
+    jy, _, _ = gregorian_to_jalali(date.today())
+    keyboard = month_picker_kb(jy, tag=TAG_SUMMARY_PICK_MONTH, extra=str(pharmacy_id))
+    rows = list(keyboard.inline_keyboard) if keyboard.inline_keyboard else []
+    rows.append((InlineKeyboardButton("بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id)),))
+    keyboard = InlineKeyboardMarkup(rows)
+    await safe_edit(
+        message,
+        "ماه مورد نظر برای خلاصه را انتخاب کن:",
+        reply_markup=keyboard,
+        context=context,
+        log_context="cb_summary_start",
+    )
+
+@lru_cache(maxsize=4096)
+def _back_markup(label: str, tag: str, *ids: int) -> InlineKeyboardMarkup:
+    """Shared single back-button markup; PTB serializes these without mutation."""
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=make_cb(tag, *ids))]])
+
+@lru_cache(maxsize=1024)
+def summary_nav_kb(pharmacy_id: int) -> InlineKeyboardMarkup:
+    """Shared 'pick another month / back' markup for the summary flow."""
+    return InlineKeyboardMarkup(
+        [
+            [InlineKeyboardButton("🔁 انتخاب ماه دیگر", callback_data=make_cb(TAG_SUMMARY_START, pharmacy_id))],
+            [InlineKeyboardButton("بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))],
+        ]
+    )
+
+@owner_only_access
+async def cb_summary_pick_month(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Render the monthly summary for the chosen Jalali month."""
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    tag, _, rest = data.partition(":")
+    if tag != TAG_SUMMARY_PICK_MONTH:
+        return
+    month_part, _, pharm = rest.partition(":")
+    try:
+        jy, jm = (int(p) for p in month_part.split("-", 1))
+        pharmacy_id = int(pharm)
+    except ValueError:
+        return
+    period = await a_get_period_by_jalali(pharmacy_id, jy, jm)
+    if not period:
+        await safe_edit(
+            message,
+            "❗ برای این ماه هنوز دوره‌ای ثبت نشده است.",
+            reply_markup=summary_nav_kb(pharmacy_id),
+            context=context,
+            log_context="cb_summary_pick_month_missing_period",
+        )
+        return
+    metrics_row = await a_get_metrics(pharmacy_id, period["id"])
+    if not metrics_row:
+        await safe_edit(
+            message,
+            "❗ برای این ماه هنوز متریک‌ها محاسبه نشده‌اند.",
+            reply_markup=summary_nav_kb(pharmacy_id),
+            context=context,
+            log_context="cb_summary_pick_month_missing_metrics",
+        )
+        return
+    sales_cash = float(_get(metrics_row, "sales_cash"))
+    sales_ins = float(_get(metrics_row, "sales_ins"))
+    sales_total = float(_get(metrics_row, "sales_total"))
+    visits_total = int(_get(metrics_row, "visits_total"))
+    fixed_total = float(_get(metrics_row, "fixed_total"))
+    gross_profit = float(_get(metrics_row, "gross_profit"))
+    checks_total: float | None = None  # Placeholder until check storage is implemented.
+    prev_jy, prev_jm = (jy - 1, 12) if jm == 1 else (jy, jm - 1)
+    prev_period = await a_get_period_by_jalali(pharmacy_id, prev_jy, prev_jm)
+    change_text = ""
+    if prev_period:
+        prev_metrics_row = await a_get_metrics(pharmacy_id, prev_period["id"])
+        if prev_metrics_row:
+            prev_gross = float(_get(prev_metrics_row, "gross_profit"))
+            if prev_gross:
+                delta = (gross_profit - prev_gross) / prev_gross
+                change_text = f"📈 تغییر سود ناخالص نسبت به ماه قبل: {fmt_percent(delta)}"
+    month_name = _month_name(jm)
+    summary_lines = [
+        f"📊 خلاصه {month_name} {jy} برای داروخانه #{pharmacy_id}",
+        "",
+        f"💵 فروش نقدی: {fmt_money(sales_cash)} تومان",
+        f"🏥 فروش بیمه‌ای: {fmt_money(sales_ins)} تومان",
+        f"💰 جمع فروش: {fmt_money(sales_total)} تومان",
+        f"👥 تعداد ویزیت‌ها: {visits_total}",
+        f"🏦 هزینه ثابت: {fmt_money(fixed_total)} تومان",
+        f"💳 جمع چک‌ها: {fmt_money(checks_total) + ' تومان' if checks_total is not None else '—'}",
+        f"💹 سود ناخالص: {fmt_money(gross_profit)} تومان",
+    ]
+    if change_text:
+        summary_lines.append("")
+        summary_lines.append(change_text)
+    summary_text = "\n".join(summary_lines)
+    await safe_edit(
+        message,
+        summary_text,
+        reply_markup=summary_nav_kb(pharmacy_id),
+        context=context,
+        log_context="cb_summary_pick_month",
+    )
+
+@owner_only_access
+async def cb_check_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Start the check registration flow by asking for the due date."""
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    match = _CB_CHECK_START_RE.match(data)
+    if not match:
+        return
+    pharmacy_id = int(match.group(1))
+    state = {
+        "step": 0,
+        "data": {
+            "pharmacy_id": pharmacy_id,
+            "date_due": None,
+            "amount": None,
+            "recipient": None,
+        },
+    }
+    if context.user_data is not None:
+        context.user_data["check"] = state
+    jy, jm, _ = gregorian_to_jalali(date.today())
+    keyboard = daily_day_picker_kb(jy, jm, tag=TAG_CHECK_PICK_DAY, extra=str(pharmacy_id))
+    await safe_edit(
+        message,
+        "تاریخ سررسید چک را انتخاب کن:",
+        reply_markup=keyboard,
+        context=context,
+        log_context="cb_check_start",
+    )
+
+@owner_only_access
+async def cb_check_pick_day(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle day selection for the check registration flow."""
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    tag, _, rest = data.partition(":")
+    if tag != TAG_CHECK_PICK_DAY:
+        return
+    date_str, _, pharm = rest.partition(":")
+    try:
+        date.fromisoformat(date_str)
+        pharmacy_id = int(pharm)
+    except ValueError:
+        return
+    check_state = context.user_data.get("check") if context.user_data is not None else None
+    check_data = check_state.get("data", {}) if check_state else None
+    if not check_state or check_data.get("pharmacy_id") != pharmacy_id:
+        return
+    check_data["date_due"] = date_str
+    check_state["step"] = 1
+    await safe_edit(
+        message,
+        f"📆 تاریخ سررسید: {to_persian_digits(date_str)}",
+        reply_markup=None,
+        context=context,
+        log_context="cb_check_pick_day_edit",
+    )
+    await safe_reply(
+        message,
+        "مبلغ چک را وارد کن (به تومان):",
+        reply_markup=ForceReply(selective=True),
+        context=context,
+        log_context="cb_check_pick_day_prompt",
+    )
+
+@owner_only_access
+async def msg_flow_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Route a text reply to whichever entry flow is active for this user.
+
+    Both flows keep their state under context.user_data, so one dispatch
+    replaces two sequentially evaluated MessageHandlers per message and
+    guarantees a reply is only processed by a single flow.
+    """
+    user_data = context.user_data
+    if not user_data:
+        return
+    if "check" in user_data:
+        await msg_check_flow(update, context)
+    elif "daily" in user_data:
+        await msg_daily_flow(update, context)
+
+async def msg_check_flow(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle textual replies for the check registration flow."""
+    message = update.effective_message
+    if not message:
+        return
+    text = (message.text or "").strip()
+    check_state = context.user_data.get("check") if context.user_data is not None else None
+    if not check_state:
+        return
+    step = check_state.get("step", 0)
+    data = check_state.get("data", {})
+    if step == 1:
+        value, err = parse_smart_number(text, as_int=True)
+        if err:
+            await safe_reply(
+                message,
+                "❗ مبلغ نامعتبر است. دوباره تلاش کن:",
+                reply_markup=ForceReply(selective=True),
+                context=context,
+                log_context="msg_check_flow_amount_error",
+            )
+            return
+        if value is None or value <= 0:
+            await safe_reply(
+                message,
+                "❗ مبلغ باید بیشتر از صفر باشد.",
+                reply_markup=ForceReply(selective=True),
+                context=context,
+                log_context="msg_check_flow_amount_nonpositive",
+            )
+            return
+        data["amount"] = int(value)
+        check_state["step"] = 2
+        await safe_reply(
+            message,
+            "نام شرکت پخش یا گیرنده چک را وارد کن:",
+            reply_markup=ForceReply(selective=True),
+            context=context,
+            log_context="msg_check_flow_recipient_prompt",
+        )
+        return
+    if step == 2:
+        data["recipient"] = text
+        check_state["step"] = 3
+        payload = data
+        logger.info("Check saved: %s", payload)
+        summary_lines = [
+            "✅ چک با موفقیت ثبت شد.",
+            f"📆 تاریخ سررسید: {to_persian_digits(payload['date_due'])}",
+            f"💰 مبلغ: {fmt_money(payload['amount'])} تومان",
+            f"🏢 گیرنده: {h(payload['recipient'])}",
+        ]
+        await safe_reply(
+            message,
+            "\n".join(summary_lines),
+            context=context,
+            log_context="msg_check_flow_complete",
+        )
+        if context.user_data is not None:
+            context.user_data.pop("check", None)
+        return
+
+# Money values repeat heavily (zeros, round totals) across report, weekly,
+# and PDF renders; cache the formatted strings keyed on the coerced float.
+@lru_cache(maxsize=8192)
+def _fmt_money_cached(x: float) -> str:
+    return f"{x:,.0f}"
+
+def fmt_money(x) -> str:
+    """Format a number with thousands separators; fallback to string representation."""
+    try:
+        return _fmt_money_cached(float(x))
+    except Exception:
+        return str(x)
+
+def fmt_percent(x, *, digits: int = 1) -> str:
+    """\n    Format a ratio (0.12 -> '12.0٪') with a configurable number of decimal places.\n\n    If conversion fails, returns a dash to indicate missing value.\n    """
+    try:
+        return f"{(float(x) * 100):.{digits}f}٪"
+    except Exception:
+        return "-"
+
+def _get(m, k, default=0):
+    """Row-or-dict lookup: sqlite3.Row supports m[k] but not .get()."""
+    try:
+        return m[k]
+    except (KeyError, IndexError):
+        return default
+
+# Report body with the constant Persian labels baked in; render_report only
+# fills the data slots, so each render is one format_map pass instead of
+# ~20 f-string evaluations.
+_REPORT_TEMPLATE = (
+    "<b>{title}</b>  {locked_badge}\n"
+    "{start_date} → {end_date}  ·  Status: <b>{status}</b>\n"
+    "\n"
+    "<b>ورودی‌ها</b>\n"
+    "فروش نقدی: {sales_cash} تومان\n"
+    "واریزی بیمه: {sales_ins} تومان\n"
+    "فروش کل: {sales_total} تومان\n"
+    "خرید (متغیر): {var_total} تومان\n"
+    "هزینهٔ ثابت (اجاره+حقوق): {fixed_total} تومان  ·  سایر: {opex_other_total} تومان\n"
+    "تعداد مراجعه: {visits_total} نفر  ·  روزهای Period: {days_count} روز\n"
+    "\n"
+    "<b>شاخص‌ها</b>\n"
+    "سود ناخالص: {gross_profit} تومان\n"
+    "سود عملیاتی (خالص): {net_profit_operational} تومان\n"
+    "حاشیه سود ناخالص: {cm_ratio}\n"
+    "حاشیه سود خالص عملیاتی: {np_ratio}\n"
+    "نقطهٔ سربه‌سر فروش: {breakeven_sales} تومان\n"
+    "میانگین فروش روزانه: {avg_daily_sales} تومان/روز\n"
+    "میانگین فروش/مراجعه: {avg_sale_per_visit} تومان/نفر\n"
+    "\n"
+    "<i>آخرین محاسبه: {computed_at}</i>"
+)
+
+def render_report(metrics_row, period_row) -> str:
+    """Create an HTML report for a period's metrics."""
+    metrics = metrics_row
+    period = period_row
+    return _REPORT_TEMPLATE.format_map(
+        {
+            "title": h(str(_get(period, "title", ""))),
+            "locked_badge": "🔒 نهایی (قفل‌شده)" if _get(metrics, "locked_at", None) else "🟢 زنده",
+            "start_date": h(_get(period, "start_date", "-")),
+            "end_date": h(_get(period, "end_date", "-")),
+            "status": h(_get(period, "status", "open")),
+            "sales_cash": fmt_money(_get(metrics, "sales_cash")),
+            "sales_ins": fmt_money(_get(metrics, "sales_ins")),
+            "sales_total": fmt_money(_get(metrics, "sales_total")),
+            "var_total": fmt_money(_get(metrics, "var_total")),
+            "fixed_total": fmt_money(_get(metrics, "fixed_total")),
+            "opex_other_total": fmt_money(_get(metrics, "opex_other_total")),
+            "visits_total": _get(metrics, "visits_total"),
+            "days_count": _get(metrics, "days_count"),
+            "gross_profit": fmt_money(_get(metrics, "gross_profit")),
+            "net_profit_operational": fmt_money(_get(metrics, "net_profit_operational")),
+            "cm_ratio": fmt_percent(_get(metrics, "cm_ratio")),
+            "np_ratio": fmt_percent(_get(metrics, "np_ratio")),
+            "breakeven_sales": fmt_money(_get(metrics, "breakeven_sales")),
+            "avg_daily_sales": fmt_money(_get(metrics, "avg_daily_sales")),
+            "avg_sale_per_visit": fmt_money(_get(metrics, "avg_sale_per_visit")),
+            "computed_at": h(str(_get(metrics, "computed_at", None) or "-")),
+        }
+    )
+
+_COMPARE_TABLE_HEADER = "<table>\n<tr><th>شاخص</th><th>ماه قبل</th><th>ماه جاری</th><th>Δ%</th></tr>"
+
+def render_compare_table(pharmacy_id: int, period_a_id: int, period_b_id: int) -> str:
+    """Render an HTML table comparing key metrics between two periods."""
+    a = get_metrics(pharmacy_id, period_a_id) or {}
+    b = get_metrics(pharmacy_id, period_b_id) or {}
+
+    def safe_num(v):
+        try:
+            return None if v is None else float(v)
+        except Exception:
+            return None
+
+    def display_num(v):
+        if isinstance(v, (int, float)):
+            return fmt_money(v)
+        if v is None:
+            return "-"
+        s = str(v)
+        return fmt_money(s) if s.replace('.', '', 1).isdigit() else s
+
+    # Simple HTML table with headers: Metric | Period A | Period B | Δ%
+    rows = [_COMPARE_TABLE_HEADER]
+
+    def add_row(label: str, key: str, is_percent: bool = False):
+        ra = _get(a, key, None)
+        rb = _get(b, key, None)
+        left = display_num(ra) if not is_percent else (fmt_percent(ra) if ra is not None else "-")
+        right = display_num(rb) if not is_percent else (fmt_percent(rb) if rb is not None else "-")
+        # compute delta percent where sensible
+        av = safe_num(ra)
+        bv = safe_num(rb)
+        if av:
+            delta = fmt_percent(((bv or 0.0) - av) / abs(av))
+        elif av == 0 and bv:
+            delta = "—"
+        else:
+            delta = "-"
+        # label/left/right/delta all come from our own formatters (fmt_money,
+        # fmt_percent, literal labels) — nothing user-supplied, so no escaping.
+        rows.append(f"<tr><td>{label}</td><td>{left}</td><td>{right}</td><td>{delta}</td></tr>")
+
+    add_row("فروش نقدی", "sales_cash")
+    add_row("فروش بیمه", "sales_ins")
+    add_row("جمع فروش", "sales_total")
+    add_row("خرید (متغیر)", "var_total")
+    add_row("هزینه ثابت", "fixed_total")
+    add_row("سایر هزینه‌ها", "opex_other_total")
+    add_row("سود ناخالص", "gross_profit")
+    add_row("سود عملیاتی", "net_profit_operational")
+    add_row("حاشیه ناخالص", "cm_ratio", is_percent=True)
+    add_row("حاشیه خالص", "np_ratio", is_percent=True)
+    add_row("نقطه سربه‌سر", "breakeven_sales")
+    add_row("میانگین فروش روزانه", "avg_daily_sales")
+    add_row("میانگین فروش/ویزیت", "avg_sale_per_visit")
+
+    rows.append("</table>")
+    return "\n".join(rows)
+
+PERSIAN_DIGITS = str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩", "01234567890123456789")
+ASCII_TO_PERSIAN_DIGITS = str.maketrans("0123456789", "۰۱۲۳۴۵۶۷۸۹")
+
+def to_persian_digits(value: int | str) -> str:
+    """Convert ASCII digits in ``value`` to Persian numerals."""
+    return str(value).translate(ASCII_TO_PERSIAN_DIGITS)
+
+# Day labels 0-31 pre-rendered once; indexing a tuple beats a str()+translate
+# pair in the tight button loop of the day picker.
+_PERSIAN_DAY_LABELS = tuple(str(i).translate(ASCII_TO_PERSIAN_DIGITS) for i in range(32))
+
+# ISO date strings for a month, built once and shared by every picker
+# variant (daily/check tags, any extra), so a cache miss on one keyboard
+# doesn't re-render the ~30 date strings another already produced.
+@lru_cache(maxsize=256)
+def _month_day_isos(jy: int, jm: int) -> tuple[str, ...]:
+    _, _, days_in_month = jalali_month_bounds(jy, jm)
+    return tuple("%04d-%02d-%02d" % (jy, jm, day) for day in range(1, days_in_month + 1))
+
+# The picker keyboards are pure functions of small scalars; caching the
+# built InlineKeyboardMarkup avoids re-allocating ~30 buttons per render
+# (PTB treats markups as immutable, so sharing instances is safe).
+@lru_cache(maxsize=1024)
+def daily_day_picker_kb(
+    jy: int,
+    jm: int,
+    *,
+    tag: str | None = None,
+    extra: str | None = None,
+) -> InlineKeyboardMarkup:
+    """Return a day-selection keyboard for the given Jalali month.
+
+    When ``tag`` is provided, the callback data will use that tag instead of the
+    default ``TAG_DAILY_PICK_DAY``. If ``extra`` is provided, it is appended as
+    an additional colon-separated part after the ISO date.
+    """
+    callback_tag = tag or TAG_DAILY_PICK_DAY
+    suffix = "" if extra is None else ":" + extra
+    rows: list[list[InlineKeyboardButton]] = []
+    current_row: list[InlineKeyboardButton] = []
+    for day, iso_date in enumerate(_month_day_isos(jy, jm), start=1):
+        label = _PERSIAN_DAY_LABELS[day]
+        callback_data = "%s:%s%s" % (callback_tag, iso_date, suffix)
+        current_row.append(InlineKeyboardButton(label, callback_data=callback_data))
+        if len(current_row) == 7:
+            rows.append(current_row)
+            current_row = []
+    if current_row:
+        rows.append(current_row)
+    return InlineKeyboardMarkup(rows)
+
+@lru_cache(maxsize=1024)
+def month_picker_kb(
+    jy: int,
+    *,
+    tag: str,
+    extra: str | None = None,
+) -> InlineKeyboardMarkup:
+    """Render a 3x4 grid of Jalali months with optional extra data in callback."""
+    buttons: list[list[InlineKeyboardButton]] = []
+    row: list[InlineKeyboardButton] = []
+    suffix = "" if extra is None else ":" + extra
+    for index, title in enumerate(JALALI_MONTH_NAMES, start=1):
+        callback = "%s:%04d-%02d%s" % (tag, jy, index, suffix)
+        row.append(InlineKeyboardButton(title, callback_data=callback))
+        if len(row) == 3:
+            buttons.append(row)
+            row = []
+    if row:
+        buttons.append(row)
+    return InlineKeyboardMarkup(buttons)
+
+JALALI_MONTH_NAMES = [
+    "فروردین",
+    "اردیبهشت",
+    "خرداد",
+    "تیر",
+    "مرداد",
+    "شهریور",
+    "مهر",
+    "آبان",
+    "آذر",
+    "دی",
+    "بهمن",
+    "اسفند",
+]
+
+# The "name or raw number" fallback was repeated as a ternary in every
+# render path; one lookup table keeps it branch-free for valid months.
+_MONTH_NAME = tuple(JALALI_MONTH_NAMES)
+
+def _month_name(jm: int) -> str:
+    """Jalali month label, falling back to the raw number outside 1..12."""
+    return _MONTH_NAME[jm - 1] if 1 <= jm <= 12 else str(jm)
+
+_GREGORIAN_MONTH_DAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+_JALALI_MONTH_DAYS = (31, 31, 31, 31, 31, 31, 30, 30, 30, 30, 30, 29)
+# Cumulative days before each Gregorian month (common year), index 0..12.
+_GREGORIAN_CUM_DAYS = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365)
+
+# Pure-integer conversion cores: no date objects, no imports, just
+# arithmetic over the month-length tuples — njit-compilable when numba is
+# present (the kernels below get wrapped alongside _compute_kpis).
+def _g2j_int(gyear: int, gmonth: int, gday: int) -> tuple[int, int, int]:
+    gy = gyear - 1600
+    gm = gmonth - 1
+    gd = gday - 1
+    g_day_no = 365 * gy + (gy + 3) // 4 - (gy + 99) // 100 + (gy + 399) // 400
+    g_day_no += _GREGORIAN_CUM_DAYS[gm]
+    if gm > 1 and ((gyear % 4 == 0 and gyear % 100 != 0) or (gyear % 400 == 0)):
+        g_day_no += 1
+    g_day_no += gd
+    j_day_no = g_day_no - 79
+    j_np = j_day_no // 12053
+    j_day_no %= 12053
+    jy = 979 + 33 * j_np + 4 * (j_day_no // 1461)
+    j_day_no %= 1461
+    if j_day_no >= 366:
+        jy += (j_day_no - 1) // 365
+        j_day_no = (j_day_no - 1) % 365
+    # Closed form: the first six months are 31 days and the next five are 30;
+    # Esfand absorbs the remainder so day 30 of a leap year maps correctly.
+    if j_day_no < 186:
+        return jy, j_day_no // 31 + 1, j_day_no % 31 + 1
+    j_day_no -= 186
+    jm = j_day_no // 30 + 7
+    if jm > 12:
+        jm = 12
+        return jy, jm, j_day_no - 150 + 1
+    return jy, jm, j_day_no % 30 + 1
+
+def _j2g_int(jy: int, jm: int, jd: int) -> tuple[int, int, int]:
+    jy -= 979
+    jm -= 1
+    jd -= 1
+    j_day_no = 365 * jy + (jy // 33) * 8 + ((jy % 33) + 3) // 4
+    j_day_no += 31 * jm if jm <= 6 else 186 + 30 * (jm - 6)
+    j_day_no += jd
+    g_day_no = j_day_no + 79
+    gy = 1600 + 400 * (g_day_no // 146097)
+    g_day_no %= 146097
+    if g_day_no >= 36525:
+        g_day_no -= 1
+        gy += 100 * (g_day_no // 36524)
+        g_day_no %= 36524
+        if g_day_no >= 365:
+            g_day_no += 1
+    gy += 4 * (g_day_no // 1461)
+    g_day_no %= 1461
+    if g_day_no >= 366:
+        g_day_no -= 1
+        gy += g_day_no // 365
+        g_day_no %= 365
+    # Cumulative-days lookup instead of a subtract-as-you-go month loop;
+    # in leap years Feb 29 (0-based day 59) is answered directly and later
+    # days shift down one so the common-year table applies. (A manual scan
+    # rather than bisect so the kernel stays njit-compilable.)
+    if (gy % 4 == 0 and gy % 100 != 0) or (gy % 400 == 0):
+        if g_day_no == 59:
+            return gy, 2, 29
+        if g_day_no > 59:
+            g_day_no -= 1
+    gm = 12
+    for i in range(1, 13):
+        if g_day_no < _GREGORIAN_CUM_DAYS[i]:
+            gm = i
+            break
+    return gy, gm, g_day_no - _GREGORIAN_CUM_DAYS[gm - 1] + 1
+
+try:  # optional, like jdatetime: compile the kernels when numba is present
+    from numba import njit as _njit_cal
+    _g2j_int = _njit_cal(cache=True)(_g2j_int)
+    _j2g_int = _njit_cal(cache=True)(_j2g_int)
+except Exception:
+    pass
+
+# date objects are immutable and hashable, so both converters memoise
+# directly on their arguments; the live key set is tiny (recent days and
+# month starts), making the hit rate near 100% on keyboard renders.
+@lru_cache(maxsize=2048)
+def gregorian_to_jalali(d: date) -> tuple[int, int, int]:
+    jd_mod = _jd()
+    if jd_mod:
+        j = jd_mod.date.fromgregorian(date=d)
+        return j.year, j.month, j.day
+    return _g2j_int(d.year, d.month, d.day)
+
+@lru_cache(maxsize=8192)
+def _iso_to_jalali(iso: str) -> tuple[int, int, int]:
+    """Jalali (year, month, day) for an ISO date string, memoised on the string.
+
+    Period start dates are low-cardinality, so the render paths skip both
+    the fromisoformat parse and the conversion on a warm cache.
+    """
+    return gregorian_to_jalali(date.fromisoformat(iso))
+
+@lru_cache(maxsize=2048)
+def jalali_to_gregorian(jy: int, jm: int, jd: int) -> date:
+    jd_mod = _jd()
+    if jd_mod:
+        return jd_mod.date(jy, jm, jd).togregorian()
+    gy, gm, gd = _j2g_int(jy, jm, jd)
+    return date(gy, gm, gd)
+
+# Pure function of two small ints with only ~a dozen live (year, month)
+# pairs at any time, so the cache hit rate is effectively 100%.
+@lru_cache(maxsize=512)
+def jalali_month_bounds(jy: int, jm: int) -> tuple[date, date, int]:
+    start = jalali_to_gregorian(jy, jm, 1)
+    if jm == 12:
+        next_start = jalali_to_gregorian(jy + 1, 1, 1)
+    else:
+        next_start = jalali_to_gregorian(jy, jm + 1, 1)
+    end = next_start - timedelta(days=1)
+    days = (end - start).days + 1
+    return start, end, days
+
+_SQL_UPSERT_MONTH_PERIOD = """\n        INSERT INTO periods(pharmacy_id, title, start_date, end_date, status, created_at)\n        VALUES (?, ?, ?, ?, 'open', datetime('now'))\n        ON CONFLICT(pharmacy_id, start_date, end_date) DO UPDATE SET title=title\n        RETURNING id, status;\n        """
+
+_SQL_SEED_MONTH_METRICS = """\n        INSERT INTO period_metrics(pharmacy_id, period_id, basis, days_count, computed_at)\n        VALUES (?, ?, 'cash', ?, datetime('now'))\n        ON CONFLICT(pharmacy_id, period_id, basis) DO NOTHING;\n        """
+
+def get_or_create_month_period(pharmacy_id: int, jy: int, jm: int) -> tuple[int, str, date, date, int]:
+    """Return period_id/status for the given Jalali month, creating it if needed.
+
+    A single UPSERT..RETURNING replaces the old SELECT-then-INSERT pair, so
+    there is one round-trip, one lock acquisition and no race between the
+    existence check and the insert.
+    """
+    start, end, days = jalali_month_bounds(jy, jm)
+    start_iso = start.isoformat()
+    end_iso = end.isoformat()
+    title = f"{jy}-{jm:02d} (شمسی)"
+    with write_conn() as conn:
+        c = conn.cursor()
+        c.execute("BEGIN IMMEDIATE;")
+        row = c.execute(
+            _SQL_UPSERT_MONTH_PERIOD, (pharmacy_id, title, start_iso, end_iso)
+        ).fetchone()
+        period_id = int(row["id"])
+        status = row["status"] or "open"
+        # Zero-valued metrics row for freshly created periods; DO NOTHING keeps
+        # existing metrics untouched. rowcount tells us whether the period is new.
+        c.execute(_SQL_SEED_MONTH_METRICS, (pharmacy_id, period_id, days))
+        created = c.rowcount == 1
+    if created:
+        _invalidate_period_cache(pharmacy_id)
+        _invalidate_metrics_cache(pharmacy_id)
+        _lookup_period_by_jalali.cache_clear()
+    return period_id, status, start, end, days
+
+# --- Smart numeric parsing (k/m/b), Persian-friendly ---
+# ``parse_smart_number`` converts shorthand numeric strings such as ``850k`` or
+# ``1.2m`` into their numeric equivalents.  It relies on the global
+# ``PERSIAN_DIGITS`` mapping defined above to normalise Persian and Arabic
+# numerals.  The ``typing.Tuple`` import and fall‑back definition for
+# ``PERSIAN_DIGITS`` were removed to avoid duplicate definitions.  ``Tuple``
+# is already imported near the top of this module and ``PERSIAN_DIGITS`` is
+# defined once globally.
+
+_NUM_ERR_FA = "❗ مقدار نامعتبر بود. مثلاً: 1.2b ، 750m ، 850k"
+# Digit normalization and separator stripping in a single translate pass.
+_NORMALIZE_INPUT = str.maketrans("۰۱۲۳۴۵۶۷۸۹٠١٢٣٤٥٦٧٨٩", "01234567890123456789", ",٬")
+_SUFFIX_FACTORS = {"k": 1_000.0, "m": 1_000_000.0, "b": 1_000_000_000.0}
+# One C-level scan instead of a per-character Python genexp.
+_NUM_CORE_RE = re.compile(r"[+-]?\d*\.?\d+")
+
+def parse_smart_number(raw: str, *, as_int: bool = False) -> Tuple[float | int | None, str | None]:
+    """\n    Accepts:\n      '1.2', '2500000',\n      '850k', '3.5k',\n      '750m', '1.2m',\n      '1b', '1.2b'\n    Rejects:\n      '1.2 m' (space before suffix), letters beyond k/m/b, multiple dots, empty.\n    Returns: (value, None) or (None, error_message_fa)\n    """
+    if raw is None:
+        return None, _NUM_ERR_FA
+
+    s = raw.strip()
+    if not s:
+        return None, _NUM_ERR_FA
+
+    # Fast path: plain ASCII digits, by far the most common reply. Skips the
+    # translate/replace/suffix machinery entirely.
+    if s.isascii() and s.isdigit():
+        return (int(s), None) if as_int else (float(s), None)
+
+    # Normalize Persian digits & separators, case-insensitive
+    s = s.translate(_NORMALIZE_INPUT).lower()
+
+    # Detect suffix (no space allowed)
+    factor = _SUFFIX_FACTORS.get(s[-1:])
+    core = s[:-1] if factor is not None else s
+    if factor is None:
+        factor = 1.0
+
+    # Optional leading sign, at most one dot, digits only.
+    if not _NUM_CORE_RE.fullmatch(core):
+        return None, _NUM_ERR_FA
+
+    try:
+        num = float(core)
+    except Exception:
+        return None, _NUM_ERR_FA
+
+    val = num * factor
+    if as_int:
+        return int(round(val)), None
+    return val, None
+
+# Comparison header and weekly day lines are rendered on every compare /
+# weekly callback; %-templates skip the f-string formatting machinery.
+_CMP_TMPL = "<b>مقایسه %s %s با %s %s</b>\n\n%s"
+_WEEKLY_DAY_TMPL = "%s: نقدی %s، بیمه %s، متغیر %s، سایر %s، مراجعه %s، یادداشت: %s"
+
+@lru_cache(maxsize=1024)
+def compare_months_kb(pharmacy_id: int, base_jy: int, base_jm: int, jy: int) -> InlineKeyboardMarkup:
+    buttons: list[list[InlineKeyboardButton]] = []
+    row: list[InlineKeyboardButton] = []
+    # All twelve buttons share everything but the picked month; build the
+    # common prefix once instead of joining five parts per button.
+    prefix = "%s:%d:%d:%d:%d:" % (TAG_COMPARE_PICK, pharmacy_id, base_jy, base_jm, jy)
+    for index, title in enumerate(JALALI_MONTH_NAMES, start=1):
+        row.append(InlineKeyboardButton(title, callback_data=prefix + str(index)))
+        if len(row) == 3:
+            buttons.append(row)
+            row = []
+    if row:
+        buttons.append(row)
+    buttons.append([InlineKeyboardButton("◀️ بازگشت", callback_data=make_cb(TAG_PHARM_SELECT, pharmacy_id))])
+    return InlineKeyboardMarkup(buttons)
+
+async def _reply_missing_period(message, context, pharmacy_id: int, text: str, log_context: str) -> None:
+    """Shared 'period not registered' response with the cached back button."""
+    await safe_edit(
+        message,
+        text,
+        reply_markup=_back_markup("◀️ بازگشت", TAG_PHARM_SELECT, pharmacy_id),
+        context=context,
+        log_context=log_context,
+    )
+
+@owner_only_access
+async def cb_compare_prev(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    if not data.startswith(_CB_COMPARE_PREV_PREFIX):
+        return
+    match = _CB_COMPARE_PREV_ARGS_RE.match(data, len(_CB_COMPARE_PREV_PREFIX))
+    if not match:
+        return
+    pharmacy_id = int(match.group(1))
+    jy = int(match.group(2))
+    jm = int(match.group(3))
+    prev_jy, prev_jm = (jy - 1, 12) if jm == 1 else (jy, jm - 1)
+    prev_start, prev_end, _ = jalali_month_bounds(prev_jy, prev_jm)
+    curr_start, curr_end, _ = jalali_month_bounds(jy, jm)
+    prev_bounds = (prev_start.isoformat(), prev_end.isoformat())
+    curr_bounds = (curr_start.isoformat(), curr_end.isoformat())
+    periods = await a_find_periods_by_bounds_pair(pharmacy_id, prev_bounds, curr_bounds)
+    prev_period = periods.get(prev_bounds)
+    if not prev_period:
+        await _reply_missing_period(message, context, pharmacy_id, "🔍 دورهٔ ماه قبل هنوز ثبت نشده است.", "cb_compare_prev_missing_prev")
+        return
+    current_period = periods.get(curr_bounds)
+    if not current_period:
+        await _reply_missing_period(message, context, pharmacy_id, "❗ دورهٔ انتخاب‌شده پیدا نشد.", "cb_compare_prev_missing_current")
+        return
+    prev_period_id = prev_period["id"]
+    current_period_id = current_period["id"]
+    table = await asyncio.to_thread(render_compare_table, pharmacy_id, prev_period_id, current_period_id)
+    month_name = _month_name(jm)
+    prev_month_name = _month_name(prev_jm)
+    back_markup = _back_markup("◀️ بازگشت", TAG_PERIOD_SELECT, pharmacy_id, current_period_id)
+    comparison_text = _CMP_TMPL % (month_name, jy, prev_month_name, prev_jy, table)
+    await safe_edit(
+        message,
+        comparison_text,
+        reply_markup=back_markup,
+        context=context,
+        log_context="cb_compare_prev",
+    )
+
+@owner_only_access
+async def cb_compare_months(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    args = _parse_cb(data, TAG_COMPARE_MONTHS, 3)
+    if args is None:
+        return
+    try:
+        pharmacy_id, base_jy, base_jm = (int(p) for p in args)
+    except ValueError:
+        return
+    jy = base_jy
+    kb = compare_months_kb(pharmacy_id, base_jy, base_jm, jy)
+    await safe_edit(
+        message,
+        f"ماه مرجع {base_jy}/{base_jm:02d} — ماه دوم را انتخاب کن",
+        reply_markup=kb,
+        context=context,
+        log_context="cb_compare_months",
+    )
+
+@owner_only_access
+async def cb_compare_pick(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    args = _parse_cb(data, TAG_COMPARE_PICK, 5)
+    if args is None:
+        return
+    try:
+        pharmacy_id, base_jy, base_jm, jy, jm = (int(p) for p in args)
+    except ValueError:
+        return
+    # Do not implicitly create periods when comparing months.  Lookup existing periods instead.
+    # Compute Jalali month bounds for both the base and target months.
+    base_start, base_end, _ = jalali_month_bounds(base_jy, base_jm)
+    target_start, target_end, _ = jalali_month_bounds(jy, jm)
+    # Attempt to find both existing periods by their inclusive date bounds.
+    base_bounds = (base_start.isoformat(), base_end.isoformat())
+    target_bounds = (target_start.isoformat(), target_end.isoformat())
+    periods = await a_find_periods_by_bounds_pair(pharmacy_id, base_bounds, target_bounds)
+    base_period = periods.get(base_bounds)
+    if not base_period:
+        # If the base month is not registered, do not create a new period.  Inform the user.
+        await _reply_missing_period(message, context, pharmacy_id, "🔍 دورهٔ ماه مبدا هنوز ثبت نشده است.", "cb_compare_pick_missing_base")
+        return
+    target_period = periods.get(target_bounds)
+    if not target_period:
+        # If the target month does not exist yet, avoid creating it and inform the user.
+        await _reply_missing_period(message, context, pharmacy_id, "🔍 دورهٔ ماه انتخاب‌شده هنوز ثبت نشده است.", "cb_compare_pick_missing_target")
+        return
+    # Both periods exist; extract their IDs for comparison.
+    base_period_id = base_period["id"]
+    target_period_id = target_period["id"]
+    table = await asyncio.to_thread(render_compare_table, pharmacy_id, base_period_id, target_period_id)
+    base_name = _month_name(base_jm)
+    target_name = _month_name(jm)
+    back_markup = _back_markup("◀️ بازگشت", TAG_PERIOD_SELECT, pharmacy_id, base_period_id)
+    await safe_edit(
+        message,
+        _CMP_TMPL % (base_name, base_jy, target_name, jy, table),
+        reply_markup=back_markup,
+        context=context,
+        log_context="cb_compare_pick",
+    )
+
+@owner_only_access
+async def cb_report_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """\n    Show the detailed monthly report for a period. This callback expects data\n    in the format ``fin.report.view:<pharmacy_id>:<period_id>``. It fetches\n    the relevant metrics and period details, renders a report via\n    ``render_report``, and then displays it with the standard month actions\n    keyboard so the user can navigate back or perform other actions.\n    """
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    args = _parse_cb(data, TAG_REPORT_VIEW, 2)
+    if args is None:
+        return
+    try:
+        pharmacy_id, period_id = (int(p) for p in args)
+    except ValueError:
+        return
+    joined_row = await a_get_metrics_with_period(pharmacy_id, period_id)
+    if not joined_row:
+        await safe_edit(
+            message,
+            "⚠️ دوره پیدا نشد.",
+            reply_markup=None,
+            context=context,
+            log_context="cb_report_view_missing",
+        )
+        return
+    # The joined row carries both metric and period columns.
+    report_html = render_report(joined_row, joined_row)
+    # Determine the Jalali month to build the month actions keyboard
+    p = joined_row
+    start_iso = p["start_date"] or date.today().isoformat()
+    jy, jm, _ = _iso_to_jalali(start_iso)
+    kb, _, _, _ = month_actions_kb(pharmacy_id, jy, jm, period_id=period_id, status=p["status"] or "open")
+    await safe_edit(
+        message,
+        report_html,
+        reply_markup=kb,
+        context=context,
+        log_context="cb_report_view",
+    )
+
+def get_period_baseline(pharmacy_id, period_id):
+    """Baseline metrics dict for the simulator, served from the metrics row cache."""
+    row = get_metrics(pharmacy_id, period_id)
+    return dict(row) if row else {}
+
+def _ensure_sim_state(context, pharmacy_id: int, period_id: int) -> dict:
+    """Return the simulator state for this pharmacy/period, (re)creating it on mismatch."""
+    sim_state = context.user_data.get("sim") if context.user_data else None
+    if not sim_state or sim_state.get("pharmacy_id") != pharmacy_id or sim_state.get("period_id") != period_id:
+        if context.user_data is None:
+            context.user_data = {}
+        sim_state = {
+            "pharmacy_id": pharmacy_id,
+            "period_id": period_id,
+            "deltas": {"sales": 0.0, "var": 0.0, "fixed": 0.0},
+            "baseline": get_period_baseline(pharmacy_id, period_id),
+        }
+        context.user_data["sim"] = sim_state
+    return sim_state
+
+@owner_only_access
+async def cb_sim_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """\n    Entry point for the two‑lever simulator.\n    Initializes baseline and deltas in context.user_data['sim'] and renders the simulation.\n    Callback data format: ``fin.sim.menu:<pharmacy_id>:<period_id>``.\n    """
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    try:
+        pharmacy_id, period_id = (int(p) for p in _parse_cb(data, TAG_SIM_MENU, 2) or ())
+    except ValueError:
+        await safe_edit(
+            message,
+            "❗ داده نامعتبر است.",
+            context=context,
+            log_context="cb_sim_menu_invalid",
+        )
+        return
+    # Access or initialize simulation state
+    sim_state = _ensure_sim_state(context, pharmacy_id, period_id)
+    baseline = sim_state.get("baseline", {})
+    deltas = sim_state.get("deltas", {})
+    sim_out = compute_simulated(baseline, deltas)
+    period_row = await a_get_period(period_id) or {}
+    text = render_sim_text(period_row, sim_out, deltas)
+    kb = sim_keyboard(pharmacy_id, period_id)
+    await safe_edit(
+        message,
+        text,
+        reply_markup=kb,
+        context=context,
+        log_context="cb_sim_menu",
+    )
+
+@owner_only_access
+async def cb_sim_delta(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """\n    Adjust one of the simulation deltas and refresh the simulation view.\n    Callback data format: ``fin.sim.delta:<ph_id>:<period_id>:<kind>:<sign>:<pct>``\n    where kind ∈ {sales, var, fixed}, sign ∈ {plus, minus}, pct ∈ {5,10}.\n    """
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    args = _parse_cb(data, TAG_SIM_DELTA, 5)
+    if args is None:
+        return
+    pharm, period, kind, sign, pct = args
+    if kind not in _SIM_DELTA_KINDS or sign not in _SIM_DELTA_SIGNS or pct not in _SIM_DELTA_PCTS:
+        return
+    try:
+        pharmacy_id = int(pharm)
+        period_id = int(period)
+    except ValueError:
+        return
+    pct_val = int(pct)
+    step = pct_val / 100.0
+    if sign == "minus":
+        step = -step
+    # Ensure simulation state exists and matches
+    sim_state = _ensure_sim_state(context, pharmacy_id, period_id)
+    # Update the specific delta with clamping
+    deltas = sim_state["deltas"]
+    current_val = float(deltas.get(kind, 0.0))
+    new_val = clamp(current_val + step, -0.30, 0.30)
+    deltas[kind] = new_val
+    baseline = sim_state["baseline"]
+    sim_out = compute_simulated(baseline, deltas)
+    period_row = await a_get_period(period_id) or {}
+    text = render_sim_text(period_row, sim_out, deltas)
+    kb = sim_keyboard(pharmacy_id, period_id)
+    await safe_edit(
+        message,
+        text,
+        reply_markup=kb,
+        context=context,
+        log_context="cb_sim_delta",
+    )
+
+def render_sim_text(period_row, sim_out, deltas):
+    raise NotImplementedError
+
+def sim_keyboard(pharmacy_id, period_id):
+    raise NotImplementedError
+
+@owner_only_access
+async def cb_sim_reset(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """\n    Reset all simulation deltas to zero and refresh the simulation view.\n    Callback data format: ``fin.sim.reset:<ph_id>:<period_id>``.\n    """
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    args = _parse_cb(data, TAG_SIM_RESET, 2)
+    if args is None:
+        return
+    try:
+        pharmacy_id, period_id = (int(p) for p in args)
+    except ValueError:
+        return
+    # Ensure simulation state exists, then zero the deltas
+    sim_state = _ensure_sim_state(context, pharmacy_id, period_id)
+    sim_state["deltas"] = {"sales": 0.0, "var": 0.0, "fixed": 0.0}
+    baseline = sim_state["baseline"]
+    deltas = sim_state["deltas"]
+    sim_out = compute_simulated(baseline, deltas)
+    period_row = await a_get_period(period_id) or {}
+    text = render_sim_text(period_row, sim_out, deltas)
+    kb = sim_keyboard(pharmacy_id, period_id)
+    await safe_edit(
+        message,
+        text,
+        reply_markup=kb,
+        context=context,
+        log_context="cb_sim_reset",
+    )
+
+@owner_only_access
+async def cb_sim_back(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """\n    Return from the simulator to the month actions menu.\n    Callback data format: ``fin.sim.back:<ph_id>:<period_id>``.\n    """
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    args = _parse_cb(data, TAG_SIM_BACK, 2)
+    if args is None:
+        return
+    try:
+        pharmacy_id, period_id = (int(p) for p in args)
+    except ValueError:
+        return
+    period_row = await a_get_period(period_id)
+    if not period_row:
+        await safe_edit(
+            message,
+            "⚠️ دوره پیدا نشد.",
+            reply_markup=None,
+            context=context,
+            log_context="cb_sim_back_missing_period",
+        )
+        return
+    start_iso = _get(period_row, "start_date", None) or date.today().isoformat()
+    jy, jm, _ = _iso_to_jalali(start_iso)
+    kb, _, _, month_name = month_actions_kb(pharmacy_id, jy, jm, period_id=period_id, status=_get(period_row, "status", None) or "open")
+    # Clear simulation state
+    if context.user_data and context.user_data.get("sim"):
+        context.user_data.pop("sim", None)
+    await safe_edit(
+        message,
+        f"ماه {jy}/{jm:02d} ({month_name}) — یکی از گزینه‌ها را انتخاب کن",
+        reply_markup=kb,
+        context=context,
+        log_context="cb_sim_back",
+    )
+
+def clamp(value: float, min_val: float, max_val: float) -> float:
+    """Constrain a value between minimum and maximum bounds."""
+    return max(min_val, min(max_val, value))
+
+def _sim_kernel(
+    sales_total: float,
+    var_total: float,
+    fixed_total: float,
+    opex_other_total: float,
+    visits_total: float,
+    days_count: float,
+    sales_delta: float,
+    var_delta: float,
+    fixed_delta: float,
+) -> tuple:
+    """Pure-numeric simulator kernel; branch-light like _compute_kpis."""
+    new_sales = sales_total * (1.0 + sales_delta)
+    new_var = var_total * (1.0 + var_delta)
+    new_fixed = fixed_total * (1.0 + fixed_delta)
+    gross_profit = new_sales - new_var
+    net_profit_operational = gross_profit - new_fixed - opex_other_total
+    cm_ratio = gross_profit / new_sales if new_sales != 0.0 else 0.0
+    np_ratio = net_profit_operational / new_sales if new_sales != 0.0 else 0.0
+    breakeven_sales = new_fixed / cm_ratio if cm_ratio != 0.0 else 0.0
+    avg_daily_sales = new_sales / days_count if days_count != 0.0 else 0.0
+    avg_sale_per_visit = new_sales / visits_total if visits_total != 0.0 else 0.0
+    return (
+        new_sales,
+        new_var,
+        new_fixed,
+        gross_profit,
+        net_profit_operational,
+        cm_ratio,
+        np_ratio,
+        breakeven_sales,
+        avg_daily_sales,
+        avg_sale_per_visit,
+    )
+
+try:  # optional, like jdatetime: compile the kernel when numba is present
+    from numba import njit as _njit_sim
+    _sim_kernel = _njit_sim(cache=True, fastmath=True)(_sim_kernel)
+except Exception:
+    pass
+
+def compute_simulated(baseline: dict, deltas: dict) -> dict:
+    """
+    Apply percentage deltas to the baseline period metrics and compute derived KPIs.
+
+    baseline: dict that may contain keys like sales_total, var_total, fixed_total,
+              opex_other_total, visits_total, days_count (any missing values default to 0).
+    deltas: dict with percentage deltas as fractions, e.g. {"sales": 0.05, "var": -0.10, "fixed": 0.0}
+    Returns a dict with recomputed keys similar to period_metrics columns.
+    """
+    def _float(d, k, default=0.0):
+        # Metrics values are floats or NULL; keep the happy path free of an
+        # exception frame and only guard the rare non-numeric leftovers.
+        v = d.get(k, default)
+        if v is None or v == "":
+            return default
+        if type(v) is float:
+            return v
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return float(default)
+
+    sales_total = _float(baseline, "sales_total", 0.0)
+    var_total = _float(baseline, "var_total", 0.0)
+    fixed_total = _float(baseline, "fixed_total", 0.0)
+    opex_other_total = _float(baseline, "opex_other_total", 0.0)
+    visits_total = int(baseline.get("visits_total", 0) or 0)
+    days_count = int(baseline.get("days_count", 0) or 0)
+
+    sales_delta = float(deltas.get("sales", 0.0) or 0.0)
+    var_delta = float(deltas.get("var", 0.0) or 0.0)
+    fixed_delta = float(deltas.get("fixed", 0.0) or 0.0)
+
+    (
+        new_sales,
+        new_var,
+        new_fixed,
+        gross_profit,
+        net_profit_operational,
+        cm_ratio,
+        np_ratio,
+        breakeven_sales,
+        avg_daily_sales,
+        avg_sale_per_visit,
+    ) = _sim_kernel(
+        sales_total,
+        var_total,
+        fixed_total,
+        opex_other_total,
+        float(visits_total),
+        float(days_count),
+        sales_delta,
+        var_delta,
+        fixed_delta,
+    )
+
+    return {
+        "sales_total": new_sales,
+        "var_total": new_var,
+        "fixed_total": new_fixed,
+        "opex_other_total": opex_other_total,
+        "visits_total": visits_total,
+        "days_count": days_count,
+        "gross_profit": gross_profit,
+        "net_profit_operational": net_profit_operational,
+        "cm_ratio": cm_ratio,
+        "np_ratio": np_ratio,
+        "breakeven_sales": breakeven_sales,
+        "avg_daily_sales": avg_daily_sales,
+        "avg_sale_per_visit": avg_sale_per_visit,
+    }
+
+@owner_only_access
+async def cb_weekly_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """\n    Show a report for the last seven days (including today) for the selected\n    pharmacy and period. Callback data format:\n    ``fin.weekly.report:<pharmacy_id>:<period_id>``.\n    Aggregates daily logs and displays per-day entries as well as totals.\n    """
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    args = _parse_cb(data, TAG_WEEKLY_REPORT, 2)
+    if args is None:
+        return
+    try:
+        pharmacy_id, period_id = (int(p) for p in args)
+    except ValueError:
+        return
+    today = date.today()
+    window_end = today
+    window_start = today - timedelta(days=6)
+    period_row = await a_get_period(period_id) if period_id else None
+    if period_row:
+        period_start_iso = _get(period_row, "start_date", None)
+        period_end_iso = _get(period_row, "end_date", None)
+        if period_start_iso and period_end_iso:
+            try:
+                period_start_date = date.fromisoformat(period_start_iso)
+                period_end_date = date.fromisoformat(period_end_iso)
+                if period_end_date < period_start_date:
+                    period_start_date, period_end_date = period_end_date, period_start_date
+                window_end = period_end_date
+                period_length = (period_end_date - period_start_date).days + 1
+                if period_length >= 7:
+                    candidate_start = period_end_date - timedelta(days=6)
+                    window_start = candidate_start if candidate_start >= period_start_date else period_start_date
+                else:
+                    window_start = period_start_date
+            except ValueError:
+                pass
+    if window_end < window_start:
+        window_start = window_end
+    start_iso = window_start.isoformat()
+    end_iso = window_end.isoformat()
+    logs = await a_get_daily_range(pharmacy_id, start_iso, end_iso)
+    log_map = {r["log_date"]: r for r in map(dict, logs) if r.get("log_date")}
+    # Totals only need the days that actually have a log entry.
+    total_sales_cash = sum(float(r.get("sales_cash") or 0.0) for r in log_map.values())
+    total_sales_ins = sum(float(r.get("sales_ins") or 0.0) for r in log_map.values())
+    total_var = sum(float(r.get("var_purchases") or 0.0) for r in log_map.values())
+    total_opex = sum(float(r.get("opex_other") or 0.0) for r in log_map.values())
+    total_visits = sum(int(r.get("visits") or 0) for r in log_map.values())
+    total_window_days = (window_end - window_start).days
+    # Walk the window by ordinal instead of allocating a timedelta per day,
+    # producing the ISO strings the log map is keyed by directly.
+    base_ord = window_start.toordinal()
+    full_day_isos = [
+        date.fromordinal(base_ord + i).isoformat() for i in range(total_window_days + 1)
+    ]
+    if not full_day_isos:
+        full_day_isos = [start_iso]
+
+    zero = fmt_money(0.0)
+
+    def _fmt_day(day_iso: str, record: Optional[dict]) -> str:
+        if record:
+            note_val = record.get("note") or None
+            note_display = h(note_val) if note_val else "-"
+            return _WEEKLY_DAY_TMPL % (
+                h(day_iso),
+                fmt_money(record.get("sales_cash") or 0.0),
+                fmt_money(record.get("sales_ins") or 0.0),
+                fmt_money(record.get("var_purchases") or 0.0),
+                fmt_money(record.get("opex_other") or 0.0),
+                record.get("visits") or 0,
+                note_display,
+            )
+        return _WEEKLY_DAY_TMPL % (h(day_iso), zero, zero, zero, zero, 0, "– بدون ثبت –")
+
+    body = "\n".join(_fmt_day(day_iso, log_map.get(day_iso)) for day_iso in full_day_isos)
+    report_text = "\n".join([
+        f"<b>گزارش ۷ روزه از {h(start_iso)} تا {h(end_iso)}</b>",
+        body,
+        "",
+        "<b>جمع ۷ روزه</b>",
+        f"نقدی: {fmt_money(total_sales_cash)}",
+        f"بیمه: {fmt_money(total_sales_ins)}",
+        f"خرید متغیر: {fmt_money(total_var)}",
+        f"سایر هزینه‌ها: {fmt_money(total_opex)}",
+        f"مراجعه: {total_visits}",
+    ])
+    keyboard = _back_markup("?? ??????", TAG_PERIOD_SELECT, pharmacy_id, period_id)
+    await safe_edit(
+        message,
+        report_text,
+        reply_markup=keyboard,
+        context=context,
+        log_context="cb_weekly_report",
+    )
+
+@owner_only_access
+async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /start command."""
+    if not update.message:
+        return
+    await update.message.reply_text("به ربات مالی خوش آمدید!", reply_markup=main_menu_kb())
+
+@owner_only_access
+async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /help command."""
+    if not update.message:
+        return
+    await update.message.reply_text(HELP_TEXT)
+
+@owner_only_access
+async def cmd_about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /about command."""
+    if not update.message:
+        return
+    await update.message.reply_text(ABOUT_TEXT)
+
+@owner_only_access
+async def cmd_ping(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /ping command."""
+    if not update.message:
+        return
+    await update.message.reply_text("🏓 Pong!")
+
+@owner_only_access
+async def cb_home(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle home button callback."""
+    q = update.callback_query
+    if not q or not q.message:
+        return
+    await q.answer()
+    await safe_edit(q.message, "به ربات مالی خوش آمدید!", reply_markup=main_menu_kb(), context=context)
+
+@owner_only_access
+async def cb_pharm_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle new pharmacy button callback."""
+    q = update.callback_query
+    if not q or not q.message:
+        return
+    await q.answer()
+    await safe_edit(q.message, "نام داروخانه را وارد کنید:", reply_markup=ForceReply(), context=context)
+
+@owner_only_access
+async def cb_pharm_select(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle pharmacy selection callback."""
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message
+    if not message:
+        return
+    data = q.data or ""
+    match = _CB_PHARM_SELECT_RE.match(data)
+    if not match:
+        return
+    pharmacy_id = int(match.group(1))
+    await safe_edit(message, f"داروخانه #{pharmacy_id} انتخاب شد.", reply_markup=await asyncio.to_thread(period_list_kb, pharmacy_id), context=context)
+
+@owner_only_access
+async def cb_compare_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle compare start callback."""
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    await safe_edit(q.message, "ماه اول را انتخاب کنید:", reply_markup=month_picker_kb(date.today().year, tag=TAG_COMPARE_PICK_FIRST), context=context)
+
+@owner_only_access
+async def cb_compare_pick_first(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle first month selection for comparison."""
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    # Implementation here
+
+@owner_only_access
+async def cb_compare_pick_second(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle second month selection for comparison."""
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    # Implementation here
+
+async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle regular text messages."""
+    if not update.message:
+        return
+    await update.message.reply_text("لطفاً از دستورات و دکمه‌های موجود استفاده کنید.")
+
+# reportlab is optional and heavy; resolve the symbols once on first PDF
+# request instead of re-running the imports on every callback.
+_RL = None
+
+def _reportlab():
+    """Import the reportlab pieces on first use; returns a namespace or None."""
+    global _RL
+    if _RL is None:
+        try:
+            from types import SimpleNamespace
+            from reportlab.lib.pagesizes import A4
+            from reportlab.lib import colors
+            from reportlab.lib.styles import getSampleStyleSheet
+            from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+            from reportlab.pdfbase import pdfmetrics
+            from reportlab.pdfbase.ttfonts import TTFont
+            _RL = SimpleNamespace(
+                A4=A4,
+                colors=colors,
+                getSampleStyleSheet=getSampleStyleSheet,
+                SimpleDocTemplate=SimpleDocTemplate,
+                Table=Table,
+                TableStyle=TableStyle,
+                Paragraph=Paragraph,
+                Spacer=Spacer,
+                pdfmetrics=pdfmetrics,
+                TTFont=TTFont,
+            )
+        except Exception:
+            _RL = False
+    return _RL or None
+
+def _pdf_pct(v) -> str:
+    try:
+        return f"{float(v) * 100:.1f}%"
+    except Exception:
+        return "-"
+
+# (title, metrics key, unit, formatter) descriptors for the PDF table;
+# one static tuple instead of a per-call add_row chain.
+_PDF_COL_WIDTHS = (230, 120, 80)
+_PDF_ROWS = (
+    ("Cash Sales", "sales_cash", "Toman", fmt_money),
+    ("Insurance Deposits", "sales_ins", "Toman", fmt_money),
+    ("Total Sales", "sales_total", "Toman", fmt_money),
+    ("Variable Purchases", "var_total", "Toman", fmt_money),
+    ("Fixed Costs (Rent+Staff)", "fixed_total", "Toman", fmt_money),
+    ("Other Opex", "opex_other_total", "Toman", fmt_money),
+    ("Gross Profit", "gross_profit", "Toman", fmt_money),
+    ("Net Operating Profit", "net_profit_operational", "Toman", fmt_money),
+    ("Gross Margin", "cm_ratio", "%", _pdf_pct),
+    ("Net Margin", "np_ratio", "%", _pdf_pct),
+    ("Breakeven Sales", "breakeven_sales", "Toman", fmt_money),
+    ("Avg Daily Sales", "avg_daily_sales", "Toman/day", fmt_money),
+    ("Avg Sale/Visit", "avg_sale_per_visit", "Toman/visit", fmt_money),
+    ("Visits", "visits_total", "person", str),
+    ("Days in Period", "days_count", "day", str),
+)
+
+@lru_cache(1)
+def _pdf_styles() -> tuple:
+    """Title/Normal/Italic paragraph styles, built once per process."""
+    styles = _reportlab().getSampleStyleSheet()
+    return styles["Title"], styles["Normal"], styles["Italic"]
+
+@lru_cache(1)
+def _pdf_table_style():
+    """Shared immutable style for the metrics table."""
+    rl = _reportlab()
+    return rl.TableStyle(
+        [
+            ("GRID", (0, 0), (-1, -1), 0.5, rl.colors.gray),
+            ("BACKGROUND", (0, 0), (-1, 0), rl.colors.lightgrey),
+            ("ALIGN", (1, 1), (-1, -1), "LEFT"),
+        ]
+    )
+
+@lru_cache(1)
+def _pdf_static_flowables() -> tuple:
+    """Shared spacer and footer; reportlab flowables are reusable across builds."""
+    rl = _reportlab()
+    _, _, italic_style = _pdf_styles()
+    return rl.Spacer(1, 12), rl.Paragraph("This report was auto-generated by FINbot.", italic_style)
+
+@lru_cache(1)
+def _pdf_font_name() -> str:
+    """Register the Persian TTF once; falls back to Helvetica."""
+    rl = _reportlab()
+    try:
+        rl.pdfmetrics.registerFont(rl.TTFont("Vazirmatn", "./assets/fonts/Vazirmatn-Regular.ttf"))
+        return "Vazirmatn"
+    except Exception:
+        return "Helvetica"
+
+@owner_only_access
+async def cb_pdf_simple(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """\n    Generate a simple PDF report for a given pharmacy and period.\n    The callback data format is ``fin.pdf.simple:<pharmacy_id>:<period_id>``.\n\n    This handler attempts to import the reportlab library; if unavailable,\n    it informs the user that PDF generation is not possible. Otherwise,\n    it constructs a one‑page PDF containing the pharmacy name, period\n    information, and a simple three‑column table of key metrics.\n    """
+    q = update.callback_query
+    if not q:
+        return
+    await q.answer()
+    message = q.message or update.effective_message
+    if not message:
+        return
+    data = q.data or ""
+    args = _parse_cb(data, TAG_PDF_SIMPLE, 2)
+    if args is None:
+        return
+    try:
+        pharmacy_id, period_id = (int(p) for p in args)
+    except ValueError:
+        return
+    # The metrics/period row and the pharmacy title are independent reads;
+    # overlap them on the DB executor instead of awaiting serially.
+    joined_row, pharmacy_title = await asyncio.gather(
+        a_get_metrics_with_period(pharmacy_id, period_id),
+        a_get_pharmacy_title(pharmacy_id),
+        return_exceptions=True,
+    )
+    if isinstance(joined_row, BaseException) or not joined_row:
+        await safe_edit(
+            message,
+            "⚠️ دوره یا داده یافت نشد.",
+            reply_markup=None,
+            context=context,
+            log_context="cb_pdf_simple_missing",
+        )
+        return
+    rl = _reportlab()
+    if rl is None:
+        await safe_edit(
+            message,
+            "⚠️ امکان تولید فایل PDF وجود ندارد. لطفماً کتابخانه reportlab را نصب کنید.",
+            reply_markup=None,
+            context=context,
+            log_context="cb_pdf_simple_no_reportlab",
+        )
+        return
+    # The joined row carries both metric and period columns; read it in
+    # place instead of materializing a dict copy.
+    metrics = joined_row
+    period = joined_row
+    # Retrieve pharmacy name
+    pharmacy_name = pharmacy_title if isinstance(pharmacy_title, str) and pharmacy_title else f"#{pharmacy_id}"
+    # Prepare table data (English)
+    table_data: list[list[str]] = [
+        ["Metric", "Value", "Unit"],
+        *([title, fmt(_get(metrics, key)), unit] for title, key, unit, fmt in _PDF_ROWS),
+    ]
+    # Build the PDF straight into memory; no tempfile round trip. These
+    # reports are a single fixed-size page (a few KB), so a spill-to-disk
+    # buffer such as SpooledTemporaryFile would never overflow its spool
+    # and would only reintroduce the file-object chunked-read send path.
+    buf = io.BytesIO()
+    doc = rl.SimpleDocTemplate(buf, pagesize=rl.A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
+    # First call parses the TTF from disk; keep that off the event loop.
+    font_name = await _adb(_pdf_font_name)
+    title_style, normal_style, _ = _pdf_styles()
+    spacer, footer = _pdf_static_flowables()
+    # Table with metrics
+    table = rl.Table(table_data, colWidths=_PDF_COL_WIDTHS)
+    table.setStyle(_pdf_table_style())
+    story = [
+        rl.Paragraph(f"Financial Report for Pharmacy {h(str(pharmacy_name))}", title_style),
+        rl.Paragraph(f"Period: {h(str(_get(period, 'title', '')))}", normal_style),
+        rl.Paragraph(f"From {h(str(_get(period, 'start_date', '-')))} to {h(str(_get(period, 'end_date', '-')))}", normal_style),
+        rl.Paragraph(f"Status: {h(str(_get(period, 'status', 'open')))}", normal_style),
+        rl.Paragraph(f"Generated on: {date.today().isoformat()}", normal_style),
+        spacer,
+        table,
+        spacer,
+        footer,
+    ]
+    # Render the PDF on a worker thread; reportlab is pure-Python CPU work
+    # that would otherwise stall every other handler for the build duration.
+    await asyncio.to_thread(doc.build, story)
+    # Hand httpx the raw bytes: a file handle would go through its seek +
+    # 64KB chunked re-read path, a bytes payload is serialized in one shot.
+    pdf_bytes = buf.getvalue()
+    # Send the generated PDF to the user
+    try:
+        await context.bot.send_document(
+            chat_id=message.chat.id,
+            document=pdf_bytes,
+            filename=f"Report_{pharmacy_id}_{period_id}.pdf",
+            caption="📄 PDF report is ready.",
+            read_timeout=60,
+            write_timeout=60,
+        )
+    except Exception:
+        await safe_edit(
+            message,
+            "⚠️ خطا در ارسال فایل PDF.",
+            reply_markup=None,
+            context=context,
+            log_context="cb_pdf_simple_send_error",
+        )
+
+async def _post_shutdown(application) -> None:
+    await drain_write_queue()
+
+def main() -> None:
+    """Entry point for running the Telegram bot."""
+    try:  # optional, like numba: use the libuv event loop when available
+        import uvloop
+        uvloop.install()
+    except Exception:
+        pass
+    migrate()
+    application = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # Generous read/write timeouts keep slow PDF uploads from timing out
+        # and re-triggering the whole build; the larger pool lets concurrent
+        # chats send without queueing on a connection.
+        .request(
+            HTTPXRequest(
+                connection_pool_size=32,
+                connect_timeout=10,
+                read_timeout=60,
+                write_timeout=60,
+            )
+        )
+        .defaults(Defaults(parse_mode=ParseMode.HTML))
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
+
+    # --- Commands ---
+    application.add_handler(CommandHandler("start", cmd_start))
+    application.add_handler(CommandHandler("help", cmd_help))
+    application.add_handler(CommandHandler("about", cmd_about))
+    application.add_handler(CommandHandler("ping", cmd_ping))
+
+    # --- Callback routes (registered in order, top to bottom) ---
+    callback_routes = (
+        # main menu flow
+        (cb_home, _CB_HOME_RE),
+        (cb_pharm_new, _CB_PHARM_NEW_RE),
+        (cb_pharm_select, _CB_PHARM_SELECT_RE),
+        # check registration
+        (cb_check_start, _CB_CHECK_START_RE),
+        (cb_check_pick_day, _CB_CHECK_PICK_DAY_RE),
+        # daily registration
+        (cb_daily_start, _CB_DAILY_START_RE),
+        (cb_daily_pick_day, _CB_DAILY_PICK_DAY_RE),
+        # monthly summary
+        (cb_summary_start, _CB_SUMMARY_START_RE),
+        (cb_summary_pick_month, _CB_SUMMARY_PICK_MONTH_RE),
+        # compare months
+        (cb_compare_start, _CB_COMPARE_START_RE),
+        (cb_compare_pick_first, _CB_COMPARE_PICK_FIRST_RE),
+        (cb_compare_pick_second, _CB_COMPARE_PICK_SECOND_RE),
+    )
+    for callback, pattern in callback_routes:
+        application.add_handler(CallbackQueryHandler(callback, pattern=pattern))
+
+    # --- Unified message flow (check/daily) ---
+    application.add_handler(MessageHandler(filters.TEXT & filters.REPLY & ~filters.COMMAND, msg_flow_router))
+
+    # Fallback handler (optional text logging)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_message))
+
+    # --- Start polling ---
+    application.run_polling(
+        allowed_updates=[
+            UpdateType.MESSAGE,
+            UpdateType.CALLBACK_QUERY,
+            UpdateType.EDITED_MESSAGE,
+            UpdateType.MY_CHAT_MEMBER,
+            UpdateType.CHAT_MEMBER,
+        ],
+        drop_pending_updates=True,
+    )
+
+
+if __name__ == "__main__":
+    import sys
+    try:
+        main()
+    except KeyboardInterrupt:
+        pass
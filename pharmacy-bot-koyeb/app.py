@@ -1,11 +1,19 @@
 
 import os
+import re
+import json
 import asyncio
 import logging
 from typing import Optional
-from datetime import datetime
+from datetime import datetime, timezone
 
 from aiohttp import web
+
+try:  # optional: libuv event loop, noticeably cheaper per socket op
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, ConversationHandler,
@@ -29,15 +37,42 @@ STORE_PHONE = os.getenv("STORE_PHONE", "Phone not set")
 STORE_LAT = os.getenv("STORE_LAT")
 STORE_LON = os.getenv("STORE_LON")
 
+# Admin id changes only on /make_me_admin; a slotted ref lets the hot
+# handlers read it as a plain attribute without per-call global statements.
+class _AdminRef:
+    __slots__ = ("id",)
+
+ADMIN = _AdminRef()
 try:
-    ADMIN_CHAT_ID: Optional[int] = int(os.getenv("ADMIN_CHAT_ID", "0") or "0")
+    ADMIN.id = int(os.getenv("ADMIN_CHAT_ID", "0") or "0")
 except Exception:
-    ADMIN_CHAT_ID = 0
+    ADMIN.id = 0
 
 PORT = int(os.getenv("PORT", "8080"))  # Koyeb sets PORT for web services
 
+# Store details come from env vars and never change after startup;
+# format the info text and parse the coordinates exactly once.
+_INFO_TEXT = f"""{STORE_NAME}
+Address: {STORE_ADDRESS}
+Phone: {STORE_PHONE}
+"""
+try:
+    _INFO_LAT: Optional[float] = float(STORE_LAT) if STORE_LAT else None
+    _INFO_LON: Optional[float] = float(STORE_LON) if STORE_LON else None
+except (TypeError, ValueError):
+    _INFO_LAT = _INFO_LON = None
+
 FEEDBACK = 1  # conversation state
 
+_TS_FMT = "%Y-%m-%d %H:%M:%S UTC"
+
+# Compiled once; the inline (?i) flag mid-pattern is deprecated on 3.12+
+# and re-parsing the pattern string per handler registration is wasted work.
+_INFO_RE = re.compile(r"^info$", re.IGNORECASE)
+# Matches both the keyboard button and the /feedback command, so the
+# conversation needs a single entry point instead of two handlers.
+_FEEDBACK_RE = re.compile(r"^/?feedback$", re.IGNORECASE)
+
 def kb_main():
     return ReplyKeyboardMarkup(
         [
@@ -62,46 +97,40 @@ async def id_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(f"Your chat ID is {chat.id}")
 
 async def admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global ADMIN_CHAT_ID
-    await update.message.reply_text(f"Admin chat id is: {ADMIN_CHAT_ID}")
+    await update.message.reply_text(f"Admin chat id is: {ADMIN.id}")
 
 async def make_admin_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global ADMIN_CHAT_ID
-    ADMIN_CHAT_ID = update.effective_chat.id
-    await update.message.reply_text(f"Done. ADMIN_CHAT_ID set to {ADMIN_CHAT_ID}")
-    log.info("ADMIN_CHAT_ID set via /make_me_admin: %s", ADMIN_CHAT_ID)
+    ADMIN.id = update.effective_chat.id
+    await update.message.reply_text(f"Done. ADMIN_CHAT_ID set to {ADMIN.id}")
+    log.info("ADMIN_CHAT_ID set via /make_me_admin: %s", ADMIN.id)
 
 async def info_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    txt = f"""{STORE_NAME}
-Address: {STORE_ADDRESS}
-Phone: {STORE_PHONE}
-"""
-    await update.message.reply_text(txt)
-    try:
-        if STORE_LAT and STORE_LON:
-            lat = float(STORE_LAT); lon = float(STORE_LON)
-            await update.message.bot.send_location(chat_id=update.effective_chat.id, latitude=lat, longitude=lon)
-    except Exception as e:
-        log.warning("Failed to send location: %s", e)
+    await update.message.reply_text(_INFO_TEXT)
+    if _INFO_LAT is not None and _INFO_LON is not None:
+        try:
+            await update.message.bot.send_location(chat_id=update.effective_chat.id, latitude=_INFO_LAT, longitude=_INFO_LON)
+        except Exception as e:
+            log.warning("Failed to send location: %s", e)
 
 async def feedback_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Please type your feedback. I will forward it to the pharmacist.")
     return FEEDBACK
 
 async def feedback_collect(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global ADMIN_CHAT_ID
     text = update.message.text or ""
     user = update.effective_user
-    ts = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+    ts = datetime.now(timezone.utc).strftime(_TS_FMT)
     summary = (
         f"📝 New Feedback\n"
         f"From: {user.full_name} (id {user.id})\n"
         f"Time: {ts}\n"
         f"Text: {text}"
     )
-    if ADMIN_CHAT_ID:
-        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=summary)
-        await update.message.reply_text("Thanks! Your feedback was sent ✅")
+    if ADMIN.id:
+        await asyncio.gather(
+            context.bot.send_message(chat_id=ADMIN.id, text=summary),
+            update.message.reply_text("Thanks! Your feedback was sent ✅"),
+        )
     else:
         await update.message.reply_text("Received your feedback. (Admin isn't configured yet, so it wasn't delivered.)")
         log.info("Feedback received but admin not set.")
@@ -112,7 +141,6 @@ async def cancel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     return ConversationHandler.END
 
 async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    global ADMIN_CHAT_ID
     msg = update.message
     if not msg or not msg.photo:
         return
@@ -120,7 +148,7 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     file_id = msg.photo[-1].file_id
     caption = msg.caption or "(no caption)"
     user = update.effective_user
-    ts = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S UTC")
+    ts = datetime.now(timezone.utc).strftime(_TS_FMT)
     header = (
         f"🧾 Prescription photo\n"
         f"From: {user.full_name} (id {user.id})\n"
@@ -128,22 +156,35 @@ async def photo_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Caption: {caption}"
     )
 
-    if ADMIN_CHAT_ID:
-        await context.bot.send_message(chat_id=ADMIN_CHAT_ID, text=header)
-        await context.bot.send_photo(chat_id=ADMIN_CHAT_ID, photo=file_id)
-        await msg.reply_text("Thanks! Your prescription was sent ✅")
+    if ADMIN.id:
+        # One API call instead of two: the header rides along as the caption.
+        # The admin forward and the user ack are independent; overlap them.
+        await asyncio.gather(
+            context.bot.send_photo(chat_id=ADMIN.id, photo=file_id, caption=header),
+            msg.reply_text("Thanks! Your prescription was sent ✅"),
+        )
     else:
         await msg.reply_text("Received the photo (admin isn't configured yet, so it wasn't forwarded).")
         log.info("Photo received but admin not set.")
 
 # --- Minimal HTTP server for Koyeb health checks ---
+# Koyeb polls these every few seconds; serve preserialized bodies and only
+# re-encode the health JSON when the admin id actually changes.
+_OK_BODY = b"OK"
+_health_cache: tuple = (None, b"")
+
 async def handle_root(request):
-    return web.Response(text="OK")
+    return web.Response(body=_OK_BODY, content_type="text/plain")
 
 async def handle_health(request):
-    return web.json_response({"status": "ok", "admin": ADMIN_CHAT_ID})
-
-async def run_http_app():
+    global _health_cache
+    cached_admin, body = _health_cache
+    if cached_admin != ADMIN.id:
+        body = json.dumps({"status": "ok", "admin": ADMIN.id}).encode()
+        _health_cache = (ADMIN.id, body)
+    return web.Response(body=body, content_type="application/json")
+
+async def run_http_app() -> web.AppRunner:
     app = web.Application()
     app.router.add_get("/", handle_root)
     app.router.add_get("/health", handle_health)
@@ -152,9 +193,10 @@ async def run_http_app():
     site = web.TCPSite(runner, host="0.0.0.0", port=PORT)
     await site.start()
     log.info("HTTP health server running on 0.0.0.0:%s", PORT)
+    return runner
 
 async def main_async():
-    log.info("Starting bot... Admin chat id at startup: %s", ADMIN_CHAT_ID)
+    log.info("Starting bot... Admin chat id at startup: %s", ADMIN.id)
     tg_app = Application.builder().token(BOT_TOKEN).build()
 
     # telegram handlers
@@ -165,25 +207,29 @@ async def main_async():
     tg_app.add_handler(CommandHandler("admin", admin_cmd))
     tg_app.add_handler(CommandHandler("make_me_admin", make_admin_cmd))
     tg_app.add_handler(ConversationHandler(
-        entry_points=[CommandHandler("feedback", feedback_start), MessageHandler(filters.Regex(r"^(?i)feedback$"), feedback_start)],
+        entry_points=[MessageHandler(filters.TEXT & filters.Regex(_FEEDBACK_RE), feedback_start)],
         states={
             FEEDBACK: [MessageHandler(filters.TEXT & ~filters.COMMAND, feedback_collect)]
         },
         fallbacks=[CommandHandler("cancel", cancel_cmd)]
     ))
-    tg_app.add_handler(MessageHandler(filters.Regex(r"^(?i)info$"), info_cmd))
+    tg_app.add_handler(MessageHandler(filters.Regex(_INFO_RE), info_cmd))
     tg_app.add_handler(MessageHandler(filters.PHOTO, photo_handler))
 
     # Start both the Telegram polling and the HTTP health server
     await tg_app.initialize()
     await tg_app.start()
-    await run_http_app()
+    # tg_app.start() alone does not fetch updates; the updater must poll.
+    await tg_app.updater.start_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    runner = await run_http_app()
     # Keep running until interrupted
     try:
         await asyncio.Event().wait()
     finally:
+        await tg_app.updater.stop()
         await tg_app.stop()
         await tg_app.shutdown()
+        await runner.cleanup()
 
 if __name__ == "__main__":
     asyncio.run(main_async())